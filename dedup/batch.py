@@ -0,0 +1,442 @@
+"""
+This module provides the batch operations on the records of a dedup collection.
+
+Batch operations read the collection with a cursor and process the records by chunks: the NZ
+records of a chunk are fetched with one query, its pairs of records are evaluated at once and
+its updates are written with one `bulk_write`.
+
+Functions:
+- iter_chunks: Splits an iterator of records into lists of records.
+- auto_accept_matches: Accepts the possible matches whose best candidate reaches a threshold.
+- materialize_field_scores: Stores the similarity scores of the fields of the best candidate of each record.
+- rescore_chunk: Evaluates the candidates of a chunk of records, runs in a worker process.
+- rescore_collection: Recomputes the 'max_match_score' of the records of a collection with a pool of processes.
+"""
+
+import time
+from collections import deque
+from concurrent.futures import Executor
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+from pymongo import UpdateOne
+
+from . import scoring
+from . import tools
+
+# Field set on the records matched by `auto_accept_matches` instead of 'human_validated'. It
+# contains the method, the threshold and the similarity score of the accepted candidate.
+AUTO_ACCEPTED_FIELD = 'auto_accepted'
+
+# Number of accepted matches returned as examples by `auto_accept_matches`
+NB_AUTO_ACCEPT_SAMPLES = 20
+
+# Fields of the dedup documents used by `rescore_chunk`
+RESCORE_PROJECTION = {'_id': True, 'rec_id': True, 'briefrec': True, 'possible_matches': True,
+                      'match_type': True, 'max_match_score': True, scoring.SCORES_CACHE_FIELD: True}
+
+
+def iter_chunks(recs: Iterable[Dict], chunk_size: int) -> Iterator[List[Dict]]:
+    """
+    Split an iterator of records into lists of records.
+
+    Parameters:
+    -----------
+    recs : iterable of dict
+        The records to split, for example a cursor.
+    chunk_size : int
+        The maximum number of records of each chunk.
+
+    Returns:
+    --------
+    iterator of list
+        The chunks of records, the last one can be smaller.
+    """
+    chunk = []
+    for rec in recs:
+        chunk.append(rec)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def auto_accept_matches(col_name: str,
+                        mongo_db_dedup: 'pymongo.database.Database',
+                        mongo_col_nz: 'pymongo.collection.Collection',
+                        threshold: float,
+                        method: str = 'mean',
+                        dry_run: bool = False,
+                        chunk_size: int = 500,
+                        min_stored_score: Optional[float] = None,
+                        user: Optional[str] = None,
+                        max_records: Optional[int] = None) -> Dict:
+    """
+    Accept the possible matches whose best candidate reaches a threshold.
+
+    The candidates of the records with the 'possible_match' match type and not validated
+    by a human are evaluated with the provided method. A record is matched when exactly
+    one candidate has a similarity score of at least `threshold`, records with several such
+    candidates are reported as ambiguous and left unchanged.
+
+    Accepted records get the 'match' match type and `AUTO_ACCEPTED_FIELD` instead of
+    'human_validated'. They are written with one `bulk_write` by chunk and the statistics
+    of the collection are updated by chunk. They are marked with `tools.MATCH_TYPE_DIRTY_FIELD`
+    and the match types of the collection are refreshed once at the end, see
+    `tools.run_match_type_refresh`. Accepted records are added to the decision journal
+    with the 'auto_accept' source. Records decided by a human during the batch are left
+    unchanged and are not counted as accepted.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    mongo_col_nz : pymongo.collection.Collection
+        The collection of the NZ records.
+    threshold : float
+        The minimum similarity score of the accepted candidate.
+    method : str
+        The method used to calculate the similarity score, see `scoring.SCORING_METHODS`.
+    dry_run : bool
+        Whether to only report the matches that would be accepted, nothing is written.
+    chunk_size : int
+        The number of records processed at once.
+    min_stored_score : float, optional
+        Only the records with a stored 'max_match_score' of at least this value are
+        evaluated. It reduces the number of evaluated records when the stored score
+        is computed with a similar method.
+    user : str, optional
+        The username recorded in the decision journal.
+    max_records : int, optional
+        The maximum number of evaluated records, all the records by default.
+
+    Returns:
+    --------
+    dict
+        The numbers of 'checked', 'accepted', 'ambiguous' and 'below_threshold' records,
+        the first accepted matches as examples in 'samples' and in 'truncated' whether
+        `max_records` stopped the batch before the end of the collection.
+    """
+    query = {'match_type': 'possible_match', 'human_validated': {'$ne': True}, 'matched_record': None}
+    if min_stored_score is not None:
+        query['max_match_score'] = {'$gte': min_stored_score}
+
+    projection = {'_id': False, 'rec_id': True, 'briefrec': True, 'possible_matches': True,
+                  'match_type': True, 'max_match_score': True, scoring.SCORES_CACHE_FIELD: True}
+
+    summary = {'checked': 0, 'accepted': 0, 'ambiguous': 0, 'below_threshold': 0, 'samples': [], 'truncated': False}
+    cursor = mongo_db_dedup[col_name].find(query, projection, batch_size=chunk_size).sort('_id', 1)
+    if max_records is not None:
+        # One more record tells if the collection has more records to evaluate
+        cursor = cursor.limit(max_records + 1)
+
+    for recs in iter_chunks(cursor, chunk_size):
+        if max_records is not None and summary['checked'] + len(recs) > max_records:
+            recs = recs[:max_records - summary['checked']]
+            summary['truncated'] = True
+            if len(recs) == 0:
+                break
+
+        # NZ records of the whole chunk are fetched with one query
+        mms_ids = list(dict.fromkeys(mms_id for rec in recs for mms_id in rec.get('possible_matches') or []))
+        nz_cached_briefrecs = scoring.get_nz_briefrecs(mms_ids, mongo_col_nz)
+        evaluations, scores_cache_updates = scoring.evaluate_local_recs(recs, nz_cached_briefrecs, method)
+
+        # MongoDB stores dates with a precision of a millisecond, the date is used to
+        # find the records accepted by this chunk
+        now = datetime.now(timezone.utc)
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        requests = []
+        old_recs = []
+        new_recs = []
+        for rec in recs:
+            summary['checked'] += 1
+            accepted = [(mms_id, float(similarity_score))
+                        for mms_id, _, similarity_score in evaluations[rec['rec_id']]
+                        if similarity_score >= threshold]
+
+            if len(accepted) == 0:
+                summary['below_threshold'] += 1
+                continue
+            if len(accepted) > 1:
+                summary['ambiguous'] += 1
+                continue
+
+            mms_id, similarity_score = accepted[0]
+            summary['accepted'] += 1
+            if len(summary['samples']) < NB_AUTO_ACCEPT_SAMPLES:
+                summary['samples'].append({'rec_id': rec['rec_id'], 'matched_record': mms_id,
+                                           'similarity_score': similarity_score})
+
+            # Human decisions taken during the batch are not overwritten
+            requests.append(UpdateOne({'rec_id': rec['rec_id'], 'matched_record': None,
+                                       'human_validated': {'$ne': True}},
+                                      {'$set': {'matched_record': mms_id,
+                                                'match_type': 'match',
+                                                AUTO_ACCEPTED_FIELD: {'method': method,
+                                                                      'threshold': threshold,
+                                                                      'similarity_score': similarity_score,
+                                                                      'date': now},
+                                                tools.MATCH_TYPE_DIRTY_FIELD: True}}))
+            old_recs.append(rec)
+            new_recs.append({**rec, 'match_type': 'match'})
+
+        if dry_run is True:
+            continue
+
+        # Newly evaluated similarity scores are stored with the decisions
+        requests += [UpdateOne({'rec_id': rec_id}, {'$set': update}) for rec_id, update in scores_cache_updates.items()]
+        if len(requests) > 0:
+            mongo_db_dedup[col_name].bulk_write(requests, ordered=False)
+        if len(old_recs) == 0:
+            continue
+
+        # Records decided by a human during the batch are not updated. Only the accepted
+        # records are counted, applied to the statistics and journaled, the statistics of
+        # the human decisions are updated by the decisions themselves.
+        accepted_recs = list(mongo_db_dedup[col_name].find({'rec_id': {'$in': [rec['rec_id'] for rec in old_recs]},
+                                                            f'{AUTO_ACCEPTED_FIELD}.date': now},
+                                                           {'_id': False, 'rec_id': True, 'matched_record': True}))
+        accepted_rec_ids = {rec['rec_id'] for rec in accepted_recs}
+        if len(accepted_rec_ids) < len(old_recs):
+            summary['accepted'] -= len(old_recs) - len(accepted_rec_ids)
+            summary['samples'] = [sample for sample in summary['samples']
+                                  if sample['rec_id'] in accepted_rec_ids
+                                  or sample['rec_id'] not in {rec['rec_id'] for rec in old_recs}]
+
+        tools.update_collection_stats(col_name, mongo_db_dedup, tools.get_stats_delta(
+            [rec for rec in old_recs if rec['rec_id'] in accepted_rec_ids],
+            [rec for rec in new_recs if rec['rec_id'] in accepted_rec_ids]))
+        tools.write_journal_entries(mongo_db_dedup,
+                                    [tools.get_journal_entry(col_name, rec['rec_id'], rec['matched_record'],
+                                                             None, 'auto_accept', user, now)
+                                     for rec in accepted_recs])
+
+    if dry_run is False and summary['accepted'] > 0:
+        # If another refresh is running, the first call waits for its end and the
+        # second one refreshes the records accepted by this batch
+        if tools.run_match_type_refresh(col_name, mongo_db_dedup) is False:
+            tools.run_match_type_refresh(col_name, mongo_db_dedup)
+
+    return summary
+
+
+def materialize_field_scores(col_name: str,
+                             mongo_db_dedup: 'pymongo.database.Database',
+                             mongo_col_nz: 'pymongo.collection.Collection',
+                             only_missing: bool = False,
+                             chunk_size: int = 500) -> int:
+    """
+    Store the similarity scores of the fields of the best candidate of each record.
+
+    The candidates are evaluated with the method of the setting `DEDUP_FIELD_SCORES_METHOD`,
+    the stored similarity scores of the fields are reused. The scores are written in
+    `tools.FIELD_SCORES_FIELD`, see `scoring.get_field_scores_update`.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    mongo_col_nz : pymongo.collection.Collection
+        The collection of the NZ records.
+    only_missing : bool
+        Whether to only process the records without stored scores of the fields.
+    chunk_size : int
+        The number of records processed at once.
+
+    Returns:
+    --------
+    int
+        The number of processed records.
+    """
+    method = settings.DEDUP_FIELD_SCORES_METHOD
+    query = {tools.FIELD_SCORES_FIELD: {'$exists': False}} if only_missing is True else {}
+    projection = {'_id': False, 'rec_id': True, 'briefrec': True, 'possible_matches': True,
+                  scoring.SCORES_CACHE_FIELD: True}
+
+    nb_recs = 0
+    cursor = mongo_db_dedup[col_name].find(query, projection, batch_size=chunk_size).sort('_id', 1)
+    for recs in iter_chunks(cursor, chunk_size):
+        mms_ids = list(dict.fromkeys(mms_id for rec in recs for mms_id in rec.get('possible_matches') or []))
+        nz_cached_briefrecs = scoring.get_nz_briefrecs(mms_ids, mongo_col_nz)
+        evaluations, scores_cache_updates = scoring.evaluate_local_recs(recs, nz_cached_briefrecs, method)
+
+        requests = [UpdateOne({'rec_id': rec['rec_id']},
+                              {'$set': {**scores_cache_updates.get(rec['rec_id'], dict()),
+                                        **scoring.get_field_scores_update(evaluations[rec['rec_id']], method)}})
+                    for rec in recs]
+        mongo_db_dedup[col_name].bulk_write(requests, ordered=False)
+        nb_recs += len(recs)
+
+    return nb_recs
+
+
+def rescore_chunk(recs: List[Dict], nz_recs: List[Dict], method: str, with_field_scores: bool) -> List[Dict]:
+    """
+    Evaluate the candidates of a chunk of records, runs in a worker process.
+
+    The brief records are parsed and the pairs are evaluated sequentially in the
+    worker, only the raw records and the resulting updates are sent between the
+    processes.
+
+    Parameters:
+    -----------
+    recs : list of dict
+        The dedup documents, with the fields of `RESCORE_PROJECTION`.
+    nz_recs : list of dict
+        The NZ records of the candidates of the chunk.
+    method : str
+        The method used to calculate the similarity score.
+    with_field_scores : bool
+        Whether to store the similarity scores of the fields of the best candidate.
+
+    Returns:
+    --------
+    list of dict
+        For each record, the 'rec_id', the '$set' update in 'update' and the new
+        'max_match_score'. Without any candidate found, the score is None and the stored
+        scores of the candidates and of the fields are removed.
+    """
+    nz_cached_briefrecs = {nz_rec['mms_id']: scoring.CachedBriefRec(scoring.JsonBriefRec(nz_rec))
+                           for nz_rec in nz_recs}
+    evaluations, scores_cache_updates = scoring.evaluate_local_recs(recs, nz_cached_briefrecs, method,
+                                                                    sequential=True)
+
+    results = []
+    for rec in recs:
+        evaluation = evaluations[rec['rec_id']]
+        if len(evaluation) == 0:
+            # Scores of candidates missing in the NZ collection are outdated
+            max_match_score = None
+            update = {scoring.SCORES_CACHE_FIELD: dict(), 'max_match_score': None}
+        else:
+            max_match_score = max(float(similarity_score) for _, _, similarity_score in evaluation)
+            update = {**scores_cache_updates.get(rec['rec_id'], dict()), 'max_match_score': max_match_score}
+        if with_field_scores is True:
+            update.update(scoring.get_field_scores_update(evaluation, method))
+        results.append({'rec_id': rec['rec_id'], 'update': update, 'max_match_score': max_match_score})
+
+    return results
+
+
+def _get_rescore_checkpoint_id(col_name: str) -> str:
+    """Return the ID of the checkpoint of the rescoring of a collection in the meta collection"""
+    return f'rescore:{col_name}'
+
+
+def rescore_collection(col_name: str,
+                       mongo_db_dedup: 'pymongo.database.Database',
+                       mongo_col_nz: 'pymongo.collection.Collection',
+                       executor: Executor,
+                       method: str = 'mean',
+                       chunk_size: int = 500,
+                       max_pending_chunks: int = 8,
+                       restart: bool = False,
+                       progress: Optional[Callable[[int, int, float], None]] = None) -> int:
+    """
+    Recompute the 'max_match_score' of the records of a collection with a pool of processes.
+
+    The collection is read by '_id' with a cursor. For each chunk of records, the NZ
+    records of all the candidates are fetched with one query and the chunk is
+    evaluated by a worker, see `rescore_chunk`. Several chunks are evaluated at once,
+    their results are written in the order of the chunks with one `bulk_write` by
+    chunk. The stored similarity scores of the fields are reused and updated. With the
+    method of the setting `DEDUP_FIELD_SCORES_METHOD`, the scores of the fields of the
+    best candidate are stored too. Records whose candidates are all missing in the NZ
+    collection get a 'max_match_score' of None and lose their stored scores.
+
+    The '_id' of the last written record is saved in the meta collection after each
+    chunk. An unfinished rescoring with the same method is resumed from this checkpoint.
+    The changes of 'max_match_score' are applied to the statistics of the collection.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    mongo_col_nz : pymongo.collection.Collection
+        The collection of the NZ records.
+    executor : concurrent.futures.Executor
+        The pool of workers evaluating the chunks, usually a `ProcessPoolExecutor`.
+    method : str
+        The method used to calculate the similarity score, see `scoring.SCORING_METHODS`.
+    chunk_size : int
+        The number of records of each chunk.
+    max_pending_chunks : int
+        The maximum number of chunks read and not written yet, it limits the memory usage.
+    restart : bool
+        Whether to ignore the checkpoint and process the whole collection.
+    progress : callable, optional
+        Called after each chunk with the number of processed records, the number of
+        records to process and the elapsed time in seconds.
+
+    Returns:
+    --------
+    int
+        The number of records processed by this call.
+    """
+    checkpoint_id = _get_rescore_checkpoint_id(col_name)
+    checkpoint = mongo_db_dedup[tools.META_COL].find_one({'_id': checkpoint_id})
+    with_field_scores = method == settings.DEDUP_FIELD_SCORES_METHOD
+
+    query = dict()
+    if restart is False and checkpoint is not None and checkpoint.get('finished') is None \
+            and checkpoint.get('method') == method and checkpoint.get('last_id') is not None:
+        query = {'_id': {'$gt': checkpoint['last_id']}}
+    else:
+        mongo_db_dedup[tools.META_COL].replace_one({'_id': checkpoint_id},
+                                                   {'method': method,
+                                                    'last_id': None,
+                                                    'started': datetime.now(timezone.utc)},
+                                                   upsert=True)
+
+    nb_total = mongo_db_dedup[col_name].count_documents(query)
+    nb_done = 0
+    start_time = time.monotonic()
+
+    def write_chunk(recs: List[Dict], results: List[Dict]) -> None:
+        nonlocal nb_done
+        old_recs = {rec['rec_id']: rec for rec in recs}
+        if len(results) > 0:
+            mongo_db_dedup[col_name].bulk_write([UpdateOne({'rec_id': result['rec_id']}, {'$set': result['update']})
+                                                 for result in results], ordered=False)
+            tools.update_collection_stats(col_name, mongo_db_dedup, tools.get_stats_delta(
+                [old_recs[result['rec_id']] for result in results],
+                [{**old_recs[result['rec_id']], 'max_match_score': result['max_match_score']} for result in results]))
+
+        mongo_db_dedup[tools.META_COL].update_one({'_id': checkpoint_id},
+                                                  {'$set': {'last_id': recs[-1]['_id'],
+                                                            'updated': datetime.now(timezone.utc)},
+                                                   '$inc': {'nb_done': len(recs)}})
+        nb_done += len(recs)
+        if progress is not None:
+            progress(nb_done, nb_total, time.monotonic() - start_time)
+
+    # Chunks are written in the order they are read, so the checkpoint is always
+    # the '_id' of a record whose predecessors are all written
+    pending = deque()
+    cursor = mongo_db_dedup[col_name].find(query, RESCORE_PROJECTION, batch_size=chunk_size).sort('_id', 1)
+    for recs in iter_chunks(cursor, chunk_size):
+        mms_ids = list(dict.fromkeys(mms_id for rec in recs for mms_id in rec.get('possible_matches') or []))
+        nz_recs = tools.fetch_nz_records(mms_ids, mongo_col_nz)
+        pending.append((recs, executor.submit(rescore_chunk, recs, nz_recs, method, with_field_scores)))
+
+        if len(pending) >= max_pending_chunks:
+            recs, future = pending.popleft()
+            write_chunk(recs, future.result())
+
+    while len(pending) > 0:
+        recs, future = pending.popleft()
+        write_chunk(recs, future.result())
+
+    mongo_db_dedup[tools.META_COL].update_one({'_id': checkpoint_id},
+                                              {'$set': {'finished': datetime.now(timezone.utc)}})
+
+    return nb_done
@@ -0,0 +1,288 @@
+"""
+This module declares the MongoDB indexes required by the queries of the apps and checks them.
+
+Indexes are declared by type of collection: dedup collections, training data, decision journal,
+NZ records and callnumber collections. Each declaration is a dict with the keys of the index and the options
+passed to `create_index`.
+
+Functions:
+- get_index_key: Returns the key of an index as a tuple of (field, direction) pairs.
+- ensure_indexes: Creates the missing declared indexes of a collection.
+- find_unused_indexes: Returns the indexes of a collection that have never been used.
+- find_redundant_indexes: Returns the indexes of a collection that are a prefix of another index.
+- get_plan_stages: Returns the stages of the winning plan of an explained query.
+- get_dedup_query_checks: Returns the main queries of the views on a dedup collection.
+- get_training_data_query_checks: Returns the main queries on the training data collection.
+- get_journal_query_checks: Returns the main queries on the decision journal.
+- get_nz_query_checks: Returns the main queries on the NZ collection.
+- get_callnumber_query_checks: Returns the main queries on a callnumber collection.
+- find_collscans: Returns the queries of a collection that would do a collection scan.
+"""
+
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Tuple
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from . import tools
+
+# Indexes of the dedup collections: lookups by rec_id, paging of the filters of the
+# list by _id, paging of the duplicate matches and grouping by matched record, claim
+# of the records to refresh and filters on the similarity scores of the fields
+DEDUP_INDEXES = [
+    {'keys': [('rec_id', ASCENDING)], 'options': {}},
+    {'keys': [('match_type', ASCENDING), ('_id', ASCENDING)], 'options': {}},
+    {'keys': [('match_type', ASCENDING), ('matched_record', ASCENDING), ('_id', ASCENDING)], 'options': {}},
+    {'keys': [('matched_record', ASCENDING)], 'options': {}},
+    {'keys': [(tools.MATCH_TYPE_DIRTY_FIELD, ASCENDING)], 'options': {'sparse': True}},
+    {'keys': [(f'{tools.FIELD_SCORES_FIELD}.$**', ASCENDING)], 'options': {}},
+]
+
+# Indexes of the training data collection, entries are replaced by match ID
+TRAINING_DATA_INDEXES = [
+    {'keys': [('match_id', ASCENDING)], 'options': {'unique': True}},
+    {'keys': [('type', ASCENDING)], 'options': {}},
+]
+
+# Indexes of the decision journal, entries are exported by collection and time of writing
+JOURNAL_INDEXES = [
+    {'keys': [('col_name', ASCENDING), (tools.JOURNAL_WRITTEN_FIELD, ASCENDING)], 'options': {}},
+]
+
+# Indexes of the NZ collection
+NZ_INDEXES = [
+    {'keys': [('mms_id', ASCENDING)], 'options': {}},
+]
+
+# Indexes of the callnumber collections
+CALLNUMBER_INDEXES = [
+    {'keys': [('item_id', ASCENDING)], 'options': {}},
+    {'keys': [('callnumber', ASCENDING)], 'options': {}},
+]
+
+
+def get_index_key(keys: Dict) -> Tuple[Tuple[str, int], ...]:
+    """
+    Return the key of an index as a tuple of (field, direction) pairs.
+
+    Parameters:
+    -----------
+    keys : dict or list
+        The key of the index, as returned by `index_information` or as declared.
+
+    Returns:
+    --------
+    tuple
+        The pairs of field and direction of the index, directions are converted to int when possible.
+    """
+    items = keys.items() if isinstance(keys, dict) else keys
+    return tuple((field, int(direction) if isinstance(direction, (int, float)) else direction)
+                 for field, direction in items)
+
+
+def ensure_indexes(mongo_col: 'pymongo.collection.Collection', indexes: List[Dict], dry_run: bool = False) -> List[str]:
+    """
+    Create the missing declared indexes of a collection.
+
+    An index is missing if no existing index has the same key, options of existing
+    indexes are not compared.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The collection to index.
+    indexes : list of dict
+        The declared indexes of the collection.
+    dry_run : bool
+        Whether to only return the missing indexes without creating them.
+
+    Returns:
+    --------
+    list of str
+        The names of the missing indexes.
+    """
+    existing_keys = {get_index_key(index['key']) for index in mongo_col.index_information().values()}
+
+    missing = []
+    for index in indexes:
+        if get_index_key(index['keys']) in existing_keys:
+            continue
+        name = '_'.join(f'{field}_{direction}' for field, direction in index['keys'])
+        if dry_run is False:
+            name = mongo_col.create_index(index['keys'], **index['options'])
+        missing.append(name)
+
+    return missing
+
+
+def find_unused_indexes(mongo_col: 'pymongo.collection.Collection') -> List[str]:
+    """
+    Return the indexes of a collection that have never been used.
+
+    The usage is read with `$indexStats`, it is reset when the server restarts. The
+    `_id` index is never reported.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The collection to check.
+
+    Returns:
+    --------
+    list of str
+        The names of the unused indexes.
+    """
+    return [index['name'] for index in mongo_col.aggregate([{'$indexStats': {}}])
+            if index['name'] != '_id_' and index['accesses']['ops'] == 0]
+
+
+def find_redundant_indexes(mongo_col: 'pymongo.collection.Collection') -> List[Tuple[str, str]]:
+    """
+    Return the indexes of a collection that are a prefix of another index.
+
+    Queries using such an index can use the longer one. Unique, sparse and partial
+    indexes are not reported, their options cannot be provided by the other index.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The collection to check.
+
+    Returns:
+    --------
+    list of tuple
+        The names of the redundant indexes with the name of the index covering them.
+    """
+    index_information = mongo_col.index_information()
+    keys = {name: get_index_key(index['key']) for name, index in index_information.items()}
+
+    redundant = []
+    for name, key in keys.items():
+        index = index_information[name]
+        if name == '_id_' or index.get('unique') or index.get('sparse') or 'partialFilterExpression' in index:
+            continue
+        for other_name, other_key in keys.items():
+            if other_name != name and len(other_key) > len(key) and other_key[:len(key)] == key:
+                redundant.append((name, other_name))
+                break
+
+    return redundant
+
+
+def get_plan_stages(plan: Dict) -> Iterator[str]:
+    """
+    Return the stages of the winning plan of an explained query.
+
+    Parameters:
+    -----------
+    plan : dict
+        The result of `explain()`.
+
+    Returns:
+    --------
+    iterator of str
+        The names of the stages, from the root of the plan.
+    """
+    query_planner = plan.get('queryPlanner', plan)
+    nodes = [query_planner.get('winningPlan', {})]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        # With the slot based execution engine the plan is in 'queryPlan'
+        node = node.get('queryPlan', node)
+        if 'stage' in node:
+            yield node['stage']
+        nodes.extend(node[child] for child in ['inputStage', 'outerStage', 'innerStage'] if child in node)
+        nodes.extend(node.get('inputStages', []))
+
+
+def get_dedup_query_checks() -> List[Dict]:
+    """
+    Return the main queries of the views on a dedup collection.
+
+    Each query is a dict with a name, the filter, and optionally the sort and the
+    limit. They reproduce the `$match`, `$sort` and `$limit` stages of the pipelines
+    listing the records, which are resolved by the query layer.
+
+    Returns:
+    --------
+    list of dict
+        The queries to explain.
+    """
+    checks = [{'name': 'record by rec_id', 'filter': {'rec_id': ''}},
+              {'name': 'records by matched record', 'filter': {'matched_record': ''}},
+              {'name': 'records to refresh', 'filter': {tools.MATCH_TYPE_DIRTY_FIELD: True}},
+              {'name': 'records by score of a field', 'filter': {f'{tools.FIELD_SCORES_FIELD}.titles': {'$gt': 0.9}}}]
+
+    for record_filter, query in tools.RECORD_FILTERS.items():
+        sort = [('matched_record', ASCENDING), ('_id', ASCENDING)] if record_filter == 'duplicatematch' \
+            else [('_id', ASCENDING)]
+        checks.append({'name': f'list of records, filter "{record_filter}"',
+                       'filter': query,
+                       'sort': sort,
+                       'limit': 300})
+
+    return checks
+
+
+def get_training_data_query_checks() -> List[Dict]:
+    """Return the main queries on the training data collection, see `get_dedup_query_checks`"""
+    return [{'name': 'entry by match_id', 'filter': {'match_id': ''}}]
+
+
+def get_journal_query_checks() -> List[Dict]:
+    """Return the main queries on the decision journal, see `get_dedup_query_checks`"""
+    return [{'name': 'decisions of a collection since a date',
+             'filter': {'col_name': '',
+                        tools.JOURNAL_WRITTEN_FIELD: {'$gt': datetime(1970, 1, 1, tzinfo=timezone.utc)}},
+             'sort': [(tools.JOURNAL_WRITTEN_FIELD, ASCENDING), ('_id', ASCENDING)]}]
+
+
+def get_nz_query_checks() -> List[Dict]:
+    """Return the main queries on the NZ collection, see `get_dedup_query_checks`"""
+    return [{'name': 'record by mms_id', 'filter': {'mms_id': ''}},
+            {'name': 'records by mms_id', 'filter': {'mms_id': {'$in': ['', '']}}}]
+
+
+def get_callnumber_query_checks() -> List[Dict]:
+    """Return the main queries on a callnumber collection, see `get_dedup_query_checks`"""
+    return [{'name': 'item by item_id', 'filter': {'item_id': ''}},
+            {'name': 'items by callnumber', 'filter': {'callnumber': ''}}]
+
+
+def find_collscans(mongo_col: 'pymongo.collection.Collection', checks: List[Dict]) -> List[str]:
+    """
+    Return the queries of a collection that would do a collection scan.
+
+    The queries are explained, they are not run.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The collection to check.
+    checks : list of dict
+        The queries to explain, see `get_dedup_query_checks`.
+
+    Returns:
+    --------
+    list of str
+        The names of the queries doing a collection scan.
+    """
+    collscans = []
+    for check in checks:
+        cursor = mongo_col.find(check['filter'])
+        if 'sort' in check:
+            cursor = cursor.sort(check['sort'])
+        if 'limit' in check:
+            cursor = cursor.limit(check['limit'])
+
+        try:
+            stages = list(get_plan_stages(cursor.explain()))
+        except OperationFailure as e:
+            collscans.append(f'{check["name"]} (explain failed: {e})')
+            continue
+
+        if 'COLLSCAN' in stages:
+            collscans.append(check['name'])
+
+    return collscans
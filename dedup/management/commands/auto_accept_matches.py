@@ -0,0 +1,56 @@
+"""
+Management command to accept the possible matches of a dedup collection above a threshold.
+
+Usage:
+    python manage.py auto_accept_matches <col_name> <threshold> [--model mean] [--dry-run]
+                                         [--chunk-size 500] [--min-stored-score 0.9]
+
+A record is matched when exactly one of its candidates reaches the threshold. Accepted
+records are marked with `auto_accepted` instead of `human_validated`, the match types of
+the collection are refreshed once at the end.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import batch, scoring, tools
+from dedup.views import mongo_db_dedup, mongo_col_nz
+
+
+class Command(BaseCommand):
+    help = 'Accept the possible matches whose best candidate reaches a threshold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('col_name', help='Name of the dedup collection')
+        parser.add_argument('threshold', type=float, help='Minimum similarity score of the accepted candidate')
+        parser.add_argument('--model', default='mean',
+                            help=f'Method used to calculate the similarity score: {", ".join(scoring.SCORING_METHODS)} '
+                                 f'or a learned model "learned:<name>"')
+        parser.add_argument('--dry-run', action='store_true', help='Only report the matches that would be accepted')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of records processed at once')
+        parser.add_argument('--min-stored-score', type=float, default=None,
+                            help='Only evaluate the records with a stored max_match_score of at least this value')
+
+    def handle(self, *args, **options):
+        col_name = options['col_name']
+        if tools.is_reserved_col(col_name) or col_name not in mongo_db_dedup.list_collection_names():
+            raise CommandError(f'Collection "{col_name}" not found')
+
+        if not scoring.is_scoring_method(options['model']):
+            raise CommandError(f'Unknown model: {options["model"]}')
+
+        if not 0 < options['threshold'] <= 1:
+            raise CommandError('Threshold must be between 0 and 1')
+
+        summary = batch.auto_accept_matches(col_name, mongo_db_dedup, mongo_col_nz,
+                                            options['threshold'],
+                                            options['model'],
+                                            dry_run=options['dry_run'],
+                                            chunk_size=options['chunk_size'],
+                                            min_stored_score=options['min_stored_score'])
+
+        for sample in summary['samples']:
+            self.stdout.write(f'{sample["rec_id"]} => {sample["matched_record"]} ({sample["similarity_score"]:.3f})')
+
+        action = 'would be accepted' if options['dry_run'] else 'accepted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{summary["checked"]} records checked: {summary["accepted"]} {action}, '
+            f'{summary["ambiguous"]} ambiguous, {summary["below_threshold"]} below threshold'))
@@ -0,0 +1,43 @@
+"""
+Management command to compute the feature matrix of the training data.
+
+Usage:
+    python manage.py build_training_features <features_dir> [--type book] [--workers 4] [--chunk-size 500]
+
+The matrix has one row by entry and one column by similarity score of a field. It is
+written to '<features_dir>/training_features_<hash>.npy' with its labels and types in
+the '.npz' file of the same name, the hash identifies the training set. Only the
+entries added or replaced since the previous matrix of the directory are evaluated.
+Load it with `dedup.training.load_training_features`.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import training
+from dedup.views import mongo_db_dedup
+
+
+class Command(BaseCommand):
+    help = 'Compute the feature matrix of the training data, only new and replaced entries are evaluated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('features_dir', help='Directory of the feature matrices')
+        parser.add_argument('--type', default=None, help='Only use the entries of this type of record, e.g. book')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of entries evaluated at once')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('At least one worker is required')
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            summary = training.build_training_features(mongo_db_dedup, options['features_dir'], executor,
+                                                       entry_type=options['type'],
+                                                       chunk_size=options['chunk_size'],
+                                                       max_pending_chunks=options['workers'] * 2)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Features of {summary["entries"]} entries written to {summary["path"]}: '
+            f'{summary["computed"]} computed, {summary["reused"]} reused'))
@@ -0,0 +1,67 @@
+"""
+Management command to create and check the indexes of the dedup, NZ and callnumber collections.
+
+Usage:
+    python manage.py ensure_indexes [--dry-run] [--skip-explain]
+
+The indexes declared in `dedup.indexes` are created when missing, unused and
+redundant indexes are reported. The main queries of the views are then explained
+and the command fails if one of them would do a collection scan. It should be run
+after loading a new collection.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import OperationFailure
+
+from callnumber_to_barcode.views import mongo_db_callnumbers
+from dedup import indexes, tools
+from dedup.views import mongo_db_dedup, mongo_col_nz
+
+
+class Command(BaseCommand):
+    help = 'Create the missing indexes of the dedup, NZ and callnumber collections and check the main queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the missing indexes')
+        parser.add_argument('--skip-explain', action='store_true', help='Do not check the queries with explain()')
+
+    def handle(self, *args, **options):
+        # Collections with their declared indexes and main queries
+        targets = [(mongo_db_dedup[col_name], indexes.DEDUP_INDEXES, indexes.get_dedup_query_checks())
+                   for col_name in sorted(mongo_db_dedup.list_collection_names())
+                   if tools.is_reserved_col(col_name) is False]
+        if tools.TRAINING_DATA_COL in mongo_db_dedup.list_collection_names():
+            targets.append((mongo_db_dedup[tools.TRAINING_DATA_COL], indexes.TRAINING_DATA_INDEXES,
+                            indexes.get_training_data_query_checks()))
+        if tools.JOURNAL_COL in mongo_db_dedup.list_collection_names():
+            targets.append((mongo_db_dedup[tools.JOURNAL_COL], indexes.JOURNAL_INDEXES,
+                            indexes.get_journal_query_checks()))
+        targets.append((mongo_col_nz, indexes.NZ_INDEXES, indexes.get_nz_query_checks()))
+        targets += [(mongo_db_callnumbers[col_name], indexes.CALLNUMBER_INDEXES, indexes.get_callnumber_query_checks())
+                    for col_name in sorted(mongo_db_callnumbers.list_collection_names())]
+
+        collscans = []
+        for mongo_col, declared_indexes, checks in targets:
+            col_label = f'{mongo_col.database.name}.{mongo_col.name}'
+
+            missing = indexes.ensure_indexes(mongo_col, declared_indexes, dry_run=options['dry_run'])
+            for name in missing:
+                action = 'missing' if options['dry_run'] else 'created'
+                self.stdout.write(f'{col_label}: index {name} {action}')
+
+            for name, other_name in indexes.find_redundant_indexes(mongo_col):
+                self.stdout.write(self.style.WARNING(f'{col_label}: index {name} is a prefix of {other_name}'))
+
+            try:
+                for name in indexes.find_unused_indexes(mongo_col):
+                    self.stdout.write(self.style.WARNING(f'{col_label}: index {name} has not been used '
+                                                         f'since the server started'))
+            except OperationFailure as e:
+                self.stdout.write(self.style.WARNING(f'{col_label}: usage of the indexes not available: {e}'))
+
+            if options['skip_explain'] is False and (options['dry_run'] is False or len(missing) == 0):
+                collscans += [f'{col_label}: {name}' for name in indexes.find_collscans(mongo_col, checks)]
+
+        if len(collscans) > 0:
+            raise CommandError('Queries doing a collection scan:\n' + '\n'.join(collscans))
+
+        self.stdout.write(self.style.SUCCESS(f'Indexes of {len(targets)} collections checked'))
@@ -0,0 +1,53 @@
+"""
+Management command to compare the scoring methods on the training data.
+
+Usage:
+    python manage.py evaluate_scoring_methods [--type book] [--methods mean,random_forest_book]
+
+The stored similarity scores of the fields of the training data are used, the pairs
+are not evaluated again. For each method, the precision, recall and F1 are printed at
+the thresholds of the filters of the list of records (possible06, possible05...) and at
+the threshold with the best F1. The full curves are available with the API
+`/dedup/training/evaluation`.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import scoring, training
+from dedup.views import mongo_db_dedup
+
+
+class Command(BaseCommand):
+    help = 'Compare the precision, recall and F1 of the scoring methods on the training data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', default=None, help='Only use the entries of this type of record, e.g. book')
+        parser.add_argument('--methods', default=None,
+                            help='Comma separated methods, all the methods and learned models by default')
+
+    def handle(self, *args, **options):
+        methods = options['methods'].split(',') if options['methods'] is not None else None
+        if methods is not None:
+            for method in methods:
+                if not scoring.is_scoring_method(method):
+                    raise CommandError(f'Unknown model: {method}')
+
+        evaluation = training.get_evaluation(mongo_db_dedup, entry_type=options['type'], methods=methods)
+        if evaluation['nb_pairs'] == 0:
+            raise CommandError('No training data with stored scores of the fields')
+
+        self.stdout.write(f'{evaluation["nb_pairs"]} pairs, {evaluation["nb_matches"]} matches, '
+                          f'{evaluation["nb_without_scores"]} entries without stored scores skipped')
+
+        for method_evaluation in evaluation['methods']:
+            self.stdout.write(f'\n{method_evaluation["method"]}')
+            thresholds = [(record_filter, threshold) for record_filter, threshold
+                          in sorted(evaluation['filter_thresholds'].items(), key=lambda item: -item[1])]
+            thresholds.append(('best F1', method_evaluation['best_threshold']))
+            for label, threshold in thresholds:
+                i = method_evaluation['thresholds'].index(threshold)
+                self.stdout.write(f'  {label:<12} > {threshold:.2f}: precision {method_evaluation["precision"][i]:.3f}, '
+                                  f'recall {method_evaluation["recall"][i]:.3f}, f1 {method_evaluation["f1"][i]:.3f} '
+                                  f'(tp {method_evaluation["tp"][i]}, fp {method_evaluation["fp"][i]}, '
+                                  f'fn {method_evaluation["fn"][i]}, tn {method_evaluation["tn"][i]})')
+
+        self.stdout.write(self.style.SUCCESS(f'{len(evaluation["methods"])} methods evaluated'))
@@ -0,0 +1,64 @@
+"""
+Management command to export the decisions taken on a dedup collection since a watermark.
+
+Usage:
+    python manage.py export_decisions <col_name> <output_path> [--since 2024-01-31T22:00:00+00:00]
+                                      [--format csv|jsonl]
+
+The entries of the decision journal are exported in the order they are written, the last
+entry of a record is its current decision. The watermark printed at the end must be used
+as `--since` of the next export to get only the new decisions. It is `DEDUP_JOURNAL_SAFETY_LAG`
+seconds in the past, the decisions written since are exported by the next export.
+"""
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import tools
+from dedup.views import mongo_db_dedup
+
+
+class Command(BaseCommand):
+    help = 'Export the decisions taken on a dedup collection since a watermark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('col_name', help='Name of the dedup collection')
+        parser.add_argument('output_path', help='Path of the file to write')
+        parser.add_argument('--since', default=None,
+                            help='ISO 8601 date, only the decisions written after it are exported. '
+                                 'Dates without time zone are in UTC')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help='Format of the export')
+
+    def handle(self, *args, **options):
+        col_name = options['col_name']
+        if tools.is_reserved_col(col_name) or col_name not in mongo_db_dedup.list_collection_names():
+            raise CommandError(f'Collection "{col_name}" not found')
+
+        since = options['since']
+        if since is not None:
+            try:
+                since = datetime.fromisoformat(since)
+            except ValueError:
+                raise CommandError(f'Invalid date "{since}"')
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+
+        # Decisions written after the watermark are exported by the next export
+        until = tools.get_journal_watermark()
+
+        # Count the entries while they are written
+        nb_entries = 0
+
+        def counted(entries):
+            nonlocal nb_entries
+            for entry in entries:
+                nb_entries += 1
+                yield entry
+
+        entries = counted(tools.iter_journal_entries(col_name, mongo_db_dedup, since=since, until=until))
+        with open(options['output_path'], 'w', encoding='utf-8', newline='') as output:
+            for chunk in tools.iter_journal_export(entries, options['format']):
+                output.write(chunk)
+
+        self.stdout.write(f'Watermark of the next export: {until.isoformat()}')
+        self.stdout.write(self.style.SUCCESS(f'{nb_entries} decisions exported to {options["output_path"]}'))
@@ -0,0 +1,49 @@
+"""
+Management command to export the records of a dedup collection in MarcXML.
+
+Usage:
+    python manage.py export_marcxml <col_name> <output_path> [--records local|nz] [--gzip]
+
+The collection is read with a cursor and the records are written one by one, so
+memory usage does not depend on the size of the collection.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import tools
+from dedup.views import mongo_db_dedup, mongo_col_nz
+
+
+class Command(BaseCommand):
+    help = 'Export the records of a dedup collection or its matched NZ records in MarcXML'
+
+    def add_arguments(self, parser):
+        parser.add_argument('col_name', help='Name of the dedup collection')
+        parser.add_argument('output_path', help='Path of the MarcXML file to write')
+        parser.add_argument('--records', choices=['local', 'nz'], default='local',
+                            help="'local' for the full records of the collection, 'nz' for the matched NZ records")
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+
+    def handle(self, *args, **options):
+        col_name = options['col_name']
+        if tools.is_reserved_col(col_name) or col_name not in mongo_db_dedup.list_collection_names():
+            raise CommandError(f'Collection "{col_name}" not found')
+
+        if options['records'] == 'local':
+            recs = tools.iter_local_fullrecs(mongo_db_dedup[col_name])
+        else:
+            recs = tools.iter_matched_nz_recs(mongo_db_dedup[col_name], mongo_col_nz)
+
+        # Count the records while they are written
+        nb_recs = 0
+
+        def counted(recs_to_count):
+            nonlocal nb_recs
+            for rec in recs_to_count:
+                nb_recs += 1
+                yield rec
+
+        with open(options['output_path'], 'wb') as output:
+            for chunk in tools.iter_marcxml(counted(recs), compress=options['gzip']):
+                output.write(chunk)
+
+        self.stdout.write(self.style.SUCCESS(f'{nb_recs} records exported to {options["output_path"]}'))
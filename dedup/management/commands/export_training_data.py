@@ -0,0 +1,47 @@
+"""
+Management command to export the training data in JSON Lines or Parquet.
+
+Usage:
+    python manage.py export_training_data <output_path> [--format jsonl|parquet] [--type book]
+
+The collection is read with a cursor, so memory usage does not depend on the size
+of the training data. The Parquet export requires pyarrow.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import tools, training
+from dedup.views import mongo_db_dedup
+
+
+class Command(BaseCommand):
+    help = 'Export the training data in JSON Lines or Parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_path', help='Path of the file to write')
+        parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl', help='Format of the export')
+        parser.add_argument('--type', default=None, help='Only export the entries of this type of record, e.g. book')
+
+    def handle(self, *args, **options):
+        entries = training.iter_training_data(mongo_db_dedup, entry_type=options['type'])
+
+        if options['format'] == 'parquet':
+            with open(options['output_path'], 'wb') as output:
+                try:
+                    nb_entries = training.write_training_parquet(entries, output)
+                except ImportError:
+                    raise CommandError('Parquet export requires pyarrow')
+        else:
+            # Count the entries while they are written
+            nb_entries = 0
+
+            def counted(entries_to_count):
+                nonlocal nb_entries
+                for entry in entries_to_count:
+                    nb_entries += 1
+                    yield entry
+
+            with open(options['output_path'], 'w', encoding='utf-8') as output:
+                for chunk in tools.iter_jsonl(counted(entries)):
+                    output.write(chunk)
+
+        self.stdout.write(self.style.SUCCESS(f'{nb_entries} entries exported to {options["output_path"]}'))
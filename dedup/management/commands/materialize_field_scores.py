@@ -0,0 +1,35 @@
+"""
+Management command to store the similarity scores of the fields of the best candidate of each record.
+
+Usage:
+    python manage.py materialize_field_scores <col_name> [--only-missing] [--chunk-size 500]
+
+The stored scores are used to filter the list of records, for example "titles>0.9,creators<0.3".
+They are also stored when records are displayed with the method of `DEDUP_FIELD_SCORES_METHOD`,
+this command fills them for a whole collection.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import batch, tools
+from dedup.views import mongo_db_dedup, mongo_col_nz
+
+
+class Command(BaseCommand):
+    help = 'Store the similarity scores of the fields of the best candidate of each record of a collection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('col_name', help='Name of the dedup collection')
+        parser.add_argument('--only-missing', action='store_true',
+                            help='Only process the records without stored scores of the fields')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of records processed at once')
+
+    def handle(self, *args, **options):
+        col_name = options['col_name']
+        if tools.is_reserved_col(col_name) or col_name not in mongo_db_dedup.list_collection_names():
+            raise CommandError(f'Collection "{col_name}" not found')
+
+        nb_recs = batch.materialize_field_scores(col_name, mongo_db_dedup, mongo_col_nz,
+                                                 only_missing=options['only_missing'],
+                                                 chunk_size=options['chunk_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'Scores of the fields of {nb_recs} records stored'))
@@ -0,0 +1,33 @@
+"""
+Management command to refresh the match types of a dedup collection.
+
+Usage:
+    python manage.py refresh_match_types <col_name> [--full]
+
+By default, only the records marked as dirty are refreshed. It should be run after
+loading or updating records outside the app. Use `--full` if records have been loaded
+or their matched records changed without marking them.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import tools
+from dedup.views import mongo_db_dedup
+
+
+class Command(BaseCommand):
+    help = 'Refresh the match types of the records of a dedup collection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('col_name', help='Name of the dedup collection')
+        parser.add_argument('--full', action='store_true', help='Refresh all the records of the collection')
+
+    def handle(self, *args, **options):
+        col_name = options['col_name']
+        if tools.is_reserved_col(col_name) or col_name not in mongo_db_dedup.list_collection_names():
+            raise CommandError(f'Collection "{col_name}" not found')
+
+        # Like the refreshes started by the app, the command takes the lease of the collection
+        if tools.run_match_type_refresh(col_name, mongo_db_dedup, full=options['full']) is False:
+            raise CommandError(f'A refresh of "{col_name}" is already running')
+
+        self.stdout.write(self.style.SUCCESS(f'Match types of "{col_name}" refreshed'))
@@ -0,0 +1,57 @@
+"""
+Management command to recompute the similarity scores of the records of a dedup collection.
+
+Usage:
+    python manage.py rescore_collection <col_name> [--model mean] [--workers 4]
+                                        [--chunk-size 500] [--restart]
+
+The candidates of the records are evaluated by a pool of processes and 'max_match_score'
+is updated. The progress is saved after each chunk: an interrupted run is resumed with the
+same command, `--restart` processes the whole collection again.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import batch, scoring, tools
+from dedup.views import mongo_db_dedup, mongo_col_nz
+
+
+class Command(BaseCommand):
+    help = 'Recompute the similarity scores of the records of a collection with a pool of processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('col_name', help='Name of the dedup collection')
+        parser.add_argument('--model', default='mean',
+                            help=f'Method used to calculate the similarity score: {", ".join(scoring.SCORING_METHODS)} '
+                                 f'or a learned model "learned:<name>"')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of records processed at once')
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved progress of a previous run')
+
+    def handle(self, *args, **options):
+        col_name = options['col_name']
+        if tools.is_reserved_col(col_name) or col_name not in mongo_db_dedup.list_collection_names():
+            raise CommandError(f'Collection "{col_name}" not found')
+
+        if not scoring.is_scoring_method(options['model']):
+            raise CommandError(f'Unknown model: {options["model"]}')
+
+        if options['workers'] < 1:
+            raise CommandError('At least one worker is required')
+
+        def progress(nb_done: int, nb_total: int, elapsed: float) -> None:
+            rate = nb_done / elapsed if elapsed > 0 else 0
+            eta = (nb_total - nb_done) / rate if rate > 0 else 0
+            self.stdout.write(f'{nb_done}/{nb_total} records, {rate:.1f} records/s, ETA {eta / 60:.1f} min')
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            nb_recs = batch.rescore_collection(col_name, mongo_db_dedup, mongo_col_nz, executor,
+                                               method=options['model'],
+                                               chunk_size=options['chunk_size'],
+                                               max_pending_chunks=options['workers'] * 2,
+                                               restart=options['restart'],
+                                               progress=progress)
+
+        self.stdout.write(self.style.SUCCESS(f'Scores of {nb_recs} records recomputed'))
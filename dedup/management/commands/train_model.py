@@ -0,0 +1,50 @@
+"""
+Management command to train a similarity model on the training data.
+
+Usage:
+    python manage.py train_model <features_dir> [--algorithm logistic_regression|gradient_boosting]
+                                 [--type book] [--workers 4]
+
+The feature matrix of the training data is updated first, see `build_training_features`.
+The model is saved in `DEDUP_MODELS_DIR` with a versioned name and can be selected as
+'learned:<name>' in the app and in the commands accepting a model.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dedup import training
+from dedup.views import mongo_db_dedup
+
+
+class Command(BaseCommand):
+    help = 'Train a model predicting the probability of a match on the training data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('features_dir', help='Directory of the feature matrices')
+        parser.add_argument('--algorithm', choices=training.MODEL_ALGORITHMS, default='logistic_regression',
+                            help='Algorithm of the model')
+        parser.add_argument('--type', default=None, help='Only use the entries of this type of record, e.g. book')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes computing the missing features')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('At least one worker is required')
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            summary = training.build_training_features(mongo_db_dedup, options['features_dir'], executor,
+                                                       max_pending_chunks=options['workers'] * 2)
+        self.stdout.write(f'Features of {summary["entries"]} entries: {summary["computed"]} computed, '
+                          f'{summary["reused"]} reused')
+
+        features, meta = training.load_training_features(options['features_dir'], summary['hash'])
+        try:
+            bundle = training.train_model(features, meta, options['algorithm'], entry_type=options['type'])
+            method = training.save_model(bundle, settings.DEDUP_MODELS_DIR)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(f'Model {method} trained on {bundle["metadata"]["nb_samples"]} pairs'))
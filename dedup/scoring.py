@@ -0,0 +1,822 @@
+"""
+This module provides the evaluation of the similarity between a local record and its possible matches.
+
+Scoring of the candidates of a record is CPU bound and can be distributed to a pool of workers. The pool
+is configured with the settings `DEDUP_SCORING_EXECUTOR` ('thread' or 'process') and
+`DEDUP_SCORING_WORKERS`. With 0 workers, the candidates are evaluated sequentially. The evaluation
+of dedupmarcxml is pure Python and holds the GIL, so only a pool of processes evaluates the pairs in
+parallel. The web app uses a pool of threads by default, `batch.rescore_collection` and
+`training.build_training_features` are given their own pools of processes. The pairs are sent to the workers by chunks, one chunk by worker.
+
+The similarity scores of each field do not depend on the method used to calculate the global
+similarity score. They are stored in the dedup documents, in the `similarity_scores` field, for
+each possible match. The stored scores are only reused if the brief records of both records and
+the version of `dedupmarcxml` are unchanged.
+
+The similarity scores of each field of the best candidate, according to the method of the setting
+`DEDUP_FIELD_SCORES_METHOD`, are stored in the `field_scores` field of the dedup documents. They
+are indexed and used to filter the list of records.
+
+Parsed NZ brief records are kept in an in-process LRU cache shared by all requests, see
+`BriefRecCache`. Its size and the lifetime of its entries are configured with the settings
+`DEDUP_BRIEFREC_CACHE_SIZE` and `DEDUP_BRIEFREC_CACHE_TTL`.
+
+Models trained on the training data, see `training.train_model`, are stored in the directory of the
+setting `DEDUP_MODELS_DIR`. They are used as the methods 'learned:<name>': the similarity scores of
+the fields of all the pairs are evaluated first, then the model predicts the global similarity
+scores with one call. A model is loaded once by process.
+
+Classes:
+- CachedBriefRec: Parsed brief record with its displayable version and fingerprint.
+- BriefRecCache: Bounded and thread-safe LRU cache of parsed NZ brief records.
+
+Functions:
+- get_executor: Returns the pool of workers used to evaluate the candidates.
+- is_learned_method: Checks if a method is a learned model.
+- read_learned_model_metadata: Returns the metadata of a learned model.
+- get_learned_models: Returns the metadata of the available learned models.
+- is_scoring_method: Checks if a method can be used to calculate the similarity score.
+- load_learned_model: Returns a learned model, it is loaded once by process.
+- predict_similarity_scores: Calculates the global similarity scores of several pairs with a learned model.
+- get_similarity_scores: Calculates the global similarity scores of a matrix of similarity scores of fields.
+- score_pair: Evaluates the similarity of two brief records.
+- aggregate_scores: Calculates the global similarity score of evaluated similarity scores.
+- run_score_tasks: Runs a chunk of evaluations of pairs in a worker.
+- score_pairs: Evaluates the similarity of pairs of brief records.
+- score_candidates: Evaluates the similarity of a brief record with all its candidates.
+- get_briefrec_key: Returns a fingerprint of a brief record.
+- get_cached_scores: Returns the stored similarity scores of the candidates of a record.
+- get_scores_cache_update: Returns the update to store the similarity scores of the candidates.
+- get_nz_briefrecs: Returns the parsed brief records of NZ records, fetching only the ones missing in the cache.
+- evaluate_local_recs: Evaluates the similarity of several local records with all their candidates.
+- get_field_scores_update: Returns the update storing the similarity scores of the fields of the best candidate.
+"""
+
+import hashlib
+import glob
+import json
+import os
+import re
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import joblib
+import numpy as np
+from django.conf import settings
+from dedupmarcxml.briefrecord import RawBriefRec, JsonBriefRec, XmlBriefRec
+from dedupmarcxml.evaluate import evaluate_records_similarity, get_similarity_score
+from dedupmarcxml import __version__ as dedupmarcxml_version
+from dedupmarcxml import tools as dedupmarcxml_tools
+
+# Local imports
+from . import tools
+
+BriefRec = Union[RawBriefRec, JsonBriefRec, XmlBriefRec]
+
+# Field of the dedup documents where the similarity scores of the possible matches are stored
+SCORES_CACHE_FIELD = 'similarity_scores'
+
+# Methods available to calculate the global similarity score, see `dedupmarcxml.evaluate.get_similarity_score`
+SCORING_METHODS = ['mean', 'random_forest_general', 'random_forest_book', 'random_forest_music', 'mlp_book']
+
+# Classifiers of dedupmarcxml used by the methods of `SCORING_METHODS`, see `get_similarity_scores`
+DEDUPMARCXML_MODELS = {'random_forest_general': 'rf_general_model',
+                       'random_forest_book': 'rf_book_model',
+                       'random_forest_music': 'rf_music_model',
+                       'mlp_book': 'mlp_book_model'}
+
+# Prefix of the methods using a learned model of `DEDUP_MODELS_DIR`, followed by the name of the model
+LEARNED_MODEL_PREFIX = 'learned:'
+
+# Names of the learned models, they are also the names of their files
+LEARNED_MODEL_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# Version of the computation of the features of the training data, see `training.compute_features_chunk`.
+# Version 2 builds the features like the app, learned models of other versions are not used.
+FEATURES_VERSION = 2
+
+# Learned models loaded by this process, a name is never reused for another model
+_learned_models = dict()
+_learned_models_lock = threading.Lock()
+
+# The pool is created at the first use and shared by all requests of the process
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> Optional[Executor]:
+    """
+    Return the pool of workers used to evaluate the candidates.
+
+    The pool is created lazily according to the settings and shared by all
+    the requests handled by the process.
+
+    Returns:
+    --------
+    Executor or None
+        The pool of workers or None if the candidates must be evaluated sequentially.
+    """
+    global _executor
+
+    if settings.DEDUP_SCORING_WORKERS < 1:
+        return None
+
+    with _executor_lock:
+        if _executor is None:
+            if settings.DEDUP_SCORING_EXECUTOR == 'process':
+                _executor = ProcessPoolExecutor(max_workers=settings.DEDUP_SCORING_WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=settings.DEDUP_SCORING_WORKERS,
+                                               thread_name_prefix='dedup_scoring')
+    return _executor
+
+
+def is_learned_method(method: str) -> bool:
+    """Check if a method is a learned model"""
+    return method.startswith(LEARNED_MODEL_PREFIX)
+
+
+def read_learned_model_metadata(name: str) -> Optional[Dict]:
+    """
+    Return the metadata of a learned model.
+
+    The metadata is read from the '.json' file stored with the model, see
+    `training.save_model`. Models saved without 'features_version' were trained
+    on the features of version 1.
+
+    Parameters:
+    -----------
+    name : str
+        The name of the model, without `LEARNED_MODEL_PREFIX`.
+
+    Returns:
+    --------
+    dict or None
+        The metadata of the model or None if the model or its metadata does not exist.
+    """
+    path = os.path.join(settings.DEDUP_MODELS_DIR, name)
+    if not os.path.exists(f'{path}.joblib') or not os.path.exists(f'{path}.json'):
+        return None
+
+    with open(f'{path}.json', encoding='utf-8') as f:
+        metadata = json.load(f)
+    return {**metadata, 'features_version': int(metadata.get('features_version', 1))}
+
+
+def get_learned_models() -> List[Dict]:
+    """
+    Return the metadata of the available learned models.
+
+    Models trained on features of another version than `FEATURES_VERSION` are
+    not returned, they must be trained again.
+
+    Returns:
+    --------
+    list of dict
+        The metadata of the models, with the method in 'name', the most recent first.
+    """
+    models = []
+    for path in glob.glob(os.path.join(settings.DEDUP_MODELS_DIR, '*.json')):
+        name = os.path.basename(path)[:-len('.json')]
+        metadata = read_learned_model_metadata(name)
+        if metadata is None or metadata['features_version'] != FEATURES_VERSION:
+            continue
+        models.append({**metadata, 'name': f'{LEARNED_MODEL_PREFIX}{name}'})
+
+    return sorted(models, key=lambda model: model.get('created', ''), reverse=True)
+
+
+def is_scoring_method(method: str) -> bool:
+    """
+    Check if a method can be used to calculate the similarity score.
+
+    Parameters:
+    -----------
+    method : str
+        A method of `SCORING_METHODS` or a learned model.
+
+    Returns:
+    --------
+    bool
+        True if the method is known or if the learned model exists and was trained
+        on features of `FEATURES_VERSION`.
+    """
+    if is_learned_method(method) is False:
+        return method in SCORING_METHODS
+
+    name = method[len(LEARNED_MODEL_PREFIX):]
+    if LEARNED_MODEL_NAME_RE.match(name) is None:
+        return False
+    metadata = read_learned_model_metadata(name)
+    return metadata is not None and metadata['features_version'] == FEATURES_VERSION
+
+
+def load_learned_model(method: str) -> Dict:
+    """
+    Return a learned model, it is loaded once by process.
+
+    Parameters:
+    -----------
+    method : str
+        The learned model, 'learned:<name>'.
+
+    Returns:
+    --------
+    dict
+        The bundle saved by `training.save_model`, with the estimator in 'model' and the
+        fields of its features in 'columns'.
+
+    Raises:
+    -------
+    ValueError
+        If the model does not exist or was trained on features of another version.
+    """
+    with _learned_models_lock:
+        if method not in _learned_models:
+            name = method[len(LEARNED_MODEL_PREFIX):]
+            metadata = read_learned_model_metadata(name) \
+                if is_learned_method(method) and LEARNED_MODEL_NAME_RE.match(name) else None
+            if metadata is None:
+                raise ValueError(f'Unknown model: {method}')
+            if metadata['features_version'] != FEATURES_VERSION:
+                raise ValueError(f'Model {method} was trained on features of version '
+                                 f'{metadata["features_version"]} instead of {FEATURES_VERSION}, '
+                                 f'it must be trained again')
+            _learned_models[method] = joblib.load(os.path.join(settings.DEDUP_MODELS_DIR, f'{name}.joblib'))
+
+    return _learned_models[method]
+
+
+def predict_similarity_scores(scores_list: List[Dict[str, float]], method: str) -> np.ndarray:
+    """
+    Calculate the global similarity scores of several pairs with a learned model.
+
+    The similarity scores of the fields are stacked in one matrix and the probabilities
+    of a match are predicted with one call. Missing scores are replaced by 0.
+
+    Parameters:
+    -----------
+    scores_list : list of dict
+        The similarity scores of the fields of each pair.
+    method : str
+        The learned model, 'learned:<name>'.
+
+    Returns:
+    --------
+    np.ndarray
+        The probability of a match of each pair.
+    """
+    if len(scores_list) == 0:
+        return np.zeros(0)
+
+    features = np.array([[scores.get(field, np.nan) for field in tools.SCORE_FIELDS] for scores in scores_list],
+                        dtype=np.float64)
+
+    return get_similarity_scores(features, tools.SCORE_FIELDS, method)
+
+
+def get_similarity_scores(features: np.ndarray, columns: List[str], method: str = 'mean') -> np.ndarray:
+    """
+    Calculate the global similarity scores of a matrix of similarity scores of fields.
+
+    All the rows are processed at once: the mean is vectorized and the classifiers
+    predict all the rows with one call. The results are the same as the ones of
+    `dedupmarcxml.evaluate.get_similarity_score` applied to each row.
+
+    Parameters:
+    -----------
+    features : np.ndarray
+        One row by pair and one column by field, NaN for the missing scores.
+    columns : list of str
+        The fields of the columns.
+    method : str
+        A method of `SCORING_METHODS` or a learned model.
+
+    Returns:
+    --------
+    np.ndarray
+        The global similarity score of each row.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    if len(features) == 0:
+        return np.zeros(0)
+
+    if is_learned_method(method):
+        bundle = load_learned_model(method)
+        model_features = np.nan_to_num(features[:, [columns.index(field) for field in bundle['columns']]], nan=0.0)
+        return bundle['model'].predict_proba(model_features)[:, 1]
+
+    if method in DEDUPMARCXML_MODELS:
+        model = getattr(dedupmarcxml_tools, DEDUPMARCXML_MODELS[method])
+        try:
+            model_features = features[:, [columns.index(field) for field in model.feature_names_in_]]
+        except ValueError:
+            # dedupmarcxml returns 0 when the scores do not fit the classifier
+            return np.zeros(len(features))
+
+        # The classifiers were fitted with the names of the fields, the columns are in the same order
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            return model.predict_proba(model_features)[:, 1]
+
+    # Mean of the scores, missing values (0.0 and 0.1) are excluded
+    valid = features >= 0.2
+    nb_valid = valid.sum(axis=1)
+    total = np.where(valid, features, 0.0).sum(axis=1)
+    return np.divide(total, nb_valid, out=np.zeros(len(features)), where=nb_valid > 0)
+
+
+def score_pair(briefrec: BriefRec, nz_briefrec: BriefRec, method: str = 'mean') -> Tuple[Dict[str, float], float]:
+    """
+    Evaluate the similarity of two brief records.
+
+    Parameters:
+    -----------
+    briefrec : Union[RawBriefRec, JsonBriefRec, XmlBriefRec]
+        The local brief record.
+    nz_briefrec : Union[RawBriefRec, JsonBriefRec, XmlBriefRec]
+        The brief record of the possible match.
+    method : str
+        The method used to calculate the global similarity score.
+
+    Returns:
+    --------
+    tuple
+        The similarity scores of each field and the global similarity score.
+    """
+    scores = evaluate_records_similarity(briefrec, nz_briefrec)
+    return scores, get_similarity_score(scores, method=method)
+
+
+def aggregate_scores(scores: Dict[str, float], method: str = 'mean') -> Tuple[Dict[str, float], float]:
+    """
+    Calculate the global similarity score of already evaluated similarity scores.
+
+    Parameters:
+    -----------
+    scores : dict
+        The similarity scores of each field.
+    method : str
+        The method used to calculate the global similarity score.
+
+    Returns:
+    --------
+    tuple
+        The similarity scores of each field and the global similarity score.
+    """
+    return scores, get_similarity_score(scores, method=method)
+
+
+def run_score_tasks(tasks: List[Tuple[Callable, Tuple]]) -> List[Tuple[Dict[str, float], float]]:
+    """Run a chunk of tasks of `score_pairs` in a worker and return their results in order"""
+    return [task(*args) for task, args in tasks]
+
+
+def score_pairs(pairs: List[Tuple[BriefRec, BriefRec]],
+                method: str = 'mean',
+                known_scores: Optional[List[Optional[Dict[str, float]]]] = None,
+                sequential: bool = False) -> List[Tuple[Dict[str, float], float]]:
+    """
+    Evaluate the similarity of pairs of brief records.
+
+    The pairs are evaluated at once by the pool of workers, split in one
+    chunk by worker, the results are returned in the order of the pairs. Pairs with known similarity
+    scores are not evaluated again, only the global similarity score is
+    calculated.
+
+    Parameters:
+    -----------
+    pairs : list of tuple
+        Pairs of local brief record and brief record of a possible match.
+    method : str
+        The method used to calculate the global similarity score.
+    known_scores : list, optional
+        Already evaluated similarity scores of each pair, None if unknown.
+    sequential : bool
+        Whether to evaluate the pairs in the current thread, for example when it is
+        already a worker of a pool.
+
+    Returns:
+    --------
+    list of tuple
+        For each pair, the similarity scores of each field and the global similarity score.
+    """
+    # With a learned model, the global similarity scores of all the pairs are predicted at once
+    if is_learned_method(method):
+        results = score_pairs(pairs, method='mean', known_scores=known_scores, sequential=sequential)
+        similarity_scores = predict_similarity_scores([scores for scores, _ in results], method)
+        return [(scores, float(similarity_score)) for (scores, _), similarity_score in zip(results, similarity_scores)]
+
+    if known_scores is None:
+        known_scores = [None] * len(pairs)
+
+    tasks = [(score_pair, (briefrec, nz_briefrec, method)) if scores is None else (aggregate_scores, (scores, method))
+             for (briefrec, nz_briefrec), scores in zip(pairs, known_scores)]
+
+    executor = get_executor() if sequential is False else None
+
+    # No need of the pool for a single pair
+    if executor is None or len(tasks) < 2:
+        return run_score_tasks(tasks)
+
+    # One chunk of pairs by worker, the pairs are sent to the processes with few messages
+    chunk_size = -(-len(tasks) // settings.DEDUP_SCORING_WORKERS)
+    futures = [executor.submit(run_score_tasks, tasks[i:i + chunk_size]) for i in range(0, len(tasks), chunk_size)]
+    return [result for future in futures for result in future.result()]
+
+
+def score_candidates(briefrec: BriefRec,
+                     nz_briefrecs: List[BriefRec],
+                     method: str = 'mean',
+                     known_scores: Optional[List[Optional[Dict[str, float]]]] = None
+                     ) -> List[Tuple[Dict[str, float], float]]:
+    """
+    Evaluate the similarity of a brief record with all its candidates.
+
+    See `score_pairs`, the results are returned in the order of the candidates.
+
+    Parameters:
+    -----------
+    briefrec : Union[RawBriefRec, JsonBriefRec, XmlBriefRec]
+        The local brief record.
+    nz_briefrecs : list
+        The brief records of the possible matches.
+    method : str
+        The method used to calculate the global similarity score.
+    known_scores : list, optional
+        Already evaluated similarity scores of each candidate, None if unknown.
+
+    Returns:
+    --------
+    list of tuple
+        For each candidate, the similarity scores of each field and the global similarity score.
+    """
+    return score_pairs([(briefrec, nz_briefrec) for nz_briefrec in nz_briefrecs], method, known_scores)
+
+
+def get_briefrec_key(briefrec: BriefRec) -> str:
+    """
+    Return a fingerprint of a brief record.
+
+    The fingerprint changes when the data of the brief record changes.
+
+    Parameters:
+    -----------
+    briefrec : Union[RawBriefRec, JsonBriefRec, XmlBriefRec]
+        The brief record.
+
+    Returns:
+    --------
+    str
+        The fingerprint of the brief record.
+    """
+    return hashlib.md5(json.dumps(briefrec.data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _get_pair_key(briefrec_key: str, nz_briefrec_key: str) -> str:
+    """Return the key of stored similarity scores, it includes the version of dedupmarcxml"""
+    return f'{dedupmarcxml_version}:{briefrec_key}:{nz_briefrec_key}'
+
+
+def get_cached_scores(rec: Dict,
+                      briefrec_key: str,
+                      mms_ids: List[str],
+                      nz_briefrec_keys: List[str]) -> List[Optional[Dict[str, float]]]:
+    """
+    Return the stored similarity scores of the candidates of a record.
+
+    Parameters:
+    -----------
+    rec : dict
+        The dedup document of the local record.
+    briefrec_key : str
+        The fingerprint of the local brief record.
+    mms_ids : list of str
+        MMS IDs of the candidates.
+    nz_briefrec_keys : list of str
+        Fingerprints of the brief records of the candidates.
+
+    Returns:
+    --------
+    list
+        For each candidate, the stored similarity scores or None if they are missing or outdated.
+    """
+    cache = rec.get(SCORES_CACHE_FIELD) or {}
+    known_scores = []
+    for mms_id, nz_briefrec_key in zip(mms_ids, nz_briefrec_keys):
+        entry = cache.get(mms_id)
+        if entry is not None and entry.get('key') == _get_pair_key(briefrec_key, nz_briefrec_key):
+            known_scores.append(entry['scores'])
+        else:
+            known_scores.append(None)
+    return known_scores
+
+
+def get_scores_cache_update(briefrec_key: str,
+                            mms_ids: List[str],
+                            nz_briefrec_keys: List[str],
+                            known_scores: List[Optional[Dict[str, float]]],
+                            results: List[Tuple[Dict[str, float], float]]) -> Dict:
+    """
+    Return the update to store the newly evaluated similarity scores of the candidates.
+
+    Parameters:
+    -----------
+    briefrec_key : str
+        The fingerprint of the local brief record.
+    mms_ids : list of str
+        MMS IDs of the candidates.
+    nz_briefrec_keys : list of str
+        Fingerprints of the brief records of the candidates.
+    known_scores : list
+        Stored similarity scores returned by `get_cached_scores`.
+    results : list of tuple
+        The results of `score_candidates`.
+
+    Returns:
+    --------
+    dict
+        The content of a '$set' update, empty if nothing needs to be stored.
+    """
+    update = dict()
+    for mms_id, nz_briefrec_key, scores, (new_scores, _) in zip(mms_ids, nz_briefrec_keys, known_scores, results):
+
+        # MongoDB field names can't contain dots or start with a dollar
+        if scores is not None or '.' in mms_id or mms_id.startswith('$'):
+            continue
+
+        update[f'{SCORES_CACHE_FIELD}.{mms_id}'] = {'key': _get_pair_key(briefrec_key, nz_briefrec_key),
+                                                    'scores': new_scores}
+    return update
+
+
+class CachedBriefRec:
+    """
+    Parsed brief record with its displayable version and fingerprint.
+
+    Attributes:
+    -----------
+    briefrec : JsonBriefRec
+        The parsed brief record.
+    display : dict
+        The brief record transformed by `tools.display_briefrec`. It is shared
+        between requests and must not be modified.
+    key : str
+        The fingerprint of the brief record, see `get_briefrec_key`.
+    """
+    __slots__ = ('briefrec', 'display', 'key')
+
+    def __init__(self, briefrec: JsonBriefRec) -> None:
+        self.briefrec = briefrec
+        self.display = tools.display_briefrec(briefrec)
+        self.key = get_briefrec_key(briefrec)
+
+
+class BriefRecCache:
+    """
+    Bounded and thread-safe LRU cache of parsed NZ brief records.
+
+    The same NZ records are candidates of many local records. The cache avoids
+    parsing their MARC data at each request. Entries are keyed by MMS ID and
+    expire after `ttl` seconds, so changes of the NZ records are taken into
+    account after this delay.
+
+    Attributes:
+    -----------
+    maxsize : int
+        Maximum number of entries, with 0 the cache is disabled.
+    ttl : float
+        Lifetime of the entries in seconds.
+    hits : int
+        Number of lookups served by the cache.
+    misses : int
+        Number of lookups requiring to parse the record.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, mms_id: str) -> Optional[CachedBriefRec]:
+        """
+        Return the cached brief record of an MMS ID.
+
+        Parameters:
+        -----------
+        mms_id : str
+            MMS ID of the NZ record.
+
+        Returns:
+        --------
+        CachedBriefRec or None
+            The cached brief record or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(mms_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(mms_id)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[mms_id]
+            self.misses += 1
+            return None
+
+    def add(self, nz_rec: Dict) -> CachedBriefRec:
+        """
+        Parse a NZ record and store its brief record in the cache.
+
+        Parameters:
+        -----------
+        nz_rec : dict
+            The NZ record, it must contain the 'mms_id' and 'marc' fields.
+
+        Returns:
+        --------
+        CachedBriefRec
+            The parsed brief record.
+        """
+        # Parsing is done outside the lock, concurrent requests are not blocked
+        cached_briefrec = CachedBriefRec(JsonBriefRec(nz_rec))
+
+        if self.maxsize < 1:
+            return cached_briefrec
+
+        with self._lock:
+            self._entries[nz_rec['mms_id']] = (time.monotonic() + self.ttl, cached_briefrec)
+            self._entries.move_to_end(nz_rec['mms_id'])
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return cached_briefrec
+
+    def get_or_add(self, nz_rec: Dict) -> CachedBriefRec:
+        """
+        Return the cached brief record of a NZ record, parse it if missing.
+
+        Parameters:
+        -----------
+        nz_rec : dict
+            The NZ record, it must contain the 'mms_id' and 'marc' fields.
+
+        Returns:
+        --------
+        CachedBriefRec
+            The parsed brief record.
+        """
+        cached_briefrec = self.get(nz_rec['mms_id'])
+        return cached_briefrec if cached_briefrec is not None else self.add(nz_rec)
+
+    def clear(self) -> None:
+        """Remove all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """
+        Return the counters of the cache.
+
+        Returns:
+        --------
+        dict
+            Number of entries, maximum size, hits, misses and hit ratio.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups > 0 else 0.0}
+
+
+# Cache of the NZ brief records shared by all requests of the process
+nz_briefrec_cache = BriefRecCache(settings.DEDUP_BRIEFREC_CACHE_SIZE, settings.DEDUP_BRIEFREC_CACHE_TTL)
+
+
+def get_nz_briefrecs(mms_ids: List[str], mongo_col_nz: 'pymongo.collection.Collection') -> Dict[str, CachedBriefRec]:
+    """
+    Return the parsed brief records of NZ records, fetching only the ones missing in the cache.
+
+    Parameters:
+    -----------
+    mms_ids : list of str
+        MMS IDs of the NZ records.
+    mongo_col_nz : pymongo.collection.Collection
+        The collection of the NZ records.
+
+    Returns:
+    --------
+    dict
+        The cached brief records with the MMS ID as key, missing records are skipped.
+    """
+    nz_cached_briefrecs = {mms_id: nz_briefrec_cache.get(mms_id) for mms_id in mms_ids}
+    nz_cached_briefrecs = {mms_id: nz_cached_briefrec for mms_id, nz_cached_briefrec in nz_cached_briefrecs.items()
+                           if nz_cached_briefrec is not None}
+    nz_recs = tools.fetch_nz_records([mms_id for mms_id in mms_ids if mms_id not in nz_cached_briefrecs], mongo_col_nz)
+    nz_cached_briefrecs.update({nz_rec['mms_id']: nz_briefrec_cache.add(nz_rec) for nz_rec in nz_recs})
+
+    return nz_cached_briefrecs
+
+
+def evaluate_local_recs(recs: List[Dict],
+                        nz_cached_briefrecs: Dict[str, CachedBriefRec],
+                        method: str = 'mean',
+                        sequential: bool = False) -> Tuple[Dict[str, List[Tuple[str, Dict[str, float], float]]],
+                                                       Dict[str, Dict]]:
+    """
+    Evaluate the similarity of several local records with all their candidates.
+
+    The stored similarity scores of the fields are reused, see `get_cached_scores`. All
+    the pairs of all the records are evaluated at once by the pool of workers.
+
+    Parameters:
+    -----------
+    recs : list of dict
+        The dedup documents, with at least 'rec_id', 'briefrec' and 'possible_matches'.
+    nz_cached_briefrecs : dict
+        The brief records of the candidates with the MMS ID as key, see `get_nz_briefrecs`.
+        Candidates missing in this dict are skipped.
+    method : str
+        The method used to calculate the global similarity score.
+    sequential : bool
+        Whether to evaluate the pairs in the current thread, see `score_pairs`.
+
+    Returns:
+    --------
+    tuple
+        The evaluations of each record with the rec_id as key, as lists of (mms_id, scores,
+        similarity score) in the order of the possible matches, and the '$set' updates storing
+        the new similarity scores with the rec_id as key.
+    """
+    pairs = []
+    for rec in recs:
+        briefrec = RawBriefRec(rec['briefrec'])
+        mms_ids = [mms_id for mms_id in rec.get('possible_matches') or [] if mms_id in nz_cached_briefrecs]
+        nz_briefrec_keys = [nz_cached_briefrecs[mms_id].key for mms_id in mms_ids]
+
+        # Similarity scores of each field are stored in the dedup document, they are
+        # evaluated again only if one of the records changed
+        briefrec_key = get_briefrec_key(briefrec)
+        known_scores = get_cached_scores(rec, briefrec_key, mms_ids, nz_briefrec_keys)
+        pairs.append((rec, briefrec, briefrec_key, mms_ids, nz_briefrec_keys, known_scores))
+
+    results = score_pairs([(briefrec, nz_cached_briefrecs[mms_id].briefrec)
+                           for _, briefrec, _, mms_ids, _, _ in pairs for mms_id in mms_ids],
+                          method=method,
+                          known_scores=[scores for *_, known_scores in pairs for scores in known_scores],
+                          sequential=sequential)
+
+    evaluations = dict()
+    scores_cache_updates = dict()
+    results = iter(results)
+    for rec, briefrec, briefrec_key, mms_ids, nz_briefrec_keys, known_scores in pairs:
+        rec_results = [next(results) for _ in mms_ids]
+
+        scores_cache_update = get_scores_cache_update(briefrec_key, mms_ids, nz_briefrec_keys,
+                                                      known_scores, rec_results)
+        if len(scores_cache_update) > 0:
+            scores_cache_updates[rec['rec_id']] = scores_cache_update
+
+        evaluations[rec['rec_id']] = [(mms_id, scores, similarity_score)
+                                      for mms_id, (scores, similarity_score) in zip(mms_ids, rec_results)]
+
+    return evaluations, scores_cache_updates
+
+
+def get_field_scores_update(evaluation: List[Tuple[str, Dict[str, float], float]], method: str) -> Dict:
+    """
+    Return the update storing the similarity scores of the fields of the best candidate.
+
+    Parameters:
+    -----------
+    evaluation : list of tuple
+        The evaluation of the candidates of a record returned by `evaluate_local_recs`.
+    method : str
+        The method used to calculate the similarity scores of the evaluation.
+
+    Returns:
+    --------
+    dict
+        The content of a '$set' update of `tools.FIELD_SCORES_FIELD` and
+        `tools.FIELD_SCORES_CANDIDATE_FIELD`, both are None without candidate.
+    """
+    if len(evaluation) == 0:
+        return {tools.FIELD_SCORES_FIELD: None, tools.FIELD_SCORES_CANDIDATE_FIELD: None}
+
+    mms_id, scores, similarity_score = max(evaluation, key=lambda candidate: candidate[2])
+    return {tools.FIELD_SCORES_FIELD: {field: float(score) for field, score in scores.items()},
+            tools.FIELD_SCORES_CANDIDATE_FIELD: {'mms_id': mms_id,
+                                                 'similarity_score': float(similarity_score),
+                                                 'method': method}}
@@ -59,6 +59,13 @@ const briefrec_fields = [
   'parent'
 ];
 
+/*
+Number of next records of the list loaded in advance
+with the batch API, the next record is displayed without
+waiting for the server.
+*/
+const prefetch_size = 5;
+
 /******************/
 /* Vue Components */
 /******************/
@@ -80,7 +87,10 @@ const RecidList = {
 
       // Default filter
       filterSelected: 'all',
-      recidtofilter: ''
+      recidtofilter: '',
+
+      // Filter on the scores of the fields of the best candidate, e.g. "titles>0.9,creators<0.3"
+      scoresfilter: ''
     }
   },
   methods: {
@@ -102,16 +112,18 @@ const RecidList = {
   // a review
   template: `
     <h2 class="mb-0">Local IDs</h2>
-    <form class="m-2" id="recordFilter" @submit.prevent="$emit('fetchRecList', filterSelected, recidtofilter)">
+    <form class="m-2" id="recordFilter" @submit.prevent="$emit('fetchRecList', filterSelected, recidtofilter, false, scoresfilter)">
       <label for="FilterOptions" class="control-label">Filter:</label>
-      <select v-model="filterSelected" class="form-select form-select-sm" id="FilterOptions" @change="$emit('fetchRecList', filterSelected)">
+      <select v-model="filterSelected" class="form-select form-select-sm" id="FilterOptions" @change="$emit('fetchRecList', filterSelected, null, false, scoresfilter)">
         <option v-for="option in filterOptions" :value="option.value" :selected="option.value == filterSelected">{{ option.text }}</option>
       </select>
+      <label for="ScoresFilter" class="control-label">Field scores:</label>
+      <input id="ScoresFilter" type="text" class="form-control" placeholder="titles>0.9,creators<0.3" v-model="scoresfilter" />
       <label for="IDFilter" class="control-label">Record ID:</label>
       <input id="IDFilter" type="text" class="form-control" v-model="recidtofilter" />
 
-      <button id="nextRecords" class="btn btn-sm" type="button" @click="$emit('fetchRecList', filterSelected, null, true)">\u25B6</button>
-      <button id="searchRecords" class="btn btn-sm" type="button" @click="$emit('fetchRecList', filterSelected, recidtofilter)">\u{1F50E}</button>
+      <button id="nextRecords" class="btn btn-sm" type="button" @click="$emit('fetchRecList', filterSelected, null, true, scoresfilter)">\u25B6</button>
+      <button id="searchRecords" class="btn btn-sm" type="button" @click="$emit('fetchRecList', filterSelected, recidtofilter, false, scoresfilter)">\u{1F50E}</button>
 
     </form>
     <div class="m-2">{{ nbTotalRecs }} records</div>
@@ -139,11 +151,17 @@ const FullLocalRec = {
   </table>`
 }
 
-/* Full record */
+/* Full record, loaded on demand */
 const FullRec = {
-  props: ['fullRecData'],
+  props: ['fullRecData', // HTML of the full record, null if not loaded
+          'canExpand', // a record is available, the full record can be loaded
+  ],
+  emits: ["expandFullRec"], // click on the button to display the full record
   template: `
-  <div class="fullrecdata m-2" v-html="fullRecData">
+  <div v-if="fullRecData" class="fullrecdata m-2" v-html="fullRecData">
+  </div>
+  <div v-else-if="canExpand" class="m-2">
+    <button class="btn btn-sm btn-link" @click="$emit('expandFullRec')">Show full record</button>
   </div>`
 }
 
@@ -203,6 +221,14 @@ const SelectEvaluationModel = {
       modelSelected: 'mean' // default
   }},
   emits: ["defineEvaluationModel"],
+  mounted() {
+    /* Learned models are added to the fixed methods */
+    fetch('/dedup/models')
+    .then(response => response.json())
+    .then(data => {
+      if (data['models']) {this.modelOptions = data['models'].map(model => model.name)}
+    });
+  },
   template: `<h2 class="m-2">Evaluation models</h2>
     <form class="m-2" id="selectModel">
       <label for="modelOptions" class="control-label">Current model:</label>
@@ -226,6 +252,10 @@ const app = Vue.createApp({
       trainingDataMessage: null,
       selectedModel: 'mean',
       col_name: col_name, // column name is defined in the template
+      prefetchedRecs: {}, // prefetched records data, key is "<recid>|<model>"
+      showFullRecs: false, // full records are loaded on demand, once requested they are displayed for next records
+      pendingPrefetch: new Set(), // keys of the records being prefetched
+      nextCursor: null, // cursor of the next page of the list of records
     }
   },
   computed: {
@@ -305,19 +335,103 @@ const app = Vue.createApp({
       this.trainingDataMessage = null;
       this.selectedLocRecid = recid; // set the selected record ID
 
-      // Fetch the record data in backend
-      fetch(`/dedup/col/${col_name}/locrec/${recid}?selectedModel=${this.selectedModel}`)
+      // Use the prefetched data if available
+      let key = this.prefetchKey(recid);
+      if (key in this.prefetchedRecs) {
+        this.displayLocRec(this.prefetchedRecs[key]);
+        delete this.prefetchedRecs[key];
+        this.prefetchNextLocRecs(recid);
+        return;
+      }
+
+      // Fetch the record data in backend, full records are loaded on demand
+      fetch(`/dedup/col/${col_name}/locrec/${recid}?selectedModel=${this.selectedModel}&fullrec=0`)
+      .then(response => response.json())
+      .then(data => {
+        // The user may have selected another record in the meantime
+        if (recid !== this.selectedLocRecid) {return}
+        this.displayLocRec(data);
+        this.prefetchNextLocRecs(recid);
+      });
+    },
+
+    /* Display the data of a local record */
+    displayLocRec(data) {
+      this.selectedLocRec = data;
+      this.defineExtNzRecRank();
+      if (this.selectedExtNzRecRank !== null) {this.truncateScores()}
+      this.loadFullRecs();
+    },
+
+    /* Display the full records, they will be displayed for next records too */
+    expandFullRecs() {
+      this.showFullRecs = true;
+      this.loadFullRecs();
+    },
+
+    /* Load the full records of the displayed local and NZ records if required */
+    loadFullRecs() {
+      if (!this.showFullRecs || !this.selectedLocRec) {return}
+
+      let locRec = this.selectedLocRec;
+      if (!locRec.fullrec) {
+        fetch(`/dedup/col/${col_name}/locrec/${this.selectedLocRecid}/fullrec`)
+        .then(response => response.json())
+        .then(data => {locRec.fullrec = data['fullrec'];});
+      }
+
+      let possibleMatch = this.selectedExtNzRecRank !== null ? locRec.possible_matches[this.selectedExtNzRecRank] : undefined;
+      if (possibleMatch !== undefined && !possibleMatch.fullrec) {
+        fetch(`/dedup/nzrec/${possibleMatch.rec_id}/fullrec`)
+        .then(response => response.json())
+        .then(data => {possibleMatch.fullrec = data['fullrec'];});
+      }
+    },
+
+    /* Key of the prefetched records, data depends on the evaluation model */
+    prefetchKey(recid) {
+      return `${recid}|${this.selectedModel}`;
+    },
+
+    /* Load in advance the next records of the list with the batch API */
+    prefetchNextLocRecs(recid) {
+      let index = this.recids.findIndex(rec => rec.rec_id === recid);
+      let nextRecids = this.recids.slice(index + 1, index + 1 + prefetch_size).map(rec => rec.rec_id);
+      let nextKeys = new Set(nextRecids.map(nextRecid => this.prefetchKey(nextRecid)));
+
+      // Rolling buffer: forget the records that are not in the next records anymore
+      for (let key of Object.keys(this.prefetchedRecs)) {
+        if (!nextKeys.has(key)) {delete this.prefetchedRecs[key]}
+      }
+
+      let missingRecids = nextRecids.filter(nextRecid => {
+        let key = this.prefetchKey(nextRecid);
+        return !(key in this.prefetchedRecs) && !this.pendingPrefetch.has(key);
+      });
+      if (missingRecids.length === 0) {return}
+
+      let model = this.selectedModel;
+      let params = new URLSearchParams(missingRecids.map(missingRecid => ['rec_id', missingRecid]));
+      params.append('selectedModel', model);
+      params.append('fullrec', '0');
+      missingRecids.forEach(missingRecid => this.pendingPrefetch.add(`${missingRecid}|${model}`));
+
+      fetch(`/dedup/col/${col_name}/locrecs?${params.toString()}`)
       .then(response => response.json())
       .then(data => {
-        this.selectedLocRec = data;
-        this.defineExtNzRecRank();
-        if (this.selectedExtNzRecRank !== null) {this.truncateScores()}
+        for (let [prefetchedRecid, recData] of Object.entries(data['records'] || {})) {
+          this.prefetchedRecs[`${prefetchedRecid}|${model}`] = recData;
+        }
+      })
+      .finally(() => {
+        missingRecids.forEach(missingRecid => this.pendingPrefetch.delete(`${missingRecid}|${model}`));
       });
     },
 
     /* Select the external or NZ record */
     extNzRecSelected(index) {
       this.selectedExtNzRecRank = index; // this rank is used in computed properties to display the selected record
+      this.loadFullRecs();
     },
 
     /* Define the rank of the external record */
@@ -408,7 +522,7 @@ const app = Vue.createApp({
     },
 
     /* Fetch the list of record IDs according to the provided filter */
-    fetchRecList(filterSelected=null, recid=null, next=false) {
+    fetchRecList(filterSelected=null, recid=null, next=false, scoresFilter=null) {
       let recListUrl = `/dedup/col/${col_name}/locrecids`;
 
       // Add filter to the URL if provided
@@ -416,9 +530,18 @@ const app = Vue.createApp({
         recListUrl += `?filter=${filterSelected}`;
       }
 
+      if (scoresFilter) {
+        recListUrl += recListUrl.includes('?') ? '&' : '?';
+        recListUrl += `scores=${encodeURIComponent(scoresFilter)}`;
+      }
+
       if (recid) {
         recListUrl += recListUrl.includes('?') ? '&' : '?';
         recListUrl += `recid=${recid}`
+      } else if (next && this.nextCursor) {
+        // The total does not change between pages, it is not requested again
+        recListUrl += recListUrl.includes('?') ? '&' : '?';
+        recListUrl += `cursor=${encodeURIComponent(this.nextCursor)}&total=0`;
       } else if (next && this.recids.length > 0) {
         recListUrl += recListUrl.includes('?') ? '&' : '?';
         let recid = this.recids.at(-1).rec_id;
@@ -428,8 +551,14 @@ const app = Vue.createApp({
       fetch(recListUrl)
       .then(response => response.json())
       .then(data => {
+        if (data['status'] === 'error') {
+          alert(data['message']);
+          return;
+        }
+        this.prefetchedRecs = {};
         this.recids = data['rec_ids'];
-        this.nbTotalRecs = data['nb_total_recs'];
+        this.nextCursor = data['next_cursor'];
+        if (data['nb_total_recs'] !== null) {this.nbTotalRecs = data['nb_total_recs'];}
         // Select the first record in the list to display
         if (this.recids.length > 0) {this.recordSelected(this.recids[0]['rec_id']);}
       });
@@ -457,7 +586,7 @@ const app = Vue.createApp({
     <header class="p-2">
       <div class="row">
         <div class="mb-2 col-10">
-          <h1>SLSP dedup tool <span class="text-muted fs-5 ms-2">({{ col_name }}) <a :href="'/dedup/col/' + col_name + '/export'"><img src="/static/dedup/file_export.png" ></a></span></h1>
+          <h1>SLSP dedup tool <span class="text-muted fs-5 ms-2">({{ col_name }}) <a :href="'/dedup/col/' + col_name + '/export'"><img src="/static/dedup/file_export.png" ></a> <a :href="'/dedup/col/' + col_name + '/export?format=csv'" class="fs-6">CSV</a></span></h1>
         </div>
         <div class="mb-2 col-2 text-end">
           <a href="/dedup">Home</a>&nbsp;&nbsp;<a href="/dedup/logout">Logout</a>
@@ -517,10 +646,10 @@ const app = Vue.createApp({
         </div>
         <div class="row">
           <div class="col-6">
-            <FullRec :full-rec-data="locFullRec" />
+            <FullRec :full-rec-data="locFullRec" :can-expand="locBriefRec !== null" @expand-full-rec="expandFullRecs" />
           </div>
           <div class="col-6">
-            <FullRec :full-rec-data="extNzFullRec" />
+            <FullRec :full-rec-data="extNzFullRec" :can-expand="extNzBriefRec !== null" @expand-full-rec="expandFullRecs" />
           </div>
         </div>
       </main>
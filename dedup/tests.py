@@ -1,3 +1,995 @@
-# from django.test import TestCase
+"""
+Tests of the deduplication application.
 
-# Create your tests here.
+Run them with:
+    python manage.py test dedup
+"""
+import base64
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import unittest
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+import joblib
+import numpy as np
+import pymongo
+from bson import ObjectId
+from dedupmarcxml.briefrecord import JsonBriefRec
+from dedupmarcxml.evaluate import get_similarity_score
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from lxml import etree
+
+from . import batch, scoring, tools, training, views
+
+# URI of a MongoDB server used by the tests of the functions using the database. Each test
+# creates its own database and drops it at the end. Without it, these tests are skipped.
+TEST_MONGO_URI = os.getenv('mongodb_dedup_test_uri')
+
+
+@unittest.skipIf(TEST_MONGO_URI is None, 'mongodb_dedup_test_uri is not set')
+class MongoTestCase(SimpleTestCase):
+    """Test case with an empty dedup database and a NZ collection"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mongo_client = pymongo.MongoClient(TEST_MONGO_URI)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mongo_client.close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.db_name = f'dedup_test_{ObjectId()}'
+        self.mongo_db_dedup = self.mongo_client[self.db_name]
+        self.mongo_col_nz = self.mongo_client[f'{self.db_name}_nz']['nz']
+
+    def tearDown(self):
+        self.mongo_client.drop_database(self.db_name)
+        self.mongo_client.drop_database(f'{self.db_name}_nz')
+
+    def get_match_types(self, col_name: str) -> dict:
+        """Return the match type of each record of a collection"""
+        return {rec['rec_id']: rec.get('match_type')
+                for rec in self.mongo_db_dedup[col_name].find({}, {'rec_id': True, 'match_type': True})}
+
+    def assert_stats_consistent(self, col_name: str) -> None:
+        """Check that the statistics updated incrementally are the same as the recomputed ones"""
+        stats = tools.get_collection_stats(col_name, self.mongo_db_dedup)
+        expected = tools.compute_collection_stats(col_name, self.mongo_db_dedup)
+        self.assertEqual(stats['counts'], expected['counts'])
+        self.assertEqual(stats['score_histogram'], expected['score_histogram'])
+
+
+class JsonToMarcTests(SimpleTestCase):
+    """Rendering of the full records in HTML"""
+
+    # Record with unsorted tags, spaces in the values and the indicators, a field without
+    # subfields and a tag that is not displayed
+    rec = {'mms_id': '991',
+           'marc': {'245': [{'ind1': '1', 'ind2': '0', 'sub': [{'a': 'Le petit prince'}, {'c': 'Saint-Exupéry'}]}],
+                    '008': '200101s2020    sz',
+                    'leader': '00000nam a2200000 c 4500',
+                    '100': [{'ind1': '1', 'ind2': ' ', 'sub': [{'a': 'Saint-Exupéry, Antoine de'}]}],
+                    '001': '991',
+                    '650': [{'ind1': ' ', 'ind2': '7', 'sub': [{'a': 'Aviation'}]},
+                            {'ind1': ' ', 'ind2': '7', 'sub': []}],
+                    'AVA': [{'ind1': ' ', 'ind2': ' ', 'sub': [{'a': 'x'}]}]}}
+
+    # Output of the previous implementation of `json_to_marc`, see `scripts/benchmark_json_to_marc.py`
+    expected = ('<strong>LDR&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>00000nam&nbsp;a2200000&nbsp;c&nbsp;4500'
+                '<br><strong>001&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>&nbsp;991'
+                '<br><strong>008&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>&nbsp;200101s2020&nbsp;&nbsp;&nbsp;&nbsp;sz'
+                '<br><strong>100&nbsp;1&nbsp;&nbsp;&nbsp;</strong>&nbsp;<strong>$$a</strong>'
+                '&nbsp;Saint-Exupéry,&nbsp;Antoine&nbsp;de'
+                '<br><strong>245&nbsp;1&nbsp;0&nbsp;</strong>&nbsp;<strong>$$a</strong>&nbsp;Le&nbsp;petit&nbsp;prince'
+                '&nbsp;<strong>$$c</strong>&nbsp;Saint-Exupéry'
+                '<br><strong>650&nbsp;&nbsp;&nbsp;7&nbsp;</strong>&nbsp;<strong>$$a</strong>&nbsp;Aviation'
+                '<br><strong>650&nbsp;&nbsp;&nbsp;7&nbsp;</strong>&nbsp;')
+
+    def test_nz_record(self):
+        self.assertEqual(tools.json_to_marc(self.rec), self.expected)
+
+    def test_local_fullrec(self):
+        self.assertEqual(tools.json_to_marc(self.rec['marc']), self.expected)
+
+    def test_escaped_data(self):
+        rec = {'leader': '00000nam a2200000 c 4500', '001': '<991>',
+               '245': [{'ind1': '"', 'ind2': '0', 'sub': [{'a': 'Tom & Jerry <b>bold</b>'}, {'<': 'x'}]}]}
+        self.assertEqual(tools.json_to_marc(rec).split('<br>')[1:],
+                         ['<strong>001&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>&nbsp;&lt;991&gt;',
+                          '<strong>245&nbsp;&quot;&nbsp;0&nbsp;</strong>&nbsp;<strong>$$a</strong>'
+                          '&nbsp;Tom&nbsp;&amp;&nbsp;Jerry&nbsp;&lt;b&gt;bold&lt;/b&gt;&nbsp;<strong>$$&lt;</strong>&nbsp;x'])
+
+    def test_same_output_as_previous_implementation(self):
+        # Random records with markup in the data, see `scripts/benchmark_json_to_marc.py`
+        path = os.path.join(settings.BASE_DIR, 'scripts', 'benchmark_json_to_marc.py')
+        spec = importlib.util.spec_from_file_location('benchmark_json_to_marc', path)
+        benchmark = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(benchmark)
+
+        rnd = random.Random(1)
+        for _ in range(100):
+            rec = benchmark.get_random_record(rnd, rnd.randint(0, 40))
+            self.assertEqual(tools.json_to_marc(rec), benchmark.json_to_marc_baseline(rec))
+
+
+class MarcXmlTests(SimpleTestCase):
+    """Streamed MarcXML collections and removal of the namespaces of responses"""
+
+    def test_iter_marcxml(self):
+        recs = [{'marc': AutoAcceptTests.get_marc(f'99{i}', f'Titre {i} <&>')} for i in range(50)]
+
+        for compress in [False, True]:
+            with self.subTest(compress=compress):
+                # Small chunks to check that the records are written incrementally, the
+                # compressed output is too small to be split
+                chunks = list(tools.iter_marcxml(iter(recs), compress=compress, chunk_size=1024))
+                content = b''.join(chunks)
+                if compress is True:
+                    content = gzip.decompress(content)
+                else:
+                    self.assertGreater(len(chunks), 2)
+
+                collection = etree.fromstring(content)
+                ns = {'marc': tools.MARC_NS}
+                self.assertEqual(collection.tag, f'{{{tools.MARC_NS}}}collection')
+                self.assertEqual(len(collection.findall('marc:record', ns)), 50)
+                self.assertEqual(collection.findall('marc:record/marc:controlfield[@tag="001"]', ns)[-1].text, '9949')
+                self.assertEqual(collection.find('marc:record/marc:datafield[@tag="245"]/marc:subfield[@code="a"]',
+                                                 ns).text, 'Titre 0 <&>')
+
+                # The namespace is only declared by the collection
+                self.assertEqual(content.count(b'xmlns'), 1)
+
+    def test_remove_ns_from_records(self):
+        response = etree.fromstring(
+            '<srw:searchRetrieveResponse xmlns:srw="http://www.loc.gov/zing/srw/">'
+            '<srw:numberOfRecords>2</srw:numberOfRecords><srw:records>'
+            + ''.join(f'<srw:record><srw:recordData><!-- record {i} -->'
+                      f'<record xmlns="{tools.MARC_NS}"><controlfield tag="001">99{i}</controlfield></record>'
+                      f'</srw:recordData></srw:record>' for i in range(2))
+            + '</srw:records></srw:searchRetrieveResponse>')
+
+        recs = tools.remove_ns_from_records(response, 'recordData/record')
+
+        self.assertEqual([rec.find('controlfield').text for rec in recs], ['990', '991'])
+        self.assertEqual(response.find('numberOfRecords').text, '2')
+        self.assertNotIn(b'xmlns', etree.tostring(response))
+        self.assertTrue(all(element.tag.startswith('{') is False
+                            for element in response.iter() if isinstance(element.tag, str)))
+
+    def test_remove_ns(self):
+        rec = tools.remove_ns(tools.json_to_xml({'marc': AutoAcceptTests.get_marc('991', 'Titre')}))
+        rec_ns = etree.fromstring(etree.tostring(rec).replace(b'<record>', f'<record xmlns="{tools.MARC_NS}">'.encode()))
+
+        self.assertEqual(etree.tostring(tools.remove_ns(rec_ns)), etree.tostring(rec))
+
+
+class RefreshMatchTypeTests(MongoTestCase):
+    """Classification of the records by `tools.refresh_match_type`"""
+
+    def setUp(self):
+        super().setUp()
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': 'a', 'matched_record': 'g1', 'possible_matches': ['g1'], 'max_match_score': 0.9},
+            {'rec_id': 'b', 'matched_record': 'g1', 'possible_matches': ['g1'], 'max_match_score': 0.8},
+            {'rec_id': 'c', 'matched_record': 'g2', 'possible_matches': ['g2'], 'max_match_score': 0.7},
+            {'rec_id': 'd', 'matched_record': None, 'possible_matches': ['g3'], 'max_match_score': 0.5},
+            {'rec_id': 'e', 'matched_record': None, 'possible_matches': [], 'max_match_score': None},
+        ])
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+
+    def test_full_refresh(self):
+        self.assertEqual(self.get_match_types('col'), {'a': 'duplicate_match', 'b': 'duplicate_match', 'c': 'match',
+                                                       'd': 'possible_match', 'e': 'no_match'})
+
+    def test_full_refresh_removes_marks(self):
+        self.mongo_db_dedup['col'].update_many({}, {'$set': {tools.MATCH_TYPE_DIRTY_FIELD: True}})
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+        self.assertEqual(self.mongo_db_dedup['col'].count_documents({tools.MATCH_TYPE_DIRTY_FIELD: {'$exists': True}}),
+                         0)
+
+    def test_incremental_refresh_with_changed_matched_record(self):
+        # 'a' leaves the group of 'b' for the group of 'c', 'd' gets a match
+        self.mongo_db_dedup['col'].update_one({'rec_id': 'a'}, {'$set': {'matched_record': 'g2',
+                                                                         tools.MATCH_TYPE_DIRTY_FIELD: True}})
+        self.mongo_db_dedup['col'].update_one({'rec_id': 'd'}, {'$set': {'matched_record': 'g3',
+                                                                         tools.MATCH_TYPE_DIRTY_FIELD: True}})
+        tools.refresh_match_type('col', self.mongo_db_dedup, incremental=True)
+
+        self.assertEqual(self.get_match_types('col'), {'a': 'duplicate_match', 'b': 'match', 'c': 'duplicate_match',
+                                                       'd': 'match', 'e': 'no_match'})
+        self.assertEqual(self.mongo_db_dedup['col'].count_documents({tools.MATCH_TYPE_DIRTY_FIELD: {'$exists': True}}),
+                         0)
+        self.assert_stats_consistent('col')
+
+    def test_incremental_refresh_with_cancelled_match(self):
+        self.mongo_db_dedup['col'].update_one({'rec_id': 'b'}, {'$set': {'matched_record': None,
+                                                                         tools.MATCH_TYPE_DIRTY_FIELD: True}})
+        tools.refresh_match_type('col', self.mongo_db_dedup, incremental=True)
+
+        self.assertEqual(self.get_match_types('col'), {'a': 'match', 'b': 'possible_match', 'c': 'match',
+                                                       'd': 'possible_match', 'e': 'no_match'})
+        self.assert_stats_consistent('col')
+
+    def test_incremental_refresh_of_new_records(self):
+        # Only the new records marked as dirty are claimed by the incremental refresh
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': 'f', 'matched_record': 'g2', 'possible_matches': ['g2'], tools.MATCH_TYPE_DIRTY_FIELD: True},
+            {'rec_id': 'g', 'matched_record': None, 'possible_matches': ['g2']},
+        ])
+        tools.refresh_match_type('col', self.mongo_db_dedup, incremental=True)
+
+        self.assertEqual(self.get_match_types('col'), {'a': 'duplicate_match', 'b': 'duplicate_match',
+                                                       'c': 'duplicate_match', 'd': 'possible_match', 'e': 'no_match',
+                                                       'f': 'duplicate_match', 'g': None})
+
+        # Records loaded without the mark are classified by the next full refresh
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+        self.assertEqual(self.get_match_types('col')['g'], 'possible_match')
+
+    def test_full_refresh_takes_the_lease(self):
+        self.assertIsNotNone(tools._acquire_refresh_lease('col', self.mongo_db_dedup))
+        self.assertFalse(tools.run_match_type_refresh('col', self.mongo_db_dedup, wait=False, full=True))
+
+    def test_refresh_pending(self):
+        # The collection has never been refreshed with a lease
+        self.assertTrue(tools.is_match_type_refresh_pending('col', self.mongo_db_dedup))
+        tools.run_match_type_refresh('col', self.mongo_db_dedup)
+        self.assertFalse(tools.is_match_type_refresh_pending('col', self.mongo_db_dedup))
+
+        self.mongo_db_dedup['col'].update_one({'rec_id': 'a'}, {'$set': {tools.MATCH_TYPE_DIRTY_FIELD: True}})
+        self.assertTrue(tools.is_match_type_refresh_pending('col', self.mongo_db_dedup))
+        tools.run_match_type_refresh('col', self.mongo_db_dedup)
+
+        token = tools._acquire_refresh_lease('col', self.mongo_db_dedup)
+        self.assertTrue(tools.is_match_type_refresh_pending('col', self.mongo_db_dedup))
+        tools._release_refresh_lease('col', self.mongo_db_dedup, token)
+        self.assertFalse(tools.is_match_type_refresh_pending('col', self.mongo_db_dedup))
+
+
+class PageCursorTests(SimpleTestCase):
+    """Cursors of the pages of the list of records"""
+
+    def test_round_trip(self):
+        sort_key = ['991', ObjectId()]
+        cursor = tools.encode_page_cursor('duplicatematch', sort_key)
+        self.assertEqual(tools.decode_page_cursor(cursor, 'duplicatematch', by_matched_record=True), sort_key)
+
+    def test_cursor_of_another_filter(self):
+        cursor = tools.encode_page_cursor('all', [ObjectId()])
+        self.assertIsNone(tools.decode_page_cursor(cursor, 'possible'))
+
+    def test_invalid_cursor(self):
+        self.assertIsNone(tools.decode_page_cursor('not a cursor', 'all'))
+        self.assertIsNone(tools.decode_page_cursor(tools.encode_page_cursor('all', [ObjectId()])[:-4], 'all'))
+
+    def test_invalid_sort_keys(self):
+        # Cursors are sent by the client, their keys must not fail or be used as query operators
+        def raw_cursor(data: str) -> str:
+            return base64.urlsafe_b64encode(data.encode()).decode()
+
+        for sort_key in ['[]', '[{"$oid": "zz"}]', '[{"$ne": null}]', '["991"]', '[{"$oid": "%s"}, 1]' % ObjectId()]:
+            with self.subTest(sort_key=sort_key):
+                self.assertIsNone(tools.decode_page_cursor(raw_cursor(f'{{"f": "all", "k": {sort_key}}}'), 'all'))
+
+        for sort_key in ['[]', '[{"$ne": null}, {"$oid": "%s"}]' % ObjectId(), '["991"]', '["991", "a"]',
+                         '["991", {"$oid": "%s"}, "red"]' % ObjectId(), '["991", {"$oid": "%s"}, true, 1]' % ObjectId()]:
+            with self.subTest(sort_key=sort_key):
+                self.assertIsNone(tools.decode_page_cursor(raw_cursor(f'{{"f": "duplicatematch", "k": {sort_key}}}'),
+                                                           'duplicatematch', by_matched_record=True))
+
+    def test_key_of_another_sort(self):
+        cursor = tools.encode_page_cursor('duplicatematch', ['991', ObjectId(), True])
+        self.assertIsNone(tools.decode_page_cursor(cursor, 'duplicatematch'))
+        cursor = tools.encode_page_cursor('all', [ObjectId()])
+        self.assertIsNone(tools.decode_page_cursor(cursor, 'all', by_matched_record=True))
+
+
+class FieldScoresFilterTests(SimpleTestCase):
+    """Queries of the filters on the similarity scores of the fields"""
+
+    def test_conditions(self):
+        self.assertEqual(tools.parse_field_scores_filter('titles>0.9, creators <= .3'),
+                         {'field_scores.titles': {'$gt': 0.9}, 'field_scores.creators': {'$lte': 0.3}})
+
+    def test_range_on_a_field(self):
+        self.assertEqual(tools.parse_field_scores_filter('years>=0.2,years<0.8'),
+                         {'field_scores.years': {'$gte': 0.2, '$lt': 0.8}})
+
+    def test_blank_conditions(self):
+        self.assertEqual(tools.parse_field_scores_filter(''), {})
+        self.assertEqual(tools.parse_field_scores_filter(',titles<1, ,'), {'field_scores.titles': {'$lt': 1.0}})
+
+    def test_invalid_conditions(self):
+        for scores_filter in ['title>0.9', 'titles=0.9', 'titles>>0.9', 'titles>high', 'titles>0.9;creators<0.3',
+                              'field_scores.titles>0.9']:
+            with self.subTest(scores_filter=scores_filter), self.assertRaises(ValueError):
+                tools.parse_field_scores_filter(scores_filter)
+
+
+class TrainingDataAccessTests(SimpleTestCase):
+    """The training data contains records of all the collections, only staff users can read it"""
+
+    def get_response(self, view, is_staff: bool):
+        """Return the response of a view to a GET request of a logged in user"""
+        request = RequestFactory().get('/')
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=is_staff)
+        return view(request)
+
+    def test_training_data_export(self):
+        self.assertEqual(self.get_response(views.get_training_data_export, is_staff=False).status_code, 403)
+
+    def test_training_evaluation(self):
+        self.assertEqual(self.get_response(views.get_training_evaluation, is_staff=False).status_code, 403)
+
+
+class SimilarityScoresTests(SimpleTestCase):
+    """Vectorized global similarity scores of `scoring.get_similarity_scores`"""
+
+    def test_same_scores_as_dedupmarcxml(self):
+        # Scores of 0.0 and 0.1 are missing values of dedupmarcxml
+        rng = np.random.default_rng(1)
+        features = rng.choice([0.0, 0.1, 0.2, 0.5, 0.9, 1.0], size=(40, len(tools.SCORE_FIELDS)))
+        features[:20] = rng.random((20, len(tools.SCORE_FIELDS)))
+        features[-1] = 0.0
+
+        for method in scoring.SCORING_METHODS:
+            with self.subTest(method=method):
+                expected = [get_similarity_score(dict(zip(tools.SCORE_FIELDS, row)), method=method) for row in features]
+                np.testing.assert_allclose(scoring.get_similarity_scores(features, tools.SCORE_FIELDS, method),
+                                           expected, atol=1e-9)
+
+                # The columns are mapped by field name
+                np.testing.assert_allclose(scoring.get_similarity_scores(features[:, ::-1], tools.SCORE_FIELDS[::-1],
+                                                                         method), expected, atol=1e-9)
+
+
+class TrainingFeaturesTests(SimpleTestCase):
+    """Features of the training data computed like the scores of the candidates in the app"""
+
+    def setUp(self):
+        self.local_marc = AutoAcceptTests.get_marc('local', 'Le petit prince')
+        self.nz_marc = AutoAcceptTests.get_marc('nz1', 'Le petit prince : roman')
+        self.briefrec = JsonBriefRec({'marc': self.local_marc}).data
+
+        # Scores of the candidate in the app, see `scoring.evaluate_local_recs`
+        nz_cached_briefrecs = {'nz1': scoring.CachedBriefRec(JsonBriefRec({'mms_id': 'nz1', 'marc': self.nz_marc}))}
+        evaluations, _ = scoring.evaluate_local_recs([{'rec_id': 'a', 'briefrec': self.briefrec,
+                                                       'possible_matches': ['nz1']}],
+                                                     nz_cached_briefrecs, sequential=True)
+        self.app_scores = evaluations['a'][0][1]
+
+    def test_stored_scores(self):
+        entry = {'scores': {field: 0.5 for field in tools.SCORE_FIELDS},
+                 'dedupmarcxml_version': scoring.dedupmarcxml_version, 'local_briefrec': self.briefrec,
+                 'local_fullrec': self.local_marc, 'ext_nz_fullrec': self.nz_marc}
+        features = training.compute_features_chunk([entry, None])
+
+        np.testing.assert_array_equal(features[0], np.full(len(tools.SCORE_FIELDS), 0.5))
+        self.assertTrue(np.isnan(features[1]).all())
+
+    def test_scores_of_another_version(self):
+        features = training.compute_features_chunk([{'scores': {field: 0.5 for field in tools.SCORE_FIELDS},
+                                                     'dedupmarcxml_version': '0.0.0', 'local_briefrec': self.briefrec,
+                                                     'local_fullrec': self.local_marc, 'ext_nz_fullrec': self.nz_marc}])
+
+        np.testing.assert_allclose(features[0], [self.app_scores.get(field, np.nan) for field in tools.SCORE_FIELDS])
+
+
+class LearnedModelsTests(SimpleTestCase):
+    """Learned models trained on features of another version are not used"""
+
+    def setUp(self):
+        models_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(models_dir.cleanup)
+        settings_override = override_settings(DEDUP_MODELS_DIR=models_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(scoring._learned_models.clear)
+
+        # Models saved before the versioning of the features have no 'features_version'
+        for name, metadata in [('current', {'features_version': training.FEATURES_VERSION}),
+                               ('outdated', {'features_version': 1}),
+                               ('unversioned', {})]:
+            joblib.dump({'model': None, 'columns': tools.SCORE_FIELDS}, os.path.join(models_dir.name, f'{name}.joblib'))
+            with open(os.path.join(models_dir.name, f'{name}.json'), 'w', encoding='utf-8') as f:
+                json.dump({'algorithm': 'logistic_regression', **metadata}, f)
+
+    def test_listed_models(self):
+        self.assertEqual([model['name'] for model in scoring.get_learned_models()], ['learned:current'])
+
+    def test_scoring_methods(self):
+        self.assertTrue(scoring.is_scoring_method('learned:current'))
+        self.assertFalse(scoring.is_scoring_method('learned:outdated'))
+        self.assertFalse(scoring.is_scoring_method('learned:unversioned'))
+        self.assertFalse(scoring.is_scoring_method('learned:missing'))
+
+    def test_load_outdated_model(self):
+        self.assertEqual(scoring.load_learned_model('learned:current')['columns'], tools.SCORE_FIELDS)
+        with self.assertRaisesRegex(ValueError, 'trained on features of version 1'):
+            scoring.load_learned_model('learned:outdated')
+        with self.assertRaisesRegex(ValueError, 'trained on features of version 1'):
+            scoring.load_learned_model('learned:unversioned')
+
+    def test_models_view(self):
+        request = RequestFactory().get('/')
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=False)
+        names = [model['name'] for model in json.loads(views.get_models(request).content)['models']]
+
+        self.assertIn('learned:current', names)
+        self.assertNotIn('learned:outdated', names)
+        self.assertNotIn('learned:unversioned', names)
+
+
+class BriefRecCacheTests(SimpleTestCase):
+    """LRU cache of the parsed NZ brief records, `scoring.BriefRecCache`"""
+
+    def setUp(self):
+        self.nz_recs = [{'mms_id': f'nz{i}', 'marc': AutoAcceptTests.get_marc(f'nz{i}', f'Titre {i}')}
+                        for i in range(3)]
+        self.now = 1000.0
+        time_patch = mock.patch.object(scoring, 'time', SimpleNamespace(monotonic=lambda: self.now))
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+
+    def test_hits_and_misses(self):
+        cache = scoring.BriefRecCache(maxsize=10, ttl=60)
+        first = cache.get_or_add(self.nz_recs[0])
+
+        self.assertIs(cache.get_or_add(self.nz_recs[0]), first)
+        self.assertEqual(first.briefrec.data['rec_id'], 'nz0')
+        cache.get_or_add(self.nz_recs[1])
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 10, 'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3})
+
+        cache.clear()
+        self.assertEqual(cache.stats(), {'size': 0, 'maxsize': 10, 'hits': 0, 'misses': 0, 'hit_ratio': 0.0})
+
+    def test_eviction_at_maxsize(self):
+        cache = scoring.BriefRecCache(maxsize=2, ttl=60)
+        cache.get_or_add(self.nz_recs[0])
+        cache.get_or_add(self.nz_recs[1])
+
+        # The least recently used entry is evicted
+        cache.get_or_add(self.nz_recs[0])
+        cache.get_or_add(self.nz_recs[2])
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertIsNotNone(cache.get('nz0'))
+        self.assertIsNone(cache.get('nz1'))
+        self.assertIsNotNone(cache.get('nz2'))
+
+    def test_expiry_after_ttl(self):
+        cache = scoring.BriefRecCache(maxsize=10, ttl=60)
+        first = cache.get_or_add(self.nz_recs[0])
+
+        self.now += 59
+        self.assertIs(cache.get_or_add(self.nz_recs[0]), first)
+        self.now += 2
+        self.assertIsNot(cache.get_or_add(self.nz_recs[0]), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_disabled_cache(self):
+        cache = scoring.BriefRecCache(maxsize=0, ttl=60)
+        cache.get_or_add(self.nz_recs[0])
+        cache.get_or_add(self.nz_recs[0])
+
+        self.assertEqual(cache.stats(), {'size': 0, 'maxsize': 0, 'hits': 0, 'misses': 2, 'hit_ratio': 0.0})
+
+    def test_models_view(self):
+        cache = scoring.BriefRecCache(maxsize=10, ttl=60)
+        cache.get_or_add(self.nz_recs[0])
+        cache.get_or_add(self.nz_recs[0])
+
+        for is_staff in [False, True]:
+            request = RequestFactory().get('/')
+            request.user = SimpleNamespace(is_authenticated=True, is_staff=is_staff)
+            with self.subTest(is_staff=is_staff), mock.patch.object(scoring, 'nz_briefrec_cache', cache):
+                response = json.loads(views.get_models(request).content)
+                if is_staff:
+                    self.assertEqual(response['briefrec_cache'], cache.stats())
+                else:
+                    self.assertNotIn('briefrec_cache', response)
+
+
+class ScoresCacheTests(SimpleTestCase):
+    """Similarity scores stored with the local records, `scoring.get_cached_scores`"""
+
+    def setUp(self):
+        self.briefrec_key = scoring.get_briefrec_key(JsonBriefRec({'marc': AutoAcceptTests.get_marc('local', 'Titre')}))
+        nz_briefrecs = [JsonBriefRec({'mms_id': f'nz{i}', 'marc': AutoAcceptTests.get_marc(f'nz{i}', 'Titre')})
+                        for i in range(2)]
+        self.nz_briefrec_keys = [scoring.get_briefrec_key(nz_briefrec) for nz_briefrec in nz_briefrecs]
+        self.results = [({'title': 0.9}, 0.9), ({'title': 0.4}, 0.4)]
+
+    def get_stored_rec(self, mms_ids, known_scores=(None, None)):
+        """Return a local record with the update of `scoring.get_scores_cache_update` applied"""
+        update = scoring.get_scores_cache_update(self.briefrec_key, mms_ids, self.nz_briefrec_keys,
+                                                 list(known_scores), self.results)
+        rec = {}
+        for path, value in update.items():
+            field, mms_id = path.split('.', 1)
+            rec.setdefault(field, {})[mms_id] = value
+        return rec
+
+    def test_stored_scores(self):
+        rec = self.get_stored_rec(['nz0', 'nz1'])
+
+        self.assertEqual(scoring.get_cached_scores(rec, self.briefrec_key, ['nz0', 'nz1'], self.nz_briefrec_keys),
+                         [{'title': 0.9}, {'title': 0.4}])
+        self.assertEqual(scoring.get_cached_scores({}, self.briefrec_key, ['nz0'], self.nz_briefrec_keys[:1]),
+                         [None])
+
+    def test_known_scores_not_stored_again(self):
+        update = scoring.get_scores_cache_update(self.briefrec_key, ['nz0', 'nz1'], self.nz_briefrec_keys,
+                                                 [{'title': 0.9}, None], self.results)
+
+        self.assertEqual(list(update), [f'{scoring.SCORES_CACHE_FIELD}.nz1'])
+
+    def test_changed_brief_records(self):
+        rec = self.get_stored_rec(['nz0', 'nz1'])
+        changed_key = scoring.get_briefrec_key(JsonBriefRec({'marc': AutoAcceptTests.get_marc('local', 'Autre titre')}))
+
+        self.assertNotEqual(changed_key, self.briefrec_key)
+        self.assertEqual(scoring.get_cached_scores(rec, changed_key, ['nz0', 'nz1'], self.nz_briefrec_keys),
+                         [None, None])
+        self.assertEqual(scoring.get_cached_scores(rec, self.briefrec_key, ['nz0', 'nz1'],
+                                                   [changed_key, self.nz_briefrec_keys[1]]),
+                         [None, {'title': 0.4}])
+
+    def test_changed_dedupmarcxml_version(self):
+        rec = self.get_stored_rec(['nz0', 'nz1'])
+
+        with mock.patch.object(scoring, 'dedupmarcxml_version', '0.0.0'):
+            self.assertEqual(scoring.get_cached_scores(rec, self.briefrec_key, ['nz0', 'nz1'], self.nz_briefrec_keys),
+                             [None, None])
+
+    def test_invalid_field_names(self):
+        # MongoDB field names can't contain dots or start with a dollar
+        self.assertEqual(scoring.get_scores_cache_update(self.briefrec_key, ['nz.0', '$nz1'], self.nz_briefrec_keys,
+                                                         [None, None], self.results), {})
+        self.assertEqual(list(self.get_stored_rec(['nz.0', 'nz1'])[scoring.SCORES_CACHE_FIELD]), ['nz1'])
+
+
+class MatchingExportTests(SimpleTestCase):
+    """Export of the records with a match in CSV, TSV and Excel"""
+
+    # Rows of the previous export, built in memory with the columns of `tools.MATCHING_EXPORT_COLUMNS`
+    rows = [['991001', '991000000000005501', 'match'],
+            ['991002', '991000000000005502', 'duplicate_match'],
+            ['991003', 'nz,"quoted"\tand tab', 'possible_match'],
+            ['991003', 'line\nbreak', 'possible_match']]
+
+    @staticmethod
+    def read_xlsx(content: bytes) -> list:
+        """Return the values of the cells of the first worksheet of an Excel file"""
+        ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            sheet = ET.fromstring(workbook.read('xl/worksheets/sheet1.xml'))
+        return [[''.join(text.text or '' for text in cell.iter(f'{ns}t')) for cell in row.iter(f'{ns}c')]
+                for row in sheet.iter(f'{ns}row')]
+
+    def get_export(self, export_format: str):
+        """Return the response of the export of a collection with the rows of the test"""
+        request = RequestFactory().get('/', {'format': export_format})
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=False)
+        with mock.patch.object(tools, 'is_match_type_refresh_pending', return_value=False), \
+                mock.patch.object(tools, 'iter_matching_rows', return_value=iter(self.rows)), \
+                mock.patch.object(views, 'mongo_db_dedup', mock.MagicMock()):
+            return views.get_matching_records(request, 'col')
+
+    def test_delimited(self):
+        for delimiter in [',', '\t']:
+            with self.subTest(delimiter=delimiter):
+                # Small chunks to check that rows are not split between chunks
+                chunks = list(tools.iter_delimited(iter(self.rows), tools.MATCHING_EXPORT_COLUMNS, delimiter,
+                                                   chunk_size=10))
+                self.assertGreater(len(chunks), 1)
+                self.assertEqual(list(csv.reader(io.StringIO(''.join(chunks)), delimiter=delimiter)),
+                                 [tools.MATCHING_EXPORT_COLUMNS] + self.rows)
+
+    def test_xlsx(self):
+        output = io.BytesIO()
+        tools.write_xlsx(iter(self.rows), tools.MATCHING_EXPORT_COLUMNS, output)
+
+        self.assertEqual(self.read_xlsx(output.getvalue()), [tools.MATCHING_EXPORT_COLUMNS] + self.rows)
+
+    def test_export_view(self):
+        for export_format, delimiter in [('csv', ','), ('tsv', '\t')]:
+            with self.subTest(export_format=export_format):
+                response = self.get_export(export_format)
+                content = b''.join(response.streaming_content)
+                self.assertEqual(response['Content-Type'], views.EXPORT_FORMATS[export_format])
+                self.assertEqual(response['Content-Disposition'], f'attachment; filename="export_col.{export_format}"')
+                self.assertEqual(list(csv.reader(io.StringIO(content.decode('utf-8')), delimiter=delimiter)),
+                                 [tools.MATCHING_EXPORT_COLUMNS] + self.rows)
+
+        response = self.get_export('xlsx')
+        self.assertEqual(response['Content-Type'], views.EXPORT_FORMATS['xlsx'])
+        self.assertEqual(self.read_xlsx(b''.join(response.streaming_content)), [tools.MATCHING_EXPORT_COLUMNS] + self.rows)
+        self.assertEqual(response['X-Dedup-Refresh-Pending'], 'false')
+        response.close()
+
+    def test_unknown_format(self):
+        self.assertEqual(self.get_export('xls').status_code, 400)
+
+
+class PageCursorPagingTests(MongoTestCase):
+    """Keyset paging of the list of records"""
+
+    def test_paging_by_matched_record(self):
+        # Groups span the pages and the order of the '_id' is not the order of the groups
+        matched_records = ['g3', 'g1', 'g2', 'g1', 'g3', 'g1', 'g2']
+        self.mongo_db_dedup['col'].insert_many([{'rec_id': f'r{i}', 'matched_record': matched_record,
+                                                 'match_type': 'duplicate_match'}
+                                                for i, matched_record in enumerate(matched_records)])
+        sort = [('matched_record', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+        expected = [rec['rec_id'] for rec in self.mongo_db_dedup['col'].find({}, sort=sort)]
+
+        rec_ids = []
+        cursor = None
+        while True:
+            query = {'match_type': 'duplicate_match'}
+            if cursor is not None:
+                sort_key = tools.decode_page_cursor(cursor, 'duplicatematch', by_matched_record=True)
+                query.update(tools.get_page_cursor_query(sort_key, by_matched_record=True))
+            recs = list(self.mongo_db_dedup['col'].find(query, sort=sort, limit=2))
+            rec_ids += [rec['rec_id'] for rec in recs]
+            if len(recs) < 2:
+                break
+            cursor = tools.encode_page_cursor('duplicatematch', [recs[-1]['matched_record'], recs[-1]['_id']])
+
+        self.assertEqual(rec_ids, expected)
+
+    def test_paging_by_id(self):
+        self.mongo_db_dedup['col'].insert_many([{'rec_id': f'r{i}'} for i in range(5)])
+        first_page = list(self.mongo_db_dedup['col'].find({}, sort=[('_id', pymongo.ASCENDING)], limit=3))
+        cursor = tools.encode_page_cursor('all', [first_page[-1]['_id']])
+        next_page = self.mongo_db_dedup['col'].find(tools.get_page_cursor_query(tools.decode_page_cursor(cursor, 'all')),
+                                                    sort=[('_id', pymongo.ASCENDING)])
+        self.assertEqual([rec['rec_id'] for rec in next_page], ['r3', 'r4'])
+
+
+class MatchingRowsTests(MongoTestCase):
+    """Rows of the export of the records with a match read from the collection"""
+
+    def test_rows(self):
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': '991001', 'match_type': 'match', 'matched_record': 'nz1', 'possible_matches': ['nz1', 'nz2']},
+            {'rec_id': '991002', 'match_type': 'duplicate_match', 'matched_record': 'nz1'},
+            {'rec_id': '991003', 'match_type': 'possible_match', 'possible_matches': ['nz3', 'nz,"4"']},
+            {'rec_id': '991004', 'match_type': 'no_match', 'possible_matches': []}])
+
+        # One row by matched record and one row by possible match, like the previous export
+        self.assertEqual(list(tools.iter_matching_rows(self.mongo_db_dedup['col'], batch_size=2)),
+                         [['991001', 'nz1', 'match'],
+                          ['991002', 'nz1', 'duplicate_match'],
+                          ['991003', 'nz3', 'possible_match'],
+                          ['991003', 'nz,"4"', 'possible_match']])
+
+
+class ApplyDecisionsTests(MongoTestCase):
+    """Decisions taken with `tools.apply_decisions`"""
+
+    def setUp(self):
+        super().setUp()
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': 'a', 'matched_record': 'g1', 'possible_matches': ['g1'], 'max_match_score': 0.9},
+            {'rec_id': 'b', 'matched_record': 'g1', 'possible_matches': ['g1'], 'max_match_score': 0.8},
+            {'rec_id': 'c', 'matched_record': None, 'possible_matches': ['g1', 'g2'], 'max_match_score': 0.7},
+            {'rec_id': 'd', 'matched_record': None, 'possible_matches': ['g2'], 'max_match_score': 0.3},
+        ])
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+
+    def test_match_types(self):
+        result = tools.apply_decisions('col', self.mongo_db_dedup, {'a': None, 'c': 'g1', 'd': 'g2', 'x': 'g1'})
+
+        self.assertEqual(result, {'updated': 3, 'not_found': ['x']})
+        self.assertEqual(self.get_match_types('col'), {'a': 'no_match', 'b': 'duplicate_match',
+                                                       'c': 'duplicate_match', 'd': 'match'})
+        self.assertEqual(self.mongo_db_dedup['col'].count_documents({'human_validated': True}), 3)
+
+    def test_stats_delta(self):
+        counts = tools.get_collection_stats('col', self.mongo_db_dedup)['counts']
+        self.assertEqual((counts['possible'], counts['possible06'], counts['duplicatematch']), (2, 1, 2))
+
+        tools.apply_decisions('col', self.mongo_db_dedup, {'a': None, 'c': 'g2'})
+
+        counts = tools.get_collection_stats('col', self.mongo_db_dedup)['counts']
+        self.assertEqual((counts['possible'], counts['possible06'], counts['nomatch'], counts['match']), (1, 0, 1, 2))
+        self.assert_stats_consistent('col')
+
+    def test_moved_record_leaves_its_group(self):
+        tools.apply_decisions('col', self.mongo_db_dedup, {'a': 'g2'})
+
+        self.assertEqual(self.get_match_types('col'), {'a': 'match', 'b': 'match', 'c': 'possible_match',
+                                                       'd': 'possible_match'})
+        self.assert_stats_consistent('col')
+
+        # The refresh of the collection keeps the decisions
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+        self.assertEqual(self.get_match_types('col'), {'a': 'match', 'b': 'match', 'c': 'possible_match',
+                                                       'd': 'possible_match'})
+
+
+class AutoAcceptTests(MongoTestCase):
+    """Matches accepted with `batch.auto_accept_matches`"""
+
+    @staticmethod
+    def get_marc(rec_id: str, title: str) -> dict:
+        """Return a JSON MARC record of a book"""
+        return {'leader': '00000nam a2200000 c 4500', '001': rec_id, '008': '200101s2020    sz            000 0 fre d',
+                '020': [{'ind1': ' ', 'ind2': ' ', 'sub': [{'a': '9782070612758'}]}],
+                '100': [{'ind1': '1', 'ind2': ' ', 'sub': [{'a': 'Saint-Exupéry, Antoine de'}]}],
+                '245': [{'ind1': '1', 'ind2': '0', 'sub': [{'a': title}, {'c': 'Antoine de Saint-Exupéry'}]}],
+                '264': [{'ind1': ' ', 'ind2': '1', 'sub': [{'a': 'Paris'}, {'b': 'Gallimard'}, {'c': '2020'}]}],
+                '300': [{'ind1': ' ', 'ind2': ' ', 'sub': [{'a': '120 pages'}]}]}
+
+    def setUp(self):
+        super().setUp()
+        self.mongo_col_nz.insert_many([{'mms_id': 'nz1', 'marc': self.get_marc('nz1', 'Le petit prince')},
+                                       {'mms_id': 'nz2', 'marc': self.get_marc('nz2', 'Le petit prince')},
+                                       {'mms_id': 'nz3', 'marc': self.get_marc('nz3', 'Vol de nuit')}])
+
+        briefrec = JsonBriefRec({'marc': self.get_marc('local', 'Le petit prince')}).data
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': 'a', 'briefrec': briefrec, 'matched_record': None, 'possible_matches': ['nz1', 'nz3']},
+            {'rec_id': 'b', 'briefrec': briefrec, 'matched_record': None, 'possible_matches': ['nz1', 'nz2']},
+            {'rec_id': 'c', 'briefrec': briefrec, 'matched_record': None, 'possible_matches': ['nz3']},
+            {'rec_id': 'd', 'briefrec': briefrec, 'matched_record': None, 'possible_matches': ['nz2'],
+             'match_type': 'no_match', 'human_validated': True},
+        ])
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_accepted_matches(self):
+        summary = batch.auto_accept_matches('col', self.mongo_db_dedup, self.mongo_col_nz, 0.9, user='tester')
+
+        self.assertEqual({key: summary[key] for key in ['checked', 'accepted', 'ambiguous', 'below_threshold']},
+                         {'checked': 3, 'accepted': 1, 'ambiguous': 1, 'below_threshold': 1})
+        self.assertEqual(self.mongo_db_dedup['col'].find_one({'rec_id': 'a'})['matched_record'], 'nz1')
+        self.assertEqual(self.get_match_types('col'), {'a': 'match', 'b': 'possible_match', 'c': 'possible_match',
+                                                       'd': 'no_match'})
+        self.assert_stats_consistent('col')
+
+        entries = list(self.mongo_db_dedup[tools.JOURNAL_COL].find({}, {'_id': False}))
+        self.assertEqual([(entry['rec_id'], entry['matched_record'], entry['source'], entry['user'])
+                          for entry in entries], [('a', 'nz1', 'auto_accept', 'tester')])
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_record_decided_during_the_batch(self):
+        get_nz_briefrecs = scoring.get_nz_briefrecs
+
+        def decide_and_get_nz_briefrecs(*args, **kwargs):
+            # A human cancels the match of 'a' while the chunk is evaluated
+            tools.apply_decisions('col', self.mongo_db_dedup, {'a': None}, user='human')
+            return get_nz_briefrecs(*args, **kwargs)
+
+        with mock.patch.object(scoring, 'get_nz_briefrecs', side_effect=decide_and_get_nz_briefrecs):
+            summary = batch.auto_accept_matches('col', self.mongo_db_dedup, self.mongo_col_nz, 0.9, user='tester')
+
+        self.assertEqual((summary['checked'], summary['accepted'], summary['samples']), (3, 0, []))
+        rec = self.mongo_db_dedup['col'].find_one({'rec_id': 'a'})
+        self.assertEqual((rec['matched_record'], rec['match_type'], rec.get(batch.AUTO_ACCEPTED_FIELD)),
+                         (None, 'no_match', None))
+        self.assert_stats_consistent('col')
+        self.assertEqual([entry['source'] for entry in self.mongo_db_dedup[tools.JOURNAL_COL].find()], ['human'])
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_dry_run(self):
+        summary = batch.auto_accept_matches('col', self.mongo_db_dedup, self.mongo_col_nz, 0.9, dry_run=True,
+                                            max_records=2, chunk_size=1)
+
+        self.assertEqual((summary['checked'], summary['accepted'], summary['truncated']), (2, 1, True))
+        self.assertEqual(summary['samples'][0]['matched_record'], 'nz1')
+        self.assertEqual(self.mongo_db_dedup['col'].count_documents({'matched_record': {'$ne': None}}), 0)
+        self.assertEqual(self.mongo_db_dedup[tools.JOURNAL_COL].count_documents({}), 0)
+
+
+class RescoreCollectionTests(MongoTestCase):
+    """Similarity scores recomputed with `batch.rescore_collection`"""
+
+    def setUp(self):
+        super().setUp()
+        self.mongo_col_nz.insert_one({'mms_id': 'nz1', 'marc': AutoAcceptTests.get_marc('nz1', 'Le petit prince')})
+
+        briefrec = JsonBriefRec({'marc': AutoAcceptTests.get_marc('local', 'Le petit prince')}).data
+        stale_scores = {'field_scores': {'titles': 1.0}, 'field_scores_candidate': {'mms_id': 'nz9'},
+                        'similarity_scores': {'nz9': {'key': 'x', 'scores': {'titles': 1.0}}}}
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': 'a', 'briefrec': briefrec, 'matched_record': None, 'possible_matches': ['nz1'],
+             'max_match_score': 0.1},
+            {'rec_id': 'b', 'briefrec': briefrec, 'matched_record': None, 'possible_matches': ['nz9'],
+             'max_match_score': 0.9, **stale_scores},
+        ])
+        tools.refresh_match_type('col', self.mongo_db_dedup)
+
+    def test_rescore(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            nb_done = batch.rescore_collection('col', self.mongo_db_dedup, self.mongo_col_nz, executor,
+                                               method=settings.DEDUP_FIELD_SCORES_METHOD)
+
+        self.assertEqual(nb_done, 2)
+        rec = self.mongo_db_dedup['col'].find_one({'rec_id': 'a'})
+        self.assertGreater(rec['max_match_score'], 0.9)
+        self.assertEqual(rec['field_scores_candidate']['mms_id'], 'nz1')
+        self.assertEqual(list(rec['similarity_scores']), ['nz1'])
+        self.assert_stats_consistent('col')
+
+    def test_rescore_without_candidate_found(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            batch.rescore_collection('col', self.mongo_db_dedup, self.mongo_col_nz, executor,
+                                     method=settings.DEDUP_FIELD_SCORES_METHOD)
+
+        rec = self.mongo_db_dedup['col'].find_one({'rec_id': 'b'}, {'_id': False})
+        self.assertEqual({field: rec[field] for field in ['max_match_score', 'similarity_scores', 'field_scores',
+                                                          'field_scores_candidate']},
+                         {'max_match_score': None, 'similarity_scores': {}, 'field_scores': None,
+                          'field_scores_candidate': None})
+        self.assert_stats_consistent('col')
+
+
+class DecisionJournalTests(MongoTestCase):
+    """Exports of the decision journal with watermarks"""
+
+    def write_entry(self, rec_id: str, timestamp: datetime) -> None:
+        """Write the entry of a decision taken at a time"""
+        tools.write_journal_entries(self.mongo_db_dedup, [tools.get_journal_entry('col', rec_id, 'nz1', None, 'human',
+                                                                                  'tester', timestamp)])
+
+    def export(self, since: datetime = None, until: datetime = None) -> list:
+        """Return the rec_id of the exported entries"""
+        return [entry['rec_id'] for entry in tools.iter_journal_entries('col', self.mongo_db_dedup, since, until)]
+
+    def test_watermark_lag(self):
+        with override_settings(DEDUP_JOURNAL_SAFETY_LAG=60):
+            watermark = tools.get_journal_watermark()
+        self.assertAlmostEqual((datetime.now(timezone.utc) - watermark).total_seconds(), 60, delta=5)
+
+    @override_settings(DEDUP_JOURNAL_SAFETY_LAG=0)
+    def test_successive_exports(self):
+        self.write_entry('a', datetime.now(timezone.utc))
+        watermark = tools.get_journal_watermark()
+
+        # A decision taken before the watermark and written after it is exported by the next export
+        time.sleep(0.01)
+        self.write_entry('b', watermark - timedelta(seconds=10))
+        self.write_entry('c', datetime.now(timezone.utc))
+
+        self.assertEqual(self.export(until=watermark), ['a'])
+        self.assertEqual(self.export(since=watermark, until=tools.get_journal_watermark()), ['b', 'c'])
+
+    def test_export_content(self):
+        timestamp = datetime(2024, 1, 31, 22, 0, tzinfo=timezone.utc)
+        self.write_entry('a', timestamp)
+
+        entries = list(tools.iter_journal_entries('col', self.mongo_db_dedup))
+        self.assertEqual(entries, [{'rec_id': 'a', 'matched_record': 'nz1', 'previous_matched_record': None,
+                                    'source': 'human', 'user': 'tester', 'timestamp': timestamp.replace(tzinfo=None)}])
+        self.assertEqual(''.join(tools.iter_journal_export(entries)).splitlines()[1],
+                         '2024-01-31T22:00:00+00:00,a,nz1,,human,tester')
+
+
+class TrainingPairsTests(MongoTestCase):
+    """Pairs added to the training data with `training.add_training_pairs`"""
+
+    def setUp(self):
+        super().setUp()
+        self.mongo_col_nz.insert_many([{'mms_id': 'nz1', 'marc': AutoAcceptTests.get_marc('nz1', 'Le petit prince')},
+                                       {'mms_id': 'nz2', 'marc': AutoAcceptTests.get_marc('nz2', 'Vol de nuit')}])
+
+        marc = AutoAcceptTests.get_marc('local', 'Le petit prince')
+        briefrec = JsonBriefRec({'marc': marc}).data
+        self.mongo_db_dedup['col'].insert_many([
+            {'rec_id': 'a', 'briefrec': briefrec, 'fullrec': marc, 'format': 'book',
+             'possible_matches': ['nz1', 'nz2', 'nz3']},
+            {'rec_id': 'b', 'briefrec': briefrec, 'fullrec': None, 'format': 'book', 'possible_matches': ['nz1']},
+        ])
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_added_and_updated_entries(self):
+        result = training.add_training_pairs('col', self.mongo_db_dedup, self.mongo_col_nz,
+                                             [{'local_recid': 'a', 'ext_nz_recid': 'nz1', 'is_match': True},
+                                              {'local_recid': 'a', 'ext_nz_recid': 'nz2', 'is_match': False}])
+        self.assertEqual(result, {'added': 2, 'updated': 0, 'errors': []})
+
+        entry = self.mongo_db_dedup[tools.TRAINING_DATA_COL].find_one({'match_id': 'a-nz1'})
+        self.assertEqual((entry['is_match'], entry['type'], entry['method']), (True, 'book', 'mean'))
+        self.assertEqual(entry['ext_nz_fullrec']['001'], 'nz1')
+        self.assertGreater(entry['similarity_score'], 0.9)
+        self.assertEqual(set(entry['scores']), set(tools.SCORE_FIELDS))
+
+        # The scores of the pairs are stored in the local record and a new decision replaces the entry
+        self.assertEqual(set(self.mongo_db_dedup['col'].find_one({'rec_id': 'a'})['similarity_scores']),
+                         {'nz1', 'nz2'})
+        result = training.add_training_pairs('col', self.mongo_db_dedup, self.mongo_col_nz,
+                                             [{'local_recid': 'a', 'ext_nz_recid': 'nz1', 'is_match': False}])
+        self.assertEqual(result, {'added': 0, 'updated': 1, 'errors': []})
+        self.assertEqual(self.mongo_db_dedup[tools.TRAINING_DATA_COL].count_documents({}), 2)
+        self.assertFalse(self.mongo_db_dedup[tools.TRAINING_DATA_COL].find_one({'match_id': 'a-nz1'})['is_match'])
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_rejected_pairs(self):
+        result = training.add_training_pairs('col', self.mongo_db_dedup, self.mongo_col_nz,
+                                             [{'local_recid': 'x', 'ext_nz_recid': 'nz1', 'is_match': True},
+                                              {'local_recid': 'b', 'ext_nz_recid': 'nz1', 'is_match': True},
+                                              {'local_recid': 'a', 'ext_nz_recid': 'nz4', 'is_match': True},
+                                              {'local_recid': 'a', 'ext_nz_recid': 'nz3', 'is_match': True},
+                                              {'local_recid': 'a', 'ext_nz_recid': 'nz1', 'is_match': True}])
+
+        self.assertEqual((result['added'], result['updated']), (1, 0))
+        self.assertEqual([(error['local_recid'], error['ext_nz_recid'], error['message']) for error in result['errors']],
+                         [('x', 'nz1', 'Local record not found'),
+                          ('b', 'nz1', 'Local record has no full record'),
+                          ('a', 'nz4', 'External record not found in possible matches'),
+                          ('a', 'nz3', 'External record not found')])
+
+
+class LocalRecordViewsTests(MongoTestCase):
+    """Local records with or without their full records and the full records loaded on demand"""
+
+    def setUp(self):
+        super().setUp()
+        self.mongo_col_nz.insert_one({'mms_id': 'nz1', 'marc': AutoAcceptTests.get_marc('nz1', 'Le petit prince')})
+        marc = AutoAcceptTests.get_marc('local', 'Le petit prince')
+        self.mongo_db_dedup['col'].insert_one({'rec_id': 'a', 'briefrec': JsonBriefRec({'marc': marc}).data,
+                                               'fullrec': marc, 'matched_record': None, 'possible_matches': ['nz1']})
+
+        for name, value in [('mongo_db_dedup', self.mongo_db_dedup), ('mongo_col_nz', self.mongo_col_nz)]:
+            patcher = mock.patch.object(views, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_json(self, view, *args, **params) -> dict:
+        """Return the JSON response of a view to a GET request of a staff user"""
+        request = RequestFactory().get('/', params)
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=True)
+        response = view(request, *args)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_with_full_records(self):
+        rec = self.get_json(views.get_local_rec, 'a', 'col')
+
+        self.assertIn('Le&nbsp;petit&nbsp;prince', rec['fullrec'])
+        self.assertEqual([nz_rec['rec_id'] for nz_rec in rec['possible_matches']], ['nz1'])
+        self.assertIn('<strong>001', rec['possible_matches'][0]['fullrec'])
+
+    @override_settings(DEDUP_SCORING_WORKERS=0)
+    def test_without_full_records(self):
+        find = type(self.mongo_db_dedup['col']).find
+        with mock.patch.object(type(self.mongo_db_dedup['col']), 'find', autospec=True, side_effect=find) as spy:
+            recs = self.get_json(views.get_local_recs, 'col', rec_id=['a', 'x'], fullrec='0')['records']
+
+        self.assertEqual(list(recs), ['a'])
+        self.assertIsNone(recs['a']['fullrec'])
+        self.assertIsNone(recs['a']['possible_matches'][0]['fullrec'])
+        self.assertGreater(recs['a']['possible_matches'][0]['similarity_score'], 0.9)
+
+        # The full local records are not read
+        local_finds = [call for call in spy.call_args_list if call.args[0].name == 'col']
+        self.assertEqual(local_finds[0].args[2], {'_id': False, 'fullrec': False})
+
+    def test_full_records_on_demand(self):
+        self.assertIn('Le&nbsp;petit&nbsp;prince', self.get_json(views.get_local_fullrec, 'col', 'a')['fullrec'])
+        self.assertIn('<strong>001', self.get_json(views.get_nz_fullrec, 'nz1')['fullrec'])
+
+        request = RequestFactory().get('/')
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=True)
+        self.assertEqual(views.get_local_fullrec(request, 'col', 'x').status_code, 404)
+        self.assertEqual(views.get_nz_fullrec(request, 'nz9').status_code, 404)
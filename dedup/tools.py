@@ -7,21 +7,129 @@ Functions:
 - xml_to_json: Converts an XML MARC record to a JSON format.
 - display_briefrec: Transforms a brief record into a displayable format.
 - remove_ns: Removes namespace information from an XML element.
+- remove_ns_from_records: Removes namespace information from a response and returns its records.
+- fetch_nz_records: Fetches several NZ records with one query.
+- iter_local_fullrecs: Iterates the full records of a dedup collection.
+- iter_matched_nz_recs: Iterates the NZ records matched by the records of a dedup collection.
+- iter_marcxml: Serializes records incrementally to a MarcXML collection.
+- iter_matching_rows: Iterates the rows of the export of the records with a match.
+- iter_delimited: Serializes rows incrementally to CSV or TSV.
+- write_xlsx: Writes rows to an Excel file with a constant memory usage.
+- parse_field_scores_filter: Builds the query of a filter on the stored similarity scores of the fields.
+- encode_page_cursor: Builds the opaque cursor of the next page of a list of records.
+- decode_page_cursor: Returns the sort key stored in a cursor.
+- get_page_cursor_query: Returns the condition selecting the records after the sort key of a cursor.
+- is_reserved_col: Checks if a collection of the dedup database is used internally.
+- is_col_allowed: Checks if the user has access to a collection.
+- refresh_match_type: Refreshes the match type of the records of a collection.
+- run_match_type_refresh: Refreshes the match type with only one refresh running by collection.
+- schedule_match_type_refresh: Starts a refresh of the match type in background.
+- is_match_type_refresh_pending: Checks if the match types of a collection are being or must be refreshed.
+- get_filter_keys: Returns the filters of the list of records matching a record.
+- get_stats_delta: Computes the changes of the statistics of a collection caused by updated records.
+- update_collection_stats: Applies changes to the statistics document of a collection.
+- compute_collection_stats: Computes the statistics document of a collection from scratch.
+- get_collection_stats: Returns the statistics document of a collection.
+- get_collections_counts: Returns the already computed numbers of records of several collections.
+- get_journal_entry: Builds an entry of the decision journal.
+- write_journal_entries: Appends entries to the decision journal.
+- get_journal_watermark: Returns the end of the time range of an export of the decision journal.
+- iter_journal_entries: Iterates the entries of the decision journal of a collection in a time range.
+- iter_jsonl: Serializes documents incrementally to JSON Lines.
+- iter_journal_export: Serializes entries of the decision journal incrementally to CSV or JSON Lines.
+- apply_decisions: Sets or cancels the matched record of several records of a collection.
 """
 
+import base64
+import binascii
+import csv
+import gzip
+import html
+import json
 import re
-from typing import Dict, Union
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from io import BytesIO, StringIO
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+import xlsxwriter
 
+from bson import ObjectId, json_util
+from bson.errors import BSONError
 from lxml import etree
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from dedupmarcxml import RawBriefRec, JsonBriefRec, XmlBriefRec
-from collections import Counter
+from django.conf import settings
 from django.http import HttpRequest
 
+# Collection of the dedup database storing the internal state of the app, like
+# the state of the match type refresh of each collection
+META_COL = 'dedup_meta'
+
+# Append-only collection of the dedup database recording the decisions taken on all
+# the collections, used to export only the decisions taken since the previous export
+JOURNAL_COL = 'decision_journal'
+
+# Collection of the dedup database storing the training data of the similarity models
+TRAINING_DATA_COL = 'training_data'
+
+# Collections of the dedup database that are not dedup collections
+RESERVED_COLS = [TRAINING_DATA_COL, META_COL, JOURNAL_COL]
+
+# Field marking records whose match type must be refreshed. Processes loading or
+# updating records outside the app must set it to True, new records included. The
+# incremental refresh only reads the sparse index of this field, records loaded
+# without it get their match type with the next full refresh.
+MATCH_TYPE_DIRTY_FIELD = 'match_type_dirty'
+
+# Field storing the matched record used to compute the match type of a record, None if
+# the record has no match. When the matched record of a dirty record changes, it gives
+# the group the record left, whose other records must be refreshed too.
+MATCH_TYPE_GROUP_FIELD = 'match_type_group'
+
+# Filters of the list of records of a collection. Number of records of each
+# filter is stored in the statistics document of the collection.
+RECORD_FILTERS = {'all': {},
+                  'possible': {'match_type': 'possible_match'},
+                  'possible06': {'match_type': 'possible_match',
+                                 'max_match_score': {'$gt': 0.6}},
+                  'possible05': {'match_type': 'possible_match',
+                                 'max_match_score': {'$gt': 0.5}},
+                  'possible04': {'match_type': 'possible_match',
+                                 'max_match_score': {'$gt': 0.4}},
+                  'nomatch': {'match_type': 'no_match'},
+                  'match': {'match_type': 'match'},
+                  'duplicatematch': {'match_type': 'duplicate_match'},
+                  }
+
+# Number of buckets of the histogram of the 'max_match_score' of the records
+SCORE_HISTOGRAM_BUCKETS = 10
+
+# Field of the dedup documents with the similarity scores of each field of the best candidate,
+# and field with the MMS ID, the similarity score and the method used to choose this candidate
+FIELD_SCORES_FIELD = 'field_scores'
+FIELD_SCORES_CANDIDATE_FIELD = 'field_scores_candidate'
+
+# Fields of the brief records evaluated by `dedupmarcxml.evaluate.evaluate_records_similarity`
+SCORE_FIELDS = ['format', 'titles', 'short_titles', 'creators', 'corp_creators', 'languages', 'publishers',
+                'editions', 'extent', 'years', 'series', 'parent', 'std_nums', 'sys_nums']
+
+# Operators available in the filters on the similarity scores of the fields
+FIELD_SCORES_OPERATORS = {'>': '$gt', '>=': '$gte', '<': '$lt', '<=': '$lte'}
+
 
 def json_to_marc(rec: Dict) -> str:
     """
     Transform a JSON MARC record to an HTML string.
 
+    Tags are ordered before rendering, the leader comes first and fields
+    with the same tag keep their order. The output is built in one pass:
+    the values, the indicators and the codes are escaped once while they are
+    rendered, and spaces are replaced by non-breaking spaces once at the end.
+
     Parameters:
     -----------
     rec : dict
@@ -37,25 +145,34 @@ def json_to_marc(rec: Dict) -> str:
     # is stored in the root of the record.
     data = rec['marc'] if 'marc' in rec else rec
 
-    # We store the displayable data in a list
-    new_data = list()
-    new_data.append(f'<strong>LDR&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>{data["leader"]}')
-    for f_num in data:
+    # Only controlfields and datafields are displayed after the leader
+    tags = sorted((tag for tag in data if tag.startswith('00') or (len(tag) == 3 and tag.isdecimal())), key=int)
+
+    # We store the displayable chunks in a list, each field starts with a line break
+    # The HTML is displayed as is by the frontend, the data of the record is escaped
+    escape = html.escape
+    chunks = [f'<strong>LDR&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>{escape(data["leader"])}']
+    append = chunks.append
+    for tag in tags:
         # Controlfields
-        if f_num.startswith('00'):
-            new_data.append(f'<strong>{f_num}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong> {data[f_num]}')
+        if tag.startswith('00'):
+            append(f'<br><strong>{tag}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong> {escape(data[tag])}')
+            continue
 
         # Datafields
-        elif re.match(r'^\d{3}$', f_num):
-            for field in data[f_num]:
-                # Subfields
-                subfields = ' '.join([[f'<strong>$${f}</strong> {subfield[f]}' for f in subfield][0] for subfield in field["sub"]])
+        for field in data[tag]:
+            append(f'<br><strong>{tag}&nbsp;{escape(field["ind1"])}&nbsp;{escape(field["ind2"])}&nbsp;</strong>')
+            if len(field['sub']) == 0:
+                append(' ')
 
-                new_data.append(f'<strong>{f_num}&nbsp;{field["ind1"]}&nbsp;{field["ind2"]}&nbsp;</strong> {subfields}')
+            # Subfields, only the first code of each subfield is displayed
+            for subfield in field['sub']:
+                for code in subfield:
+                    append(f' <strong>$${escape(code)}</strong> {escape(subfield[code])}')
+                    break
 
-    # At the end we join the data and return it
-    new_data = '<br>'.join(sorted(new_data, key=lambda k: 0 if k.startswith('<strong>LDR') else int(k[8:11])))
-    return new_data.replace(' ', '&nbsp;')
+    # At the end we join the chunks, spaces of the values are replaced only once
+    return ''.join(chunks).replace(' ', '&nbsp;')
 
 
 def json_to_xml(data: dict) -> etree.Element:
@@ -220,6 +337,10 @@ def remove_ns(data: etree.Element) -> etree.Element:
     """
     Remove namespace from XML data.
 
+    The tags of the element and of all its descendants are rewritten in
+    place without namespace, then the unused namespace declarations are
+    removed. The XML is not serialized and parsed again.
+
     Parameters:
     -----------
     data : etree.Element
@@ -228,11 +349,423 @@ def remove_ns(data: etree.Element) -> etree.Element:
     Returns:
     --------
     etree.Element
-        The XML element without namespace information.
+        The same XML element without namespace information.
+    """
+    for element in data.iter():
+        # Comments and processing instructions have no string tag
+        if isinstance(element.tag, str) and element.tag.startswith('{'):
+            element.tag = element.tag.split('}', 1)[1]
+
+    etree.cleanup_namespaces(data)
+    return data
+
+
+def remove_ns_from_records(data: etree.Element, path: str = 'record') -> List[etree.Element]:
+    """
+    Remove namespace from a whole SRU or OAI response and return its records.
+
+    The namespaces of the response are removed in a single walk, see
+    `remove_ns`, the records are then extracted without namespace.
+
+    Parameters:
+    -----------
+    data : etree.Element
+        The XML response containing the records.
+    path : str
+        The path of the records without namespace, for example 'recordData/record'
+        in SRU responses. Default is 'record'.
+
+    Returns:
+    --------
+    list of etree.Element
+        The records without namespace information.
+    """
+    return remove_ns(data).findall(f'.//{path}')
+
+
+# Namespace of the MarcXML collections
+MARC_NS = 'http://www.loc.gov/MARC21/slim'
+
+# Fields of the NZ records required to build brief records and to display
+# the full record. Other fields of the NZ records are not loaded.
+NZ_REC_PROJECTION = {'_id': False, 'mms_id': True, 'marc': True}
+
+
+def fetch_nz_records(mms_ids: List[str], mongo_col_nz: 'pymongo.collection.Collection') -> List[Dict]:
+    """
+    Fetch several NZ records with one query.
+
+    The records are returned in the order of the provided MMS IDs. IDs
+    without corresponding record in the NZ collection are skipped.
+
+    Parameters:
+    -----------
+    mms_ids : list of str
+        MMS IDs of the NZ records to fetch.
+    mongo_col_nz : pymongo.collection.Collection
+        The MongoDB collection containing the NZ records.
+
+    Returns:
+    --------
+    list of dict
+        The NZ records with only the fields defined in `NZ_REC_PROJECTION`.
+    """
+    if len(mms_ids) == 0:
+        return []
+
+    nz_recs = {rec['mms_id']: rec for rec in mongo_col_nz.find({'mms_id': {'$in': list(set(mms_ids))}},
+                                                               NZ_REC_PROJECTION)}
+
+    return [nz_recs[mms_id] for mms_id in mms_ids if mms_id in nz_recs]
+
+
+def iter_local_fullrecs(mongo_col: 'pymongo.collection.Collection', batch_size: int = 500) -> Iterator[Dict]:
+    """
+    Iterate the full records of a dedup collection.
+
+    The collection is read with a cursor, records without full record are
+    skipped.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The dedup collection.
+    batch_size : int
+        Number of records fetched by each round trip of the cursor.
+
+    Returns:
+    --------
+    Iterator[dict]
+        The full records in the format of the NZ records, the MARC data is in the 'marc' key.
+    """
+    for rec in mongo_col.find({}, {'_id': False, 'fullrec': True}, batch_size=batch_size):
+        if rec.get('fullrec'):
+            yield {'marc': rec['fullrec']}
+
+
+def iter_matched_nz_recs(mongo_col: 'pymongo.collection.Collection',
+                         mongo_col_nz: 'pymongo.collection.Collection',
+                         batch_size: int = 500) -> Iterator[Dict]:
+    """
+    Iterate the NZ records matched by the records of a dedup collection.
+
+    The matched records are read with a cursor sorted by `matched_record`, so
+    a NZ record matched by several local records is returned only once without
+    keeping the list of IDs in memory. NZ records are fetched by batches.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The dedup collection.
+    mongo_col_nz : pymongo.collection.Collection
+        The MongoDB collection containing the NZ records.
+    batch_size : int
+        Number of NZ records fetched with each query.
+
+    Returns:
+    --------
+    Iterator[dict]
+        The NZ records.
+    """
+    cursor = mongo_col.find({'matched_record': {'$ne': None}},
+                            {'_id': False, 'matched_record': True},
+                            batch_size=batch_size).sort('matched_record', 1)
+    mms_ids = []
+    for rec in cursor:
+        if len(mms_ids) > 0 and mms_ids[-1] == rec['matched_record']:
+            continue
+        mms_ids.append(rec['matched_record'])
+
+        # Keep the last ID to skip the next duplicates
+        if len(mms_ids) > batch_size:
+            yield from fetch_nz_records(mms_ids[:-1], mongo_col_nz)
+            mms_ids = mms_ids[-1:]
+
+    yield from fetch_nz_records(mms_ids, mongo_col_nz)
+
+
+def iter_marcxml(recs: Iterable[Dict], compress: bool = False, chunk_size: int = 65536) -> Iterator[bytes]:
+    """
+    Serialize records incrementally to a MarcXML collection.
+
+    Records are transformed with `json_to_xml` and written one by one with
+    `etree.xmlfile`. The output is returned by chunks, so memory usage does not
+    depend on the number of records.
+
+    Parameters:
+    -----------
+    recs : Iterable[dict]
+        The JSON records, the MARC data must be in the 'marc' key.
+    compress : bool
+        Whether to compress the output with gzip.
+    chunk_size : int
+        Minimum size of the returned chunks in bytes, the last chunk can be smaller.
+
+    Returns:
+    --------
+    Iterator[bytes]
+        The chunks of the MarcXML collection.
+    """
+    buffer = BytesIO()
+    sink = gzip.GzipFile(fileobj=buffer, mode='wb') if compress is True else buffer
+
+    with etree.xmlfile(sink, encoding='utf-8') as xf:
+        xf.write_declaration()
+
+        # Records without namespace inherit the MARC21 namespace of the collection
+        with xf.element('collection', nsmap={None: MARC_NS}):
+            for rec in recs:
+                xf.write(json_to_xml(rec))
+                if buffer.tell() >= chunk_size:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+
+    if compress is True:
+        sink.close()
+    yield buffer.getvalue()
+
+
+# Columns of the export of the records with a match
+MATCHING_EXPORT_COLUMNS = ['rec_id', 'matched_record', 'match_type']
+
+
+def iter_matching_rows(mongo_col: 'pymongo.collection.Collection', batch_size: int = 500) -> Iterator[List[str]]:
+    """
+    Iterate the rows of the export of the records with a match.
+
+    Matched records and duplicate matches give one row with the matched record,
+    possible matches give one row by candidate. The collection is read with a
+    cursor, see `MATCHING_EXPORT_COLUMNS` for the columns.
+
+    Parameters:
+    -----------
+    mongo_col : pymongo.collection.Collection
+        The dedup collection.
+    batch_size : int
+        Number of records fetched with each batch of the cursor.
+
+    Returns:
+    --------
+    Iterator[list]
+        The rows, without header.
+    """
+    cursor = mongo_col.find({'match_type': {'$in': ['match', 'duplicate_match', 'possible_match']}},
+                            {'_id': False,
+                             'rec_id': True,
+                             'matched_record': True,
+                             'possible_matches': True,
+                             'match_type': True},
+                            batch_size=batch_size)
+    for rec in cursor:
+        if rec['match_type'] in ['match', 'duplicate_match']:
+            yield [rec['rec_id'], rec['matched_record'], rec['match_type']]
+        else:
+            for possible_match in rec.get('possible_matches') or []:
+                yield [rec['rec_id'], possible_match, rec['match_type']]
+
+
+def iter_delimited(rows: Iterable[Sequence], header: Sequence[str], delimiter: str = ',',
+                   chunk_size: int = 65536) -> Iterator[str]:
+    """
+    Serialize rows incrementally to CSV or TSV.
+
+    Parameters:
+    -----------
+    rows : Iterable[Sequence]
+        The rows to serialize.
+    header : Sequence[str]
+        The names of the columns, written in the first row.
+    delimiter : str
+        The delimiter of the fields, ',' for CSV and '\\t' for TSV.
+    chunk_size : int
+        Minimum size of the returned chunks in characters, the last chunk can be smaller.
+
+    Returns:
+    --------
+    Iterator[str]
+        The chunks of the file.
     """
-    temp_data = etree.tostring(data).decode()
-    temp_data = re.sub(r'\s?xmlns="[^"]+"', '', temp_data).encode()
-    return etree.fromstring(temp_data)
+    buffer = StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator='\n')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def write_xlsx(rows: Iterable[Sequence], header: Sequence[str], fileobj: BinaryIO) -> None:
+    """
+    Write rows to an Excel file with a constant memory usage.
+
+    The worksheet is written with the `constant_memory` mode of xlsxwriter: each
+    row is flushed to a temporary file when the next one starts.
+
+    Parameters:
+    -----------
+    rows : Iterable[Sequence]
+        The rows to write.
+    header : Sequence[str]
+        The names of the columns, written in the first row.
+    fileobj : BinaryIO
+        The file receiving the workbook, usually a temporary file.
+    """
+    workbook = xlsxwriter.Workbook(fileobj, {'constant_memory': True, 'in_memory': False})
+    worksheet = workbook.add_worksheet()
+    bold = workbook.add_format({'bold': True})
+    worksheet.write_row(0, 0, header, bold)
+    for row_num, row in enumerate(rows, start=1):
+        worksheet.write_row(row_num, 0, row)
+    workbook.close()
+
+
+def parse_field_scores_filter(scores_filter: str) -> Dict:
+    """
+    Build the query of a filter on the stored similarity scores of the fields.
+
+    The filter is a comma separated list of conditions, for example
+    "titles>0.9,creators<0.3". All conditions must be fulfilled.
+
+    Parameters:
+    -----------
+    scores_filter : str
+        The filter, the fields are listed in `SCORE_FIELDS` and the operators in
+        `FIELD_SCORES_OPERATORS`.
+
+    Returns:
+    --------
+    dict
+        The MongoDB query on `FIELD_SCORES_FIELD`.
+
+    Raises:
+    -------
+    ValueError
+        If a condition is invalid.
+    """
+    query = dict()
+    for condition in scores_filter.split(','):
+        if condition.strip() == '':
+            continue
+        m = re.fullmatch(r'\s*(\w+)\s*([<>]=?)\s*(\d+(?:\.\d+)?|\.\d+)\s*', condition)
+        if m is None or m.group(1) not in SCORE_FIELDS:
+            raise ValueError(f'Invalid condition: {condition}')
+        field, operator, value = m.groups()
+        query.setdefault(f'{FIELD_SCORES_FIELD}.{field}', dict())[FIELD_SCORES_OPERATORS[operator]] = float(value)
+
+    return query
+
+
+def encode_page_cursor(record_filter: str, sort_key: List) -> str:
+    """
+    Build the opaque cursor of the next page of a list of records.
+
+    The cursor contains the filter and the sort key of the last record of the
+    page. BSON types of the sort key, like ObjectId, are kept.
+
+    Parameters:
+    -----------
+    record_filter : str
+        The name of the filter of the list.
+    sort_key : list
+        The values of the sort key of the last record of the page.
+
+    Returns:
+    --------
+    str
+        The URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(json_util.dumps({'f': record_filter, 'k': sort_key}).encode()).decode()
+
+
+def decode_page_cursor(cursor: str, record_filter: str, by_matched_record: bool = False) -> Optional[List]:
+    """
+    Return the sort key stored in a cursor.
+
+    The cursor is sent by the client, the types of the values of the sort key are
+    checked before they are used in a query, see `get_page_cursor_query`.
+
+    Parameters:
+    -----------
+    cursor : str
+        The cursor built by `encode_page_cursor`.
+    record_filter : str
+        The name of the filter of the list, the cursor is ignored if it was built for another filter.
+    by_matched_record : bool
+        Whether the list is sorted by 'matched_record' and '_id'. The key is then the
+        'matched_record', the '_id' and optionally the color of the group of the last
+        record, otherwise only its '_id'.
+
+    Returns:
+    --------
+    list or None
+        The values of the sort key or None if the cursor is invalid.
+    """
+    try:
+        data = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, ValueError, UnicodeDecodeError, BSONError):
+        return None
+
+    if not isinstance(data, dict) or data.get('f') != record_filter or not isinstance(data.get('k'), list):
+        return None
+
+    sort_key = data['k']
+    if by_matched_record is False:
+        valid = len(sort_key) == 1 and isinstance(sort_key[0], ObjectId)
+    else:
+        valid = len(sort_key) in (2, 3) and isinstance(sort_key[0], str) and isinstance(sort_key[1], ObjectId) \
+            and (len(sort_key) == 2 or isinstance(sort_key[2], bool))
+
+    return sort_key if valid is True else None
+
+
+def get_page_cursor_query(sort_key: List, by_matched_record: bool = False) -> Dict:
+    """
+    Return the condition selecting the records after the sort key of a cursor.
+
+    Parameters:
+    -----------
+    sort_key : list
+        The sort key returned by `decode_page_cursor`: the '_id' of the last record or,
+        for a list sorted by matched record, its 'matched_record' and its '_id'. The color
+        of the key is ignored.
+    by_matched_record : bool
+        Whether the list is sorted by 'matched_record' and '_id'.
+
+    Returns:
+    --------
+    dict
+        The MongoDB query of the records of the next pages.
+    """
+    if by_matched_record is False:
+        return {'_id': {'$gt': sort_key[0]}}
+
+    # Next records of the same matched record and records of the next matched records
+    return {'$or': [{'matched_record': {'$gt': sort_key[0]}},
+                    {'matched_record': sort_key[0], '_id': {'$gt': sort_key[1]}}]}
+
+
+def is_reserved_col(col_name: str) -> bool:
+    """Check if a collection of the dedup database is used internally
+
+    NZ collections, training data and collections storing the state of the
+    app are not dedup collections.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection to check.
+
+    Returns:
+    --------
+    bool
+        True if the collection is not a dedup collection.
+    """
+    return col_name.startswith('NZ_') is True or col_name in RESERVED_COLS
 
 
 def is_col_allowed(col_name: str, request: HttpRequest) -> bool:
@@ -252,8 +785,8 @@ def is_col_allowed(col_name: str, request: HttpRequest) -> bool:
         True if the user has access to the collection, False otherwise.
     """
 
-    # If the collection name starts with 'NZ_' or is 'training_data', access is denied
-    if col_name.startswith('NZ_') is True or col_name == 'training_data':
+    # If the collection name starts with 'NZ_' or is used internally, access is denied
+    if is_reserved_col(col_name) is True:
         return False
 
     if request.user.is_staff:
@@ -266,46 +799,745 @@ def is_col_allowed(col_name: str, request: HttpRequest) -> bool:
     return False
 
 
-def split_unique_and_duplicates(lst):
-    counts = Counter(lst)
-    uniques = [x for x, c in counts.items() if c == 1]
-    non_uniques = [x for x, c in counts.items() if c > 1]
-    return uniques, non_uniques
+def _get_match_type_merge_stages(col_name: str) -> List[Dict]:
+    """Return the stages writing the match type of records grouped by matched record
 
+    The input documents have the matched record as `_id` and the list of the records
+    with this matched record in `recs`, with their `_id`, `match_type` and group.
+    """
+    return [
+        # Several records with the same matched record are duplicate matches
+        {'$set': {'new_match_type': {'$cond': [{'$gt': [{'$size': '$recs'}, 1]}, 'duplicate_match', 'match']}}},
+
+        # One document per record, only records whose match type or group changed are kept
+        {'$unwind': '$recs'},
+        {'$match': {'$expr': {'$or': [{'$ne': ['$recs.match_type', '$new_match_type']},
+                                      {'$ne': [f'$recs.{MATCH_TYPE_GROUP_FIELD}', '$_id']}]}}},
+        {'$project': {'_id': '$recs._id', 'match_type': '$new_match_type', MATCH_TYPE_GROUP_FIELD: '$_id'}},
+
+        # Write the new match types in the collection
+        {'$merge': {'into': col_name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ]
 
-def refresh_match_type(col_name: str, mongo_db_dedup: 'pymongo.database.Database') -> None:
+
+def refresh_match_type(col_name: str, mongo_db_dedup: 'pymongo.database.Database', incremental: bool = False) -> None:
     """Refresh the match type of records for a collection
 
     This view is an API that can be used to refresh the match type of records for a collection.
     It will update the match type of records based on the current state of the matched_record and possible_matches fields.
 
+    The whole classification is done by MongoDB, no list of records is loaded in the Django process.
+    Records with a match are grouped by matched record, the new match type of the records
+    whose match type changed is written back with `$merge`. The matched record used to compute
+    the match type is stored in `MATCH_TYPE_GROUP_FIELD`.
+
+    The records marked with `MATCH_TYPE_DIRTY_FIELD` are first claimed with an ID of the run,
+    the mark is removed at the end. Records marked during the refresh are kept for the next one.
+    With `incremental`, only the claimed records are refreshed, with the records of their
+    current group and of the group they left.
+
+    The statistics document of the collection is updated with the changes of the
+    refreshed records, a full refresh computes it from scratch.
+
         Parameters:
         -----------
         col_name : str
             The name of the collection for which to refresh the match type.
         mongo_db_dedup : pymongo.database.Database
             The MongoDB database containing the deduplication collections.
+        incremental : bool
+            Whether to refresh only the records touched since the last refresh.
     """
+    run_id = str(ObjectId())
+    scope = {MATCH_TYPE_DIRTY_FIELD: run_id}
+    if incremental is True:
+        result = mongo_db_dedup[col_name].update_many({MATCH_TYPE_DIRTY_FIELD: True}, {'$set': scope})
+        if result.modified_count == 0:
+            return
+
+        # Groups whose match types can change: the current and the previous groups of the claimed records
+        groups = set(mongo_db_dedup[col_name].distinct('matched_record', {'matched_record': {'$ne': None}, **scope}))
+        groups.update(mongo_db_dedup[col_name].distinct(MATCH_TYPE_GROUP_FIELD,
+                                                        {MATCH_TYPE_GROUP_FIELD: {'$ne': None}, **scope}))
+        groups = list(groups)
+
+        # Records whose match type can change: the claimed records and the records of these groups.
+        # Claimed records without match type are new and not counted yet.
+        touched_query = {'$or': [scope, {'matched_record': {'$in': groups}}]}
+        stats_before = _count_stats(col_name, mongo_db_dedup, {**touched_query, 'match_type': {'$exists': True}})
+    else:
+        # All the marks are claimed, including the ones left by an interrupted refresh
+        mongo_db_dedup[col_name].update_many({MATCH_TYPE_DIRTY_FIELD: {'$exists': True}}, {'$set': scope})
+
+    # Scope of the records without match
+    no_match_scope = scope if incremental is True else dict()
+
     # possible matches
-    query = {'possible_matches.0': {'$exists': 1}, 'matched_record': None, 'human_validated': {'$ne': True}}
-    update = {"$set": {'match_type': 'possible_match'}}
+    query = {'possible_matches.0': {'$exists': 1}, 'matched_record': None, 'human_validated': {'$ne': True},
+             '$or': [{'match_type': {'$ne': 'possible_match'}}, {MATCH_TYPE_GROUP_FIELD: {'$ne': None}}],
+             **no_match_scope}
+    update = {"$set": {'match_type': 'possible_match', MATCH_TYPE_GROUP_FIELD: None}}
     mongo_db_dedup[col_name].update_many(query, update)
 
     # No matches
-    query = {'possible_matches.0': {'$exists': 0}, 'matched_record': None, 'human_validated': {'$ne': True}}
-    update = {"$set": {'match_type': 'no_match'}}
+    query = {'possible_matches.0': {'$exists': 0}, 'matched_record': None, 'human_validated': {'$ne': True},
+             '$or': [{'match_type': {'$ne': 'no_match'}}, {MATCH_TYPE_GROUP_FIELD: {'$ne': None}}],
+             **no_match_scope}
+    update = {"$set": {'match_type': 'no_match', MATCH_TYPE_GROUP_FIELD: None}}
     mongo_db_dedup[col_name].update_many(query, update)
 
     # matches and multi_matches
-    query = {'matched_record': {'$ne': None}}
-    project = {'matched_record': 1, '_id': 0}
-    matched_ids = [recid['matched_record'] for recid in mongo_db_dedup[col_name].find(query, project)]
+    pipeline = [
+        # 1. Records with a matched record, in incremental mode only the records of the touched groups
+        {'$match': {'matched_record': {'$in': groups}} if incremental is True else {'matched_record': {'$ne': None}}},
 
-    matched_unique, matched_duplicate = split_unique_and_duplicates(matched_ids)
+        # 2. Group records by matched record, only IDs, current match types and groups are kept
+        {'$group': {'_id': '$matched_record',
+                    'recs': {'$push': {'_id': '$_id',
+                                       'match_type': {'$ifNull': ['$match_type', None]},
+                                       MATCH_TYPE_GROUP_FIELD: {'$ifNull': [f'${MATCH_TYPE_GROUP_FIELD}', None]}}}}}
+    ]
+    mongo_db_dedup[col_name].aggregate(pipeline + _get_match_type_merge_stages(col_name), allowDiskUse=True)
 
-    query = {"matched_record": {"$in": matched_unique}}
-    update = {"$set": {'match_type': 'match'}}
-    mongo_db_dedup[col_name].update_many(query, update)
-    query = {"matched_record": {"$in": matched_duplicate}}
-    update = {"$set": {'match_type': 'duplicate_match'}}
-    mongo_db_dedup[col_name].update_many(query, update)
+    if incremental is True:
+        stats_after = _count_stats(col_name, mongo_db_dedup, touched_query)
+        update_collection_stats(col_name, mongo_db_dedup, _diff_stats(stats_before, stats_after))
+    else:
+        compute_collection_stats(col_name, mongo_db_dedup)
+
+    mongo_db_dedup[col_name].update_many(scope, {'$unset': {MATCH_TYPE_DIRTY_FIELD: ''}})
+
+
+def _acquire_refresh_lease(col_name: str, mongo_db_dedup: 'pymongo.database.Database') -> Optional[str]:
+    """Acquire the lease to refresh the match type of a collection
+
+    The lease is stored in the meta collection, so only one refresh of a
+    collection runs at a time across all the processes of the app. An expired
+    lease can be taken over.
+
+    Returns:
+    --------
+    str or None
+        The token of the lease or None if another refresh is running.
+    """
+    now = datetime.now(timezone.utc)
+    token = str(ObjectId())
+    try:
+        mongo_db_dedup[META_COL].update_one(
+            {'_id': f'refresh_match_type:{col_name}', 'lease_until': {'$not': {'$gt': now}}},
+            {'$set': {'lease_until': now + timedelta(seconds=settings.DEDUP_MATCH_TYPE_REFRESH_LEASE),
+                      'lease_token': token}},
+            upsert=True)
+    except DuplicateKeyError:
+        # The document exists with a valid lease
+        return None
+    return token
+
+
+def _release_refresh_lease(col_name: str, mongo_db_dedup: 'pymongo.database.Database', token: str) -> None:
+    """Release the lease to refresh the match type of a collection and save the time of the refresh"""
+    now = datetime.now(timezone.utc)
+    mongo_db_dedup[META_COL].update_one({'_id': f'refresh_match_type:{col_name}', 'lease_token': token},
+                                        {'$set': {'lease_until': now, 'last_refresh': now},
+                                         '$unset': {'lease_token': ''}})
+
+
+def _run_leased_refresh(col_name: str,
+                        mongo_db_dedup: 'pymongo.database.Database',
+                        token: str,
+                        full: bool = False) -> None:
+    """Refresh the match type of a collection with an acquired lease and release it
+
+    The first refresh of a collection is a full refresh, next ones are incremental
+    unless `full` is True.
+    """
+    try:
+        state = mongo_db_dedup[META_COL].find_one({'_id': f'refresh_match_type:{col_name}'}, {'last_refresh': True})
+        refresh_match_type(col_name, mongo_db_dedup, incremental=full is False and 'last_refresh' in state)
+    finally:
+        _release_refresh_lease(col_name, mongo_db_dedup, token)
+
+
+def run_match_type_refresh(col_name: str,
+                           mongo_db_dedup: 'pymongo.database.Database',
+                           wait: bool = True,
+                           full: bool = False) -> bool:
+    """Refresh the match type of a collection, only one refresh runs by collection
+
+    The first refresh of a collection is a full refresh, next ones are incremental.
+    If another refresh of the collection is running, no new refresh is started.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection for which to refresh the match type.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    wait : bool
+        Whether to wait for the end of the refresh running in another request.
+    full : bool
+        Whether to refresh all the records of the collection.
+
+    Returns:
+    --------
+    bool
+        True if the refresh has been run by this call.
+    """
+    token = _acquire_refresh_lease(col_name, mongo_db_dedup)
+
+    if token is None:
+        # Wait until the running refresh releases or loses its lease
+        deadline = time.monotonic() + settings.DEDUP_MATCH_TYPE_REFRESH_LEASE
+        while wait is True and time.monotonic() < deadline:
+            running = mongo_db_dedup[META_COL].find_one({'_id': f'refresh_match_type:{col_name}',
+                                                         'lease_until': {'$gt': datetime.now(timezone.utc)}})
+            if running is None:
+                break
+            time.sleep(0.5)
+        return False
+
+    _run_leased_refresh(col_name, mongo_db_dedup, token, full)
+    return True
+
+
+def schedule_match_type_refresh(col_name: str, mongo_db_dedup: 'pymongo.database.Database') -> None:
+    """Start a refresh of the match type of a collection in background
+
+    The refresh runs in a thread, see `run_match_type_refresh`. Nothing is
+    started if a refresh of the collection is already running.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection for which to refresh the match type.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    """
+    token = _acquire_refresh_lease(col_name, mongo_db_dedup)
+    if token is None:
+        return
+
+    threading.Thread(target=_run_leased_refresh,
+                     args=(col_name, mongo_db_dedup, token),
+                     name=f'refresh_match_type_{col_name}',
+                     daemon=True).start()
+
+
+def is_match_type_refresh_pending(col_name: str, mongo_db_dedup: 'pymongo.database.Database') -> bool:
+    """Check if the match types of a collection are being or must be refreshed
+
+    The refresh is pending if a refresh is running, if the collection has never been
+    refreshed or if records are marked as dirty.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+
+    Returns:
+    --------
+    bool
+        True if the match types of some records may be outdated.
+    """
+    state = mongo_db_dedup[META_COL].find_one({'_id': f'refresh_match_type:{col_name}'},
+                                              {'last_refresh': True, 'lease_until': True})
+    if state is None or 'last_refresh' not in state:
+        return True
+
+    lease_until = state.get('lease_until')
+    if lease_until is not None and lease_until.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc):
+        return True
+
+    return mongo_db_dedup[col_name].find_one({MATCH_TYPE_DIRTY_FIELD: True}, {'_id': True}) is not None
+
+
+def _get_stats_id(col_name: str) -> str:
+    """Return the ID of the statistics document of a collection in the meta collection"""
+    return f'stats:{col_name}'
+
+
+def _get_score_bucket(score: Optional[float]) -> Optional[int]:
+    """Return the bucket of the score histogram of a 'max_match_score', None if the score is missing"""
+    if not isinstance(score, (int, float)) or isinstance(score, bool):
+        return None
+    return min(max(int(score * SCORE_HISTOGRAM_BUCKETS), 0), SCORE_HISTOGRAM_BUCKETS - 1)
+
+
+def get_filter_keys(rec: Dict) -> List[str]:
+    """
+    Return the filters of the list of records matching a record.
+
+    The conditions of `RECORD_FILTERS` are evaluated on the record, they only use
+    equality and `$gt`.
+
+    Parameters:
+    -----------
+    rec : dict
+        The record with at least the 'match_type' and 'max_match_score' fields.
+
+    Returns:
+    --------
+    list
+        The keys of `RECORD_FILTERS` matching the record.
+    """
+    filter_keys = []
+    for filter_key, query in RECORD_FILTERS.items():
+        for field, condition in query.items():
+            value = rec.get(field)
+            if isinstance(condition, dict):
+                if not isinstance(value, (int, float)) or not value > condition['$gt']:
+                    break
+            elif value != condition:
+                break
+        else:
+            filter_keys.append(filter_key)
+
+    return filter_keys
+
+
+def get_stats_delta(old_recs: Iterable[Optional[Dict]], new_recs: Iterable[Optional[Dict]]) -> Dict[str, int]:
+    """
+    Compute the changes of the statistics of a collection caused by updated records.
+
+    Parameters:
+    -----------
+    old_recs : iterable of dict
+        The records before the update, None for new records.
+    new_recs : iterable of dict
+        The same records after the update, None for deleted records.
+
+    Returns:
+    --------
+    dict
+        The `$inc` update of the statistics document, without the unchanged fields.
+    """
+    delta = Counter()
+    for recs, sign in [(old_recs, -1), (new_recs, 1)]:
+        for rec in recs:
+            if rec is None:
+                continue
+            for filter_key in get_filter_keys(rec):
+                delta[f'counts.{filter_key}'] += sign
+            bucket = _get_score_bucket(rec.get('max_match_score'))
+            if bucket is not None:
+                delta[f'score_histogram.{bucket}'] += sign
+
+    return {field: value for field, value in delta.items() if value != 0}
+
+
+def update_collection_stats(col_name: str, mongo_db_dedup: 'pymongo.database.Database', delta: Dict[str, int]) -> None:
+    """
+    Apply changes to the statistics document of a collection.
+
+    Nothing is done if the document does not exist yet, it is computed from
+    scratch when it is read for the first time.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    delta : dict
+        The `$inc` update built with `get_stats_delta`.
+    """
+    if len(delta) == 0:
+        return
+
+    mongo_db_dedup[META_COL].update_one({'_id': _get_stats_id(col_name)},
+                                        {'$inc': delta,
+                                         '$set': {'updated': datetime.now(timezone.utc)}})
+
+
+def _count_stats(col_name: str, mongo_db_dedup: 'pymongo.database.Database', query: Dict) -> Dict[str, Dict]:
+    """Count the records of each filter and of each bucket of the score histogram with one aggregation"""
+    facets = {filter_key: [{'$match': filter_query}, {'$count': 'n'}]
+              for filter_key, filter_query in RECORD_FILTERS.items()}
+    facets['score_histogram'] = [
+        {'$match': {'max_match_score': {'$type': 'number'}}},
+        {'$group': {'_id': {'$min': [{'$max': [{'$floor': {'$multiply': ['$max_match_score',
+                                                                             SCORE_HISTOGRAM_BUCKETS]}}, 0]},
+                                     SCORE_HISTOGRAM_BUCKETS - 1]},
+                    'n': {'$sum': 1}}}
+    ]
+    result = next(mongo_db_dedup[col_name].aggregate([{'$match': query}, {'$facet': facets}], allowDiskUse=True))
+
+    return {'counts': {filter_key: result[filter_key][0]['n'] if result[filter_key] else 0
+                       for filter_key in RECORD_FILTERS},
+            'score_histogram': {str(bucket): 0 for bucket in range(SCORE_HISTOGRAM_BUCKETS)} |
+                               {str(int(b['_id'])): b['n'] for b in result['score_histogram']}}
+
+
+def _diff_stats(stats_before: Dict[str, Dict], stats_after: Dict[str, Dict]) -> Dict[str, int]:
+    """Return the `$inc` update between two results of `_count_stats`"""
+    delta = {f'{part}.{key}': stats_after[part][key] - stats_before[part][key]
+             for part in ['counts', 'score_histogram'] for key in stats_after[part]}
+    return {field: value for field, value in delta.items() if value != 0}
+
+
+def compute_collection_stats(col_name: str, mongo_db_dedup: 'pymongo.database.Database') -> Dict:
+    """
+    Compute the statistics document of a collection from scratch.
+
+    The document contains the number of records of each filter of `RECORD_FILTERS`
+    in 'counts' and the number of records by bucket of 'max_match_score' in
+    'score_histogram'. It is saved in the meta collection.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+
+    Returns:
+    --------
+    dict
+        The statistics document.
+    """
+    stats = {'_id': _get_stats_id(col_name),
+             **_count_stats(col_name, mongo_db_dedup, {}),
+             'updated': datetime.now(timezone.utc)}
+    mongo_db_dedup[META_COL].replace_one({'_id': stats['_id']}, stats, upsert=True)
+
+    return stats
+
+
+def get_collection_stats(col_name: str, mongo_db_dedup: 'pymongo.database.Database') -> Dict:
+    """
+    Return the statistics document of a collection.
+
+    The document is computed if it does not exist yet, see `compute_collection_stats`.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+
+    Returns:
+    --------
+    dict
+        The statistics document.
+    """
+    stats = mongo_db_dedup[META_COL].find_one({'_id': _get_stats_id(col_name)})
+    if stats is None:
+        stats = compute_collection_stats(col_name, mongo_db_dedup)
+
+    return stats
+
+
+def get_collections_counts(col_names: List[str], mongo_db_dedup: 'pymongo.database.Database') -> Dict[str, Dict]:
+    """
+    Return the already computed numbers of records of several collections.
+
+    The statistics documents are read with one query, missing documents are not computed.
+
+    Parameters:
+    -----------
+    col_names : list of str
+        The names of the collections.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+
+    Returns:
+    --------
+    dict
+        The number of records of each filter, key is the name of the collection.
+    """
+    stats_ids = {_get_stats_id(col_name): col_name for col_name in col_names}
+
+    return {stats_ids[stats['_id']]: stats['counts']
+            for stats in mongo_db_dedup[META_COL].find({'_id': {'$in': list(stats_ids)}}, {'counts': True})}
+
+
+# Field of the entries of the decision journal with the time they are written, used by the exports
+JOURNAL_WRITTEN_FIELD = 'written'
+
+# Columns of the export of the decision journal
+JOURNAL_EXPORT_COLUMNS = ['timestamp', 'rec_id', 'matched_record', 'previous_matched_record', 'source', 'user']
+
+
+def get_journal_entry(col_name: str,
+                      rec_id: str,
+                      matched_record: Optional[str],
+                      previous_matched_record: Optional[str],
+                      source: str,
+                      user: Optional[str],
+                      timestamp: datetime) -> Dict:
+    """
+    Build an entry of the decision journal.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection of the record.
+    rec_id : str
+        The record ID of the decided record.
+    matched_record : str, optional
+        The new matched record, None if the match is cancelled.
+    previous_matched_record : str, optional
+        The matched record before the decision.
+    source : str
+        The origin of the decision: 'human' or 'auto_accept'.
+    user : str, optional
+        The username of the user who took or started the decision.
+    timestamp : datetime
+        The time of the decision.
+
+    Returns:
+    --------
+    dict
+        The entry to insert in `JOURNAL_COL`.
+    """
+    return {'col_name': col_name,
+            'rec_id': rec_id,
+            'matched_record': matched_record,
+            'previous_matched_record': previous_matched_record,
+            'source': source,
+            'user': user,
+            'timestamp': timestamp}
+
+
+def write_journal_entries(mongo_db_dedup: 'pymongo.database.Database', entries: List[Dict]) -> None:
+    """
+    Append entries to the decision journal.
+
+    The entries are stamped with the time of the write in `JOURNAL_WRITTEN_FIELD`,
+    the exports select the entries with it, see `get_journal_watermark`.
+
+    Parameters:
+    -----------
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    entries : list of dict
+        The entries built by `get_journal_entry`.
+    """
+    if len(entries) > 0:
+        now = datetime.now(timezone.utc)
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        mongo_db_dedup[JOURNAL_COL].insert_many([{**entry, JOURNAL_WRITTEN_FIELD: now} for entry in entries],
+                                                ordered=False)
+
+
+def get_journal_watermark() -> datetime:
+    """
+    Return the end of the time range of an export of the decision journal.
+
+    An entry is stamped before it is inserted, so an entry with an older stamp can
+    appear after an export. The watermark is `DEDUP_JOURNAL_SAFETY_LAG` seconds in
+    the past: the entries stamped after it are returned by the next export.
+
+    Returns:
+    --------
+    datetime
+        The watermark, with the precision of a millisecond of the dates of MongoDB.
+    """
+    until = datetime.now(timezone.utc) - timedelta(seconds=settings.DEDUP_JOURNAL_SAFETY_LAG)
+    return until.replace(microsecond=until.microsecond // 1000 * 1000)
+
+
+def iter_journal_entries(col_name: str,
+                         mongo_db_dedup: 'pymongo.database.Database',
+                         since: Optional[datetime] = None,
+                         until: Optional[datetime] = None,
+                         batch_size: int = 500) -> Iterator[Dict]:
+    """
+    Iterate the entries of the decision journal of a collection in a time range.
+
+    The range applies to the time the entries are written, `JOURNAL_WRITTEN_FIELD`.
+    Entries are returned in the order they are written, the last entry of a record
+    is its current decision. An export from `since` to `until` followed by an export
+    from `until` returns each entry once if `until` is a watermark returned by
+    `get_journal_watermark`.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    since : datetime, optional
+        Only the entries written after this time are returned.
+    until : datetime, optional
+        Only the entries written before this time or at this time are returned.
+    batch_size : int
+        Number of entries fetched with each batch of the cursor.
+
+    Returns:
+    --------
+    Iterator[dict]
+        The entries, without '_id', 'col_name' and `JOURNAL_WRITTEN_FIELD`.
+    """
+    query = {'col_name': col_name}
+    if since is not None or until is not None:
+        query[JOURNAL_WRITTEN_FIELD] = dict()
+    if since is not None:
+        query[JOURNAL_WRITTEN_FIELD]['$gt'] = since
+    if until is not None:
+        query[JOURNAL_WRITTEN_FIELD]['$lte'] = until
+
+    yield from mongo_db_dedup[JOURNAL_COL].find(query,
+                                                {'_id': False, 'col_name': False, JOURNAL_WRITTEN_FIELD: False},
+                                                batch_size=batch_size).sort([(JOURNAL_WRITTEN_FIELD, 1), ('_id', 1)])
+
+
+def iter_jsonl(docs: Iterable[Dict], chunk_size: int = 65536) -> Iterator[str]:
+    """
+    Serialize documents incrementally to JSON Lines.
+
+    Dates are written in ISO 8601 format.
+
+    Parameters:
+    -----------
+    docs : Iterable[dict]
+        The documents to serialize.
+    chunk_size : int
+        Minimum size of the returned chunks in characters, the last chunk can be smaller.
+
+    Returns:
+    --------
+    Iterator[str]
+        The chunks of the file.
+    """
+    buffer = StringIO()
+    for doc in docs:
+        buffer.write(json.dumps(doc, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)))
+        buffer.write('\n')
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def iter_journal_export(entries: Iterable[Dict], export_format: str = 'csv') -> Iterator[str]:
+    """
+    Serialize entries of the decision journal incrementally to CSV or JSON Lines.
+
+    Timestamps are written in ISO 8601 format in UTC.
+
+    Parameters:
+    -----------
+    entries : Iterable[dict]
+        The entries returned by `iter_journal_entries`.
+    export_format : str
+        'csv' or 'jsonl'.
+
+    Returns:
+    --------
+    Iterator[str]
+        The chunks of the file.
+    """
+    # Dates read from MongoDB are naive UTC dates
+    entries = ({**entry, 'timestamp': entry['timestamp'].replace(tzinfo=timezone.utc).isoformat()}
+               for entry in entries)
+    if export_format == 'jsonl':
+        return iter_jsonl(entries)
+
+    return iter_delimited(([entry.get(column) for column in JOURNAL_EXPORT_COLUMNS] for entry in entries),
+                          JOURNAL_EXPORT_COLUMNS)
+
+
+def apply_decisions(col_name: str,
+                    mongo_db_dedup: 'pymongo.database.Database',
+                    decisions: Dict[str, Optional[str]],
+                    validation_fields: Optional[Dict] = None,
+                    user: Optional[str] = None,
+                    source: str = 'human') -> Dict:
+    """
+    Set or cancel the matched record of several records of a collection.
+
+    The decided records are updated with one `bulk_write`, they get the 'match' or
+    'no_match' match type. Then the records sharing an old or a new matched record
+    of the decided records are fetched with one query and their match type is
+    recomputed once for each matched record with one `bulk_write`: 'duplicate_match'
+    if several records have the same matched record, 'match' otherwise. The changes are applied to the
+    statistics document of the collection and the decisions to the decision journal.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    decisions : dict
+        The new matched record of each record, key is the rec_id. None cancels the match.
+    validation_fields : dict, optional
+        Fields set on the decided records to record the origin of the decision,
+        by default `{'human_validated': True}`.
+    user : str, optional
+        The username recorded in the decision journal.
+    source : str
+        The origin of the decision recorded in the decision journal.
+
+    Returns:
+    --------
+    dict
+        The number of updated records in 'updated' and the record IDs not found in the
+        collection in 'not_found'.
+    """
+    if validation_fields is None:
+        validation_fields = {'human_validated': True}
+
+    # State of the records before the update and after it, key is rec_id, used to update the statistics
+    stats_fields = {'_id': False, 'rec_id': True, 'match_type': True, 'max_match_score': True, 'matched_record': True}
+    old_recs = {rec['rec_id']: rec for rec in mongo_db_dedup[col_name].find({'rec_id': {'$in': list(decisions)}},
+                                                                            stats_fields)}
+    new_recs = dict()
+
+    # Matched records whose number of records can change: old and new matched records
+    matched_records_to_check = set()
+    requests = []
+    journal_entries = []
+    now = datetime.now(timezone.utc)
+    for rec_id, matched_record in decisions.items():
+        if rec_id not in old_recs:
+            continue
+        if old_recs[rec_id].get('matched_record') is not None:
+            matched_records_to_check.add(old_recs[rec_id]['matched_record'])
+
+        match_type = 'no_match' if matched_record is None else 'match'
+        if matched_record is not None:
+            matched_records_to_check.add(matched_record)
+        requests.append(UpdateOne({'rec_id': rec_id},
+                                  {'$set': {'matched_record': matched_record,
+                                            'match_type': match_type,
+                                            MATCH_TYPE_GROUP_FIELD: matched_record,
+                                            **validation_fields}}))
+        new_recs[rec_id] = {**old_recs[rec_id], 'matched_record': matched_record, 'match_type': match_type}
+        journal_entries.append(get_journal_entry(col_name, rec_id, matched_record,
+                                                 old_recs[rec_id].get('matched_record'), source, user, now))
+
+    if len(requests) > 0:
+        mongo_db_dedup[col_name].bulk_write(requests, ordered=False)
+    write_journal_entries(mongo_db_dedup, journal_entries)
+
+    # Number of records by matched record decides if we have a duplicate match or not
+    groups = dict()
+    for rec in mongo_db_dedup[col_name].find({'matched_record': {'$in': list(matched_records_to_check)}},
+                                             stats_fields):
+        groups.setdefault(rec['matched_record'], []).append(rec)
+
+    group_requests = []
+    for group, recs in groups.items():
+        match_type = 'duplicate_match' if len(recs) > 1 else 'match'
+        for rec in recs:
+            old_recs.setdefault(rec['rec_id'], rec)
+            new_recs[rec['rec_id']] = {**rec, 'match_type': match_type}
+        group_requests.append(UpdateMany({'rec_id': {'$in': [rec['rec_id'] for rec in recs]},
+                                          '$or': [{'match_type': {'$ne': match_type}},
+                                                  {MATCH_TYPE_GROUP_FIELD: {'$ne': group}}]},
+                                         {'$set': {'match_type': match_type, MATCH_TYPE_GROUP_FIELD: group}}))
+
+    if len(group_requests) > 0:
+        mongo_db_dedup[col_name].bulk_write(group_requests, ordered=False)
+
+    update_collection_stats(col_name, mongo_db_dedup,
+                            get_stats_delta([old_recs[rec_id] for rec_id in new_recs], new_recs.values()))
+
+    return {'updated': len(requests), 'not_found': [rec_id for rec_id in decisions if rec_id not in old_recs]}
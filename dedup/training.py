@@ -0,0 +1,813 @@
+"""
+This module builds and exports the training data of the similarity models.
+
+Each entry of the training data collection is a pair of a local record and a NZ
+record with the decision of the user, the similarity scores of the fields and the
+similarity score. Entries are identified by their 'match_id', adding a pair again
+replaces its entry. The scores of the fields are computed like the scores of the
+candidates in the app, from the stored brief record of the local record, so the
+learned models are trained on the same features as the ones they get in the app.
+
+Functions:
+- get_match_id: Returns the ID of the training data entry of a pair of records.
+- add_training_pairs: Adds or replaces several pairs of records in the training data.
+- iter_training_data: Iterates the entries of the training data.
+- write_training_parquet: Writes entries of the training data to a Parquet file.
+- get_training_set_versions: Returns the version of each entry of the training data.
+- get_training_set_hash: Returns the hash identifying the features of a training set.
+- compute_features_chunk: Computes the feature rows of a chunk of entries, runs in a worker process.
+- build_training_features: Computes the feature matrix of the training data, reusing a previous matrix.
+- find_training_features: Returns the paths of the most recent feature matrix of a directory.
+- load_training_features: Loads a feature matrix and its metadata.
+- train_model: Trains a model predicting the probability of a match from a feature matrix.
+- save_model: Saves a trained model with a versioned name.
+- load_training_scores: Loads the stored similarity scores of the fields and the labels of the training data.
+- evaluate_scores: Computes the precision, recall, F1 and confusion matrix of methods at several thresholds.
+- get_filter_thresholds: Returns the thresholds of 'max_match_score' used by the filters of the list of records.
+- get_evaluation: Returns the evaluation of the scoring methods on the training data, cached by training set.
+"""
+
+import glob
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import Executor
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import joblib
+import numpy as np
+from dedupmarcxml.briefrecord import JsonBriefRec, RawBriefRec
+from pymongo import ReplaceOne, UpdateOne
+
+from . import scoring
+from . import tools
+
+# Number of entries of each row group of the Parquet export
+PARQUET_ROW_GROUP_SIZE = 1000
+
+# Prefix of the files of the feature matrices: '<prefix><hash>.npy' contains the matrix,
+# one row by entry and one column by field of `tools.SCORE_FIELDS`, '<prefix><hash>.npz'
+# contains the metadata of the rows
+FEATURES_PREFIX = 'training_features_'
+
+# Version of the computation of the features, matrices of other versions are not reused,
+# see `scoring.FEATURES_VERSION`
+FEATURES_VERSION = scoring.FEATURES_VERSION
+
+# Algorithms available to train a model, see `train_model`
+MODEL_ALGORITHMS = ['logistic_regression', 'gradient_boosting']
+
+# Thresholds of the similarity score evaluated by default by `get_evaluation`
+EVALUATION_THRESHOLDS = np.round(np.linspace(0, 1, 101), 2)
+
+
+def get_match_id(rec_id: str, mms_id: str) -> str:
+    """Return the ID of the training data entry of a pair of records"""
+    return f'{rec_id}-{mms_id}'
+
+
+def add_training_pairs(col_name: str,
+                       mongo_db_dedup: 'pymongo.database.Database',
+                       mongo_col_nz: 'pymongo.collection.Collection',
+                       pairs: List[Dict],
+                       method: str = 'mean') -> Dict:
+    """
+    Add or replace several pairs of records in the training data.
+
+    The local records are fetched with one query, the NZ records with another one,
+    all the pairs are evaluated at once and the entries are written with one
+    `bulk_write` of upserts on 'match_id'. The stored similarity scores of the fields
+    of the local records are reused and updated.
+
+    Parameters:
+    -----------
+    col_name : str
+        The name of the collection of the local records.
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    mongo_col_nz : pymongo.collection.Collection
+        The collection of the NZ records.
+    pairs : list of dict
+        The pairs to add, with the 'local_recid', 'ext_nz_recid' and 'is_match' keys.
+        The NZ record must be a possible match of the local record.
+    method : str
+        The method used to calculate the similarity score, see `scoring.SCORING_METHODS`.
+
+    Returns:
+    --------
+    dict
+        The number of 'added' and 'updated' entries and the rejected pairs in 'errors',
+        as dicts with the 'local_recid', 'ext_nz_recid' and 'message' keys.
+    """
+    projection = {'_id': False, 'rec_id': True, 'briefrec': True, 'fullrec': True, 'format': True,
+                  'possible_matches': True, scoring.SCORES_CACHE_FIELD: True}
+    local_recs = {rec['rec_id']: rec for rec in
+                  mongo_db_dedup[col_name].find({'rec_id': {'$in': list({pair['local_recid'] for pair in pairs})}},
+                                                projection)}
+    nz_recs = {nz_rec['mms_id']: nz_rec for nz_rec in
+               tools.fetch_nz_records(list(dict.fromkeys(pair['ext_nz_recid'] for pair in pairs)), mongo_col_nz)}
+
+    errors = []
+    valid_pairs = dict()
+    for pair in pairs:
+        local_rec = local_recs.get(pair['local_recid'])
+        if local_rec is None:
+            message = 'Local record not found'
+        elif len(local_rec.get('fullrec') or []) == 0:
+            message = 'Local record has no full record'
+        elif pair['ext_nz_recid'] not in (local_rec.get('possible_matches') or []):
+            message = 'External record not found in possible matches'
+        elif pair['ext_nz_recid'] not in nz_recs:
+            message = 'External record not found'
+        else:
+            # The last decision on a pair is kept
+            valid_pairs[get_match_id(pair['local_recid'], pair['ext_nz_recid'])] = pair
+            continue
+        errors.append({'local_recid': pair['local_recid'], 'ext_nz_recid': pair['ext_nz_recid'], 'message': message})
+
+    if len(valid_pairs) == 0:
+        return {'added': 0, 'updated': 0, 'errors': errors}
+
+    # Each local record is evaluated only with the NZ records of its pairs
+    mms_ids_by_rec_id = dict()
+    for pair in valid_pairs.values():
+        mms_ids_by_rec_id.setdefault(pair['local_recid'], []).append(pair['ext_nz_recid'])
+    nz_cached_briefrecs = {mms_id: scoring.nz_briefrec_cache.get_or_add(nz_rec) for mms_id, nz_rec in nz_recs.items()}
+    evaluations, scores_cache_updates = scoring.evaluate_local_recs(
+        [{**local_recs[rec_id], 'possible_matches': mms_ids} for rec_id, mms_ids in mms_ids_by_rec_id.items()],
+        nz_cached_briefrecs, method)
+    evaluations = {(rec_id, mms_id): (scores, similarity_score)
+                   for rec_id, evaluation in evaluations.items()
+                   for mms_id, scores, similarity_score in evaluation}
+
+    now = datetime.now(timezone.utc)
+    requests = []
+    for match_id, pair in valid_pairs.items():
+        local_rec = local_recs[pair['local_recid']]
+        scores, similarity_score = evaluations[(pair['local_recid'], pair['ext_nz_recid'])]
+        training_entry = {'local_fullrec': local_rec['fullrec'],
+                          'local_briefrec': local_rec['briefrec'],
+                          'ext_nz_fullrec': nz_recs[pair['ext_nz_recid']]['marc'],
+                          'similarity_score': float(similarity_score),
+                          'scores': {field: float(score) for field, score in scores.items()},
+                          'dedupmarcxml_version': scoring.dedupmarcxml_version,
+                          'method': method,
+                          'is_match': pair['is_match'],
+                          'match_id': match_id,
+                          'type': local_rec.get('format'),
+                          'updated': now}
+        requests.append(ReplaceOne({'match_id': match_id}, training_entry, upsert=True))
+
+    result = mongo_db_dedup[tools.TRAINING_DATA_COL].bulk_write(requests, ordered=False)
+
+    if len(scores_cache_updates) > 0:
+        mongo_db_dedup[col_name].bulk_write([UpdateOne({'rec_id': rec_id}, {'$set': update})
+                                             for rec_id, update in scores_cache_updates.items()], ordered=False)
+
+    return {'added': result.upserted_count, 'updated': len(requests) - result.upserted_count, 'errors': errors}
+
+
+def iter_training_data(mongo_db_dedup: 'pymongo.database.Database',
+                       entry_type: Optional[str] = None,
+                       batch_size: int = 500) -> Iterator[Dict]:
+    """
+    Iterate the entries of the training data.
+
+    Parameters:
+    -----------
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    entry_type : str, optional
+        Only the entries of this type of record are returned, for example 'book'.
+    batch_size : int
+        Number of entries fetched with each batch of the cursor.
+
+    Returns:
+    --------
+    Iterator[dict]
+        The entries, without '_id', in the order of 'match_id'.
+    """
+    query = {'type': entry_type} if entry_type is not None else {}
+    yield from mongo_db_dedup[tools.TRAINING_DATA_COL].find(query, {'_id': False},
+                                                            batch_size=batch_size).sort('match_id', 1)
+
+
+def write_training_parquet(entries: Iterable[Dict], fileobj: BinaryIO,
+                           row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> int:
+    """
+    Write entries of the training data to a Parquet file.
+
+    Entries are written by row groups, memory usage does not depend on the number
+    of entries. The full records are stored as JSON strings, their fields differ
+    between records. The similarity scores of the fields are stored as a map.
+
+    Parameters:
+    -----------
+    entries : Iterable[dict]
+        The entries returned by `iter_training_data`.
+    fileobj : BinaryIO
+        The file receiving the Parquet data, usually a temporary file.
+    row_group_size : int
+        Number of entries of each row group.
+
+    Returns:
+    --------
+    int
+        The number of written entries.
+    """
+    # pyarrow is only required by this export
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('match_id', pa.string()),
+                        ('type', pa.string()),
+                        ('is_match', pa.bool_()),
+                        ('similarity_score', pa.float64()),
+                        ('method', pa.string()),
+                        ('scores', pa.map_(pa.string(), pa.float64())),
+                        ('updated', pa.timestamp('ms', tz='UTC')),
+                        ('local_fullrec', pa.string()),
+                        ('ext_nz_fullrec', pa.string())])
+
+    def to_row(entry: Dict) -> Dict:
+        # Entries added before the scores of the fields were stored do not have them
+        scores = entry.get('scores')
+        return {'match_id': entry['match_id'],
+                'type': entry.get('type'),
+                'is_match': entry.get('is_match'),
+                'similarity_score': entry.get('similarity_score'),
+                'method': entry.get('method'),
+                'scores': list(scores.items()) if scores is not None else None,
+                'updated': entry.get('updated'),
+                'local_fullrec': json.dumps(entry.get('local_fullrec')),
+                'ext_nz_fullrec': json.dumps(entry.get('ext_nz_fullrec'))}
+
+    nb_entries = 0
+    with pq.ParquetWriter(fileobj, schema) as writer:
+        rows = []
+        for entry in entries:
+            rows.append(to_row(entry))
+            if len(rows) >= row_group_size:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                nb_entries += len(rows)
+                rows = []
+
+        if len(rows) > 0 or nb_entries == 0:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            nb_entries += len(rows)
+
+    return nb_entries
+
+
+def get_training_set_versions(mongo_db_dedup: 'pymongo.database.Database',
+                              entry_type: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Return the version of each entry of the training data.
+
+    Only the small fields are read. The version of an entry is its 'updated' date, it
+    changes each time the entry is replaced. Entries added before the date was stored
+    have an empty version.
+
+    Parameters:
+    -----------
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    entry_type : str, optional
+        Only the entries of this type of record are returned, for example 'book'.
+
+    Returns:
+    --------
+    dict
+        Arrays in the order of 'match_id': 'match_ids', 'versions', 'is_match' and 'types'.
+    """
+    query = {'type': entry_type} if entry_type is not None else {}
+    projection = {'_id': False, 'match_id': True, 'updated': True, 'is_match': True, 'type': True}
+
+    match_ids, versions, is_match, types = [], [], [], []
+    for entry in mongo_db_dedup[tools.TRAINING_DATA_COL].find(query, projection).sort('match_id', 1):
+        match_ids.append(entry['match_id'])
+        versions.append(entry['updated'].isoformat() if entry.get('updated') is not None else '')
+        is_match.append(entry.get('is_match') is True)
+        types.append(entry.get('type') or '')
+
+    return {'match_ids': np.array(match_ids, dtype=str),
+            'versions': np.array(versions, dtype=str),
+            'is_match': np.array(is_match, dtype=bool),
+            'types': np.array(types, dtype=str)}
+
+
+def get_training_set_hash(match_ids: np.ndarray, versions: np.ndarray) -> str:
+    """
+    Return the hash identifying the features of a training set.
+
+    The hash depends on the entries and their versions, on the fields of the
+    features, on `FEATURES_VERSION` and on the version of dedupmarcxml computing them.
+
+    Parameters:
+    -----------
+    match_ids : np.ndarray
+        The match IDs of the entries.
+    versions : np.ndarray
+        The versions of the entries, see `get_training_set_versions`.
+
+    Returns:
+    --------
+    str
+        The hexadecimal hash.
+    """
+    training_set_hash = hashlib.sha256(f'{FEATURES_VERSION}|{scoring.dedupmarcxml_version}|'
+                                       f'{",".join(tools.SCORE_FIELDS)}'.encode())
+    for match_id, version in zip(match_ids, versions):
+        training_set_hash.update(f'\n{match_id}|{version}'.encode())
+
+    return training_set_hash.hexdigest()[:16]
+
+
+def compute_features_chunk(entries: List[Dict]) -> np.ndarray:
+    """
+    Compute the feature rows of a chunk of entries, runs in a worker process.
+
+    The features must be the scores of the fields the app evaluates for the candidates
+    of a record, see `scoring.evaluate_local_recs`. The stored scores of an entry are
+    used if they were computed with the current version of dedupmarcxml, or if the
+    version was not stored. Otherwise, the pair is evaluated again like in the app: the
+    local brief record is the stored one and the NZ brief record is parsed from the
+    MARC record. Only the entries added before the local brief record was stored are
+    evaluated with a brief record parsed from the local full record.
+
+    Parameters:
+    -----------
+    entries : list of dict
+        The entries with the 'scores', 'dedupmarcxml_version', 'local_briefrec',
+        'local_fullrec' and 'ext_nz_fullrec' fields, None for missing entries.
+
+    Returns:
+    --------
+    np.ndarray
+        One row by entry with the similarity scores of the fields of `tools.SCORE_FIELDS`,
+        NaN for the missing scores and the missing entries.
+    """
+    features = np.full((len(entries), len(tools.SCORE_FIELDS)), np.nan)
+
+    rows = []
+    pairs = []
+    for row, entry in enumerate(entries):
+        if entry is None:
+            continue
+        if entry.get('scores') is not None \
+                and entry.get('dedupmarcxml_version', scoring.dedupmarcxml_version) == scoring.dedupmarcxml_version:
+            features[row] = [entry['scores'].get(field, np.nan) for field in tools.SCORE_FIELDS]
+            continue
+
+        briefrec = RawBriefRec(entry['local_briefrec']) if entry.get('local_briefrec') is not None \
+            else JsonBriefRec({'marc': entry['local_fullrec']})
+        rows.append(row)
+        pairs.append((briefrec, JsonBriefRec({'marc': entry['ext_nz_fullrec']})))
+
+    for row, (scores, _) in zip(rows, scoring.score_pairs(pairs, sequential=True)):
+        features[row] = [scores.get(field, np.nan) for field in tools.SCORE_FIELDS]
+
+    return features
+
+
+def find_training_features(features_dir: str, training_set_hash: Optional[str] = None) -> Optional[Tuple[str, str]]:
+    """
+    Return the paths of the most recent feature matrix of a directory.
+
+    Parameters:
+    -----------
+    features_dir : str
+        The directory of the feature matrices.
+    training_set_hash : str, optional
+        The hash of the wanted feature matrix, the most recent one by default.
+
+    Returns:
+    --------
+    tuple, optional
+        The paths of the '.npy' matrix and of the '.npz' metadata, None if not found.
+    """
+    pattern = training_set_hash if training_set_hash is not None else '*'
+    paths = [path for path in glob.glob(os.path.join(features_dir, f'{FEATURES_PREFIX}{pattern}.npz'))
+             if os.path.exists(path[:-len('.npz')] + '.npy')]
+    if len(paths) == 0:
+        return None
+
+    path = max(paths, key=os.path.getmtime)
+    return path[:-len('.npz')] + '.npy', path
+
+
+def load_training_features(features_dir: str,
+                           training_set_hash: Optional[str] = None) -> Optional[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """
+    Load a feature matrix and its metadata.
+
+    The matrix is memory mapped in read-only mode.
+
+    Parameters:
+    -----------
+    features_dir : str
+        The directory of the feature matrices.
+    training_set_hash : str, optional
+        The hash of the wanted feature matrix, the most recent one by default.
+
+    Returns:
+    --------
+    tuple, optional
+        The matrix and the metadata: 'match_ids', 'versions', 'is_match', 'types', 'columns',
+        'features_version', 'dedupmarcxml_version' and 'hash'. None if not found.
+    """
+    paths = find_training_features(features_dir, training_set_hash)
+    if paths is None:
+        return None
+
+    features = np.load(paths[0], mmap_mode='r')
+    with np.load(paths[1]) as data:
+        meta = {key: data[key] for key in data.files}
+
+    return features, meta
+
+
+def build_training_features(mongo_db_dedup: 'pymongo.database.Database',
+                            features_dir: str,
+                            executor: Optional[Executor] = None,
+                            entry_type: Optional[str] = None,
+                            chunk_size: int = 500,
+                            max_pending_chunks: int = 8) -> Dict:
+    """
+    Compute the feature matrix of the training data, reusing a previous matrix.
+
+    The matrix is identified by the hash of the training set, see `get_training_set_hash`.
+    If it already exists nothing is computed. Otherwise, the rows of the entries whose
+    version did not change are copied from the most recent matrix of the directory
+    computed with the same fields, the same `FEATURES_VERSION` and the same version of
+    dedupmarcxml. Only the features of the new and the replaced entries are computed, by
+    chunks submitted to the executor, see `compute_features_chunk`.
+
+    The matrix is written with `np.lib.format.open_memmap`, it can be memory mapped,
+    see `load_training_features`. The labels and the types are stored in the metadata.
+
+    Parameters:
+    -----------
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    features_dir : str
+        The directory of the feature matrices.
+    executor : concurrent.futures.Executor, optional
+        The pool of workers evaluating the chunks, usually a `ProcessPoolExecutor`. The
+        chunks are evaluated in the current process without executor.
+    entry_type : str, optional
+        Only the entries of this type of record are used, for example 'book'.
+    chunk_size : int
+        The number of entries evaluated at once.
+    max_pending_chunks : int
+        The maximum number of chunks read and not written yet, it limits the memory usage.
+
+    Returns:
+    --------
+    dict
+        The 'hash' and the 'path' of the matrix, the numbers of 'entries', of 'computed'
+        and of 'reused' rows.
+    """
+    meta = get_training_set_versions(mongo_db_dedup, entry_type)
+    training_set_hash = get_training_set_hash(meta['match_ids'], meta['versions'])
+    path = os.path.join(features_dir, f'{FEATURES_PREFIX}{training_set_hash}.npy')
+    summary = {'hash': training_set_hash, 'path': path, 'entries': len(meta['match_ids']), 'computed': 0, 'reused': 0}
+
+    if find_training_features(features_dir, training_set_hash) is not None:
+        summary['reused'] = summary['entries']
+        return summary
+
+    os.makedirs(features_dir, exist_ok=True)
+    tmp_path = os.path.join(features_dir, f'{FEATURES_PREFIX}{training_set_hash}.tmp.npy')
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                         shape=(len(meta['match_ids']), len(tools.SCORE_FIELDS)))
+
+    # Rows of the entries that did not change since the previous matrix are reused
+    rows_to_compute = np.arange(len(meta['match_ids']))
+    previous = load_training_features(features_dir)
+    if previous is not None and str(previous[1]['dedupmarcxml_version']) == scoring.dedupmarcxml_version \
+            and int(previous[1].get('features_version', 1)) == FEATURES_VERSION \
+            and list(previous[1]['columns']) == tools.SCORE_FIELDS:
+        previous_features, previous_meta = previous
+        previous_rows = {(match_id, version): row for row, (match_id, version)
+                         in enumerate(zip(previous_meta['match_ids'], previous_meta['versions']))}
+        reused = np.array([previous_rows.get(key, -1) for key in zip(meta['match_ids'], meta['versions'])], dtype=int)
+        features[reused >= 0] = previous_features[reused[reused >= 0]]
+        rows_to_compute = np.flatnonzero(reused < 0)
+        summary['reused'] = len(meta['match_ids']) - len(rows_to_compute)
+
+    def write_chunk(rows: np.ndarray, chunk_features: np.ndarray) -> None:
+        features[rows] = chunk_features
+        summary['computed'] += len(rows)
+
+    pending = deque()
+    projection = {'_id': False, 'match_id': True, 'scores': True, 'dedupmarcxml_version': True, 'local_briefrec': True,
+                  'local_fullrec': True, 'ext_nz_fullrec': True}
+    for start in range(0, len(rows_to_compute), chunk_size):
+        rows = rows_to_compute[start:start + chunk_size]
+        entries = {entry['match_id']: entry for entry in mongo_db_dedup[tools.TRAINING_DATA_COL].find(
+            {'match_id': {'$in': meta['match_ids'][rows].tolist()}}, projection)}
+
+        # Entries deleted since the versions were read have no features
+        chunk_entries = [entries.get(match_id) for match_id in meta['match_ids'][rows]]
+        if executor is None:
+            write_chunk(rows, compute_features_chunk(chunk_entries))
+            continue
+
+        pending.append((rows, executor.submit(compute_features_chunk, chunk_entries)))
+        if len(pending) >= max_pending_chunks:
+            rows, future = pending.popleft()
+            write_chunk(rows, future.result())
+
+    while len(pending) > 0:
+        rows, future = pending.popleft()
+        write_chunk(rows, future.result())
+
+    features.flush()
+    del features
+
+    # The metadata is written last, a matrix without metadata is ignored
+    os.replace(tmp_path, path)
+    np.savez(path[:-len('.npy')] + '.npz',
+             columns=np.array(tools.SCORE_FIELDS, dtype=str),
+             features_version=np.array(FEATURES_VERSION),
+             dedupmarcxml_version=np.array(scoring.dedupmarcxml_version),
+             hash=np.array(training_set_hash),
+             **meta)
+
+    return summary
+
+
+def train_model(features: np.ndarray, meta: Dict[str, np.ndarray], algorithm: str = 'logistic_regression',
+                entry_type: Optional[str] = None) -> Dict:
+    """
+    Train a model predicting the probability of a match from a feature matrix.
+
+    Rows with missing scores are skipped. Scores are used as they are, they are all
+    between 0 and 1.
+
+    Parameters:
+    -----------
+    features : np.ndarray
+        The feature matrix, see `load_training_features`.
+    meta : dict
+        The metadata of the feature matrix.
+    algorithm : str
+        'logistic_regression' or 'gradient_boosting'.
+    entry_type : str, optional
+        Only the rows of this type of record are used, for example 'book'.
+
+    Returns:
+    --------
+    dict
+        The bundle of the model: the estimator in 'model', the fields of its features in
+        'columns' and its metadata in 'metadata'.
+
+    Raises:
+    -------
+    ValueError
+        If the algorithm is unknown or if the rows do not contain both matches and non-matches.
+    """
+    # Imported here, only training requires the estimators
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    from sklearn.linear_model import LogisticRegression
+
+    if algorithm not in MODEL_ALGORITHMS:
+        raise ValueError(f'Unknown algorithm: {algorithm}')
+
+    rows = ~np.isnan(features).any(axis=1)
+    if entry_type is not None:
+        rows &= meta['types'] == entry_type
+    features = np.asarray(features[rows])
+    labels = meta['is_match'][rows]
+
+    if len(np.unique(labels)) < 2:
+        raise ValueError('Training data must contain matches and non-matches')
+
+    if algorithm == 'logistic_regression':
+        model = LogisticRegression(max_iter=1000)
+    else:
+        model = HistGradientBoostingClassifier()
+    model.fit(features, labels)
+
+    return {'model': model,
+            'columns': [str(column) for column in meta['columns']],
+            'metadata': {'algorithm': algorithm,
+                         'entry_type': entry_type,
+                         'training_set_hash': str(meta['hash']),
+                         'features_version': int(meta.get('features_version', 1)),
+                         'dedupmarcxml_version': str(meta['dedupmarcxml_version']),
+                         'nb_samples': int(len(labels)),
+                         'nb_matches': int(labels.sum()),
+                         'created': datetime.now(timezone.utc).isoformat()}}
+
+
+def save_model(bundle: Dict, models_dir: str) -> str:
+    """
+    Save a trained model with a versioned name.
+
+    The bundle is saved with joblib in '<name>.joblib' and its metadata in '<name>.json',
+    the name contains the algorithm, the type of record and the time of the training.
+    Models are never overwritten.
+
+    Parameters:
+    -----------
+    bundle : dict
+        The bundle returned by `train_model`.
+    models_dir : str
+        The directory of the models, usually the setting `DEDUP_MODELS_DIR`.
+
+    Returns:
+    --------
+    str
+        The method using the model, 'learned:<name>'.
+    """
+    metadata = bundle['metadata']
+    created = datetime.fromisoformat(metadata['created'])
+    name = '_'.join([metadata['algorithm']] +
+                    ([metadata['entry_type']] if metadata['entry_type'] is not None else []) +
+                    [created.strftime('%Y%m%d_%H%M%S')])
+    if scoring.LEARNED_MODEL_NAME_RE.match(name) is None:
+        raise ValueError(f'Invalid model name: {name}')
+
+    os.makedirs(models_dir, exist_ok=True)
+    path = os.path.join(models_dir, name)
+    if os.path.exists(f'{path}.joblib'):
+        raise ValueError(f'Model {name} already exists')
+
+    # The metadata is written last, a model without metadata is not listed
+    joblib.dump(bundle, f'{path}.joblib')
+    with open(f'{path}.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+
+    return f'{scoring.LEARNED_MODEL_PREFIX}{name}'
+
+
+def load_training_scores(mongo_db_dedup: 'pymongo.database.Database',
+                         entry_type: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Load the stored similarity scores of the fields and the labels of the training data.
+
+    Only the small fields are read, the pairs are not evaluated again. Entries added
+    before the scores of the fields were stored are skipped, they get them when they
+    are added again.
+
+    Parameters:
+    -----------
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    entry_type : str, optional
+        Only the entries of this type of record are loaded, for example 'book'.
+
+    Returns:
+    --------
+    dict
+        Arrays in the order of 'match_id': 'match_ids' and 'versions' of all the entries,
+        see `get_training_set_versions`, and 'features' and 'is_match' of the entries with
+        scores. The number of skipped entries is in 'nb_without_scores'.
+    """
+    query = {'type': entry_type} if entry_type is not None else {}
+    projection = {'_id': False, 'match_id': True, 'updated': True, 'is_match': True, 'scores': True}
+
+    match_ids, versions, features, is_match = [], [], [], []
+    for entry in mongo_db_dedup[tools.TRAINING_DATA_COL].find(query, projection).sort('match_id', 1):
+        match_ids.append(entry['match_id'])
+        versions.append(entry['updated'].isoformat() if entry.get('updated') is not None else '')
+        if entry.get('scores') is None:
+            continue
+        features.append([entry['scores'].get(field, np.nan) for field in tools.SCORE_FIELDS])
+        is_match.append(entry.get('is_match') is True)
+
+    return {'match_ids': np.array(match_ids, dtype=str),
+            'versions': np.array(versions, dtype=str),
+            'features': np.array(features, dtype=np.float64).reshape(len(features), len(tools.SCORE_FIELDS)),
+            'is_match': np.array(is_match, dtype=bool),
+            'nb_without_scores': len(match_ids) - len(features)}
+
+
+def evaluate_scores(similarity_scores: np.ndarray, labels: np.ndarray, thresholds: np.ndarray) -> Dict[str, List]:
+    """
+    Compute the precision, recall, F1 and confusion matrix of a method at several thresholds.
+
+    A pair is predicted as a match when its similarity score is strictly greater than
+    the threshold, like the filters of the list of records. All the thresholds are
+    evaluated at once with a matrix of predictions.
+
+    Parameters:
+    -----------
+    similarity_scores : np.ndarray
+        The similarity score of each pair.
+    labels : np.ndarray
+        Whether each pair is a match.
+    thresholds : np.ndarray
+        The thresholds to evaluate.
+
+    Returns:
+    --------
+    dict
+        Lists in the order of the thresholds: 'thresholds', 'precision', 'recall', 'f1',
+        'tp', 'fp', 'fn' and 'tn'. Precision, recall and F1 are 0 when undefined.
+    """
+    predictions = similarity_scores[np.newaxis, :] > thresholds[:, np.newaxis]
+    tp = (predictions & labels).sum(axis=1)
+    fp = (predictions & ~labels).sum(axis=1)
+    fn = (~predictions & labels).sum(axis=1)
+    tn = (~predictions & ~labels).sum(axis=1)
+
+    precision = np.divide(tp, tp + fp, out=np.zeros(len(thresholds)), where=(tp + fp) > 0)
+    recall = np.divide(tp, tp + fn, out=np.zeros(len(thresholds)), where=(tp + fn) > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(len(thresholds)),
+                   where=(precision + recall) > 0)
+
+    return {'thresholds': thresholds.tolist(),
+            'precision': precision.tolist(),
+            'recall': recall.tolist(),
+            'f1': f1.tolist(),
+            'tp': tp.tolist(),
+            'fp': fp.tolist(),
+            'fn': fn.tolist(),
+            'tn': tn.tolist()}
+
+
+def get_filter_thresholds() -> Dict[str, float]:
+    """Return the thresholds of 'max_match_score' used by the filters of the list of records"""
+    return {record_filter: query['max_match_score']['$gt'] for record_filter, query in tools.RECORD_FILTERS.items()
+            if isinstance(query.get('max_match_score'), dict) and '$gt' in query['max_match_score']}
+
+
+def get_evaluation(mongo_db_dedup: 'pymongo.database.Database',
+                   entry_type: Optional[str] = None,
+                   methods: Optional[List[str]] = None,
+                   thresholds: Optional[np.ndarray] = None) -> Dict:
+    """
+    Return the evaluation of the scoring methods on the training data, cached by training set.
+
+    The stored similarity scores of the fields are loaded in a matrix, see
+    `load_training_scores`. Each method calculates the similarity scores of all the
+    pairs at once, see `scoring.get_similarity_scores`, and is evaluated at all the
+    thresholds at once, see `evaluate_scores`. The thresholds of the filters of the
+    list of records are always evaluated.
+
+    The result is stored in the meta collection with the hash of the training set,
+    the methods and the thresholds. It is reused until one of them changes.
+
+    Parameters:
+    -----------
+    mongo_db_dedup : pymongo.database.Database
+        The MongoDB database containing the deduplication collections.
+    entry_type : str, optional
+        Only the entries of this type of record are used, for example 'book'.
+    methods : list of str, optional
+        The methods to evaluate, by default all the methods of `scoring.SCORING_METHODS`
+        and all the learned models.
+    thresholds : np.ndarray, optional
+        The thresholds to evaluate, `EVALUATION_THRESHOLDS` by default.
+
+    Returns:
+    --------
+    dict
+        The 'training_set_hash', the numbers of pairs ('nb_pairs', 'nb_matches' and
+        'nb_without_scores'), the thresholds of the filters in 'filter_thresholds' and the
+        list of the evaluations of the methods in 'methods', see `evaluate_scores`, with
+        the method in 'method' and the threshold of the best F1 in 'best_threshold'.
+    """
+    if methods is None:
+        methods = scoring.SCORING_METHODS + [model['name'] for model in scoring.get_learned_models()]
+    filter_thresholds = get_filter_thresholds()
+    if thresholds is None:
+        thresholds = EVALUATION_THRESHOLDS
+    thresholds = np.unique(np.concatenate([np.asarray(thresholds, dtype=np.float64),
+                                           list(filter_thresholds.values())]))
+
+    training_scores = load_training_scores(mongo_db_dedup, entry_type)
+    training_set_hash = get_training_set_hash(training_scores['match_ids'], training_scores['versions'])
+    cache_key = hashlib.sha256(json.dumps([training_set_hash, methods, thresholds.tolist()]).encode()).hexdigest()
+
+    cache_id = f'evaluation:{entry_type}' if entry_type is not None else 'evaluation'
+    cached = mongo_db_dedup[tools.META_COL].find_one({'_id': cache_id, 'key': cache_key}, {'evaluation': True})
+    if cached is not None:
+        return cached['evaluation']
+
+    labels = training_scores['is_match']
+    evaluation = {'training_set_hash': training_set_hash,
+                  'entry_type': entry_type,
+                  'nb_pairs': int(len(labels)),
+                  'nb_matches': int(labels.sum()),
+                  'nb_without_scores': training_scores['nb_without_scores'],
+                  'filter_thresholds': filter_thresholds,
+                  'methods': []}
+    for method in methods:
+        similarity_scores = scoring.get_similarity_scores(training_scores['features'], tools.SCORE_FIELDS, method)
+        method_evaluation = {'method': method, **evaluate_scores(similarity_scores, labels, thresholds)}
+        method_evaluation['best_threshold'] = method_evaluation['thresholds'][int(np.argmax(method_evaluation['f1']))]
+        evaluation['methods'].append(method_evaluation)
+
+    mongo_db_dedup[tools.META_COL].replace_one({'_id': cache_id},
+                                               {'key': cache_key,
+                                                'evaluation': evaluation,
+                                                'computed': datetime.now(timezone.utc)},
+                                               upsert=True)
+
+    return evaluation
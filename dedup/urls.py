@@ -18,15 +18,46 @@ urlpatterns = [
     # Collection page with list of records to dedup, main dedup view
     path("col/<slug:col_name>/export", views.get_matching_records, name="get_matching_records"),
 
+    # Streamed MarcXML export of the local records or of the matched NZ records
+    path("col/<slug:col_name>/export/marcxml", views.get_marcxml_export, name="get_marcxml_export"),
+
+    # Streamed export of the decisions taken since a watermark, from the decision journal
+    path("col/<slug:col_name>/export/decisions", views.get_decisions_export, name="get_decisions_export"),
+
     # API used by the frontend to get the records to dedup
     path("col/<slug:col_name>/locrecids", views.get_local_record_ids, name="get_local_record_ids"),
 
     # API used by the frontend to get the data of the local record to dedup
     path("col/<slug:col_name>/locrec/<str:rec_id>", views.local_rec, name="local_rec"),
 
+    # API used by the frontend to prefetch the data of the next local records
+    path("col/<slug:col_name>/locrecs", views.get_local_recs, name="get_local_recs"),
+
+    # APIs used by the frontend to display the full records on demand
+    path("col/<slug:col_name>/locrec/<str:rec_id>/fullrec", views.get_local_fullrec, name="get_local_fullrec"),
+    path("nzrec/<str:mms_id>/fullrec", views.get_nz_fullrec, name="get_nz_fullrec"),
+
+    # API used by scripts and power users to send several decisions at once
+    path("col/<slug:col_name>/decisions", views.post_decisions, name="post_decisions"),
+
+    # API accepting the possible matches above a threshold, dry run by default
+    path("col/<slug:col_name>/autoaccept", views.post_auto_accept, name="post_auto_accept"),
+
+    # API used by the frontend to list the available scoring methods and learned models
+    path("models", views.get_models, name="get_models"),
+
     # API used by the frontend to save dedup results int the training data
     path("training/add", views.add_to_training_data, name="add_to_training_data"),
 
+    # API used by scripts to add several pairs of a collection to the training data at once
+    path("col/<slug:col_name>/training/add", views.post_training_pairs, name="post_training_pairs"),
+
+    # Precision, recall and F1 of the scoring methods at each threshold on the training data
+    path("training/evaluation", views.get_training_evaluation, name="get_training_evaluation"),
+
+    # Streamed export of the training data in JSON Lines or Parquet
+    path("training/export", views.get_training_data_export, name="get_training_data_export"),
+
     # Views to manage login and logout. The login view does not require
     # authentication to be accessed
     path("login/", login_view, name="login_view"),
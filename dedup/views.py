@@ -2,28 +2,34 @@
 This module contains the views of the deduplication application.
 """
 # Django imports
-from django.http import HttpResponse, JsonResponse, HttpRequest
+from django.http import HttpResponse, JsonResponse, HttpRequest, StreamingHttpResponse, FileResponse
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import AuthenticationForm
 from django.utils.html import escape
-from mongosanitizer.sanitizer import sanitize
+from django.views.decorators.cache import cache_control
+from django.conf import settings
 
 # Standard library imports
 import pymongo
 import os
+import itertools
 import json
-from io import BytesIO
-import pandas as pd
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List
+from pymongo import UpdateOne
 
 # Local imports
 from . import tools
+from . import scoring
+from . import batch
+from . import training
 
 # Used for dedup tasks
 # https://dedupmarcxml.readthedocs.io
-from dedupmarcxml.evaluate import evaluate_records_similarity, get_similarity_score
-from dedupmarcxml.briefrecord import RawBriefRec, JsonBriefRec
+from dedupmarcxml.briefrecord import RawBriefRec
 
 # Used only with DNB records
 # from lxml import etree
@@ -47,6 +53,31 @@ mongo_col_nz = mongo_db_nz[os.getenv('nz_db_col')]
 # for each material type
 mongo_db_dedup = mongo_client[os.getenv('dedup_db')]
 
+# Maximum number of local records fetched at once by the frontend
+MAX_BATCH_RECORDS = 20
+
+# Maximum number of decisions sent at once to the bulk decision API
+MAX_BATCH_DECISIONS = 1000
+
+# Maximum number of pairs added at once to the training data
+MAX_BATCH_TRAINING_PAIRS = 1000
+
+# Maximum number of records evaluated by a dry run of the auto-accept API, whole
+# collections are processed by the `auto_accept_matches` management command
+MAX_AUTO_ACCEPT_RECORDS = 2000
+
+# Formats of the export of the records with a match and their content types
+EXPORT_FORMATS = {'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                  'csv': 'text/csv; charset=utf-8',
+                  'tsv': 'text/tab-separated-values; charset=utf-8'}
+
+# Formats of the export of the decision journal and their content types
+JOURNAL_EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8',
+                          'jsonl': 'application/jsonl; charset=utf-8'}
+
+# Lifetime in seconds of the full records in the cache of the browser
+FULLREC_MAX_AGE = 3600
+
 
 def index(request: HttpRequest) -> HttpResponse:
     """
@@ -55,7 +86,8 @@ def index(request: HttpRequest) -> HttpResponse:
     This view is public. It displays the
     list of collections. The application is able to dedup several collections
     without any hard coding. We display all collections of `dedup_db` except
-    the ones starting with 'NZ_' and the training data collection.
+    the ones starting with 'NZ_' and the training data collection, with the
+    number of records of each collection read from its statistics document.
 
     Args:
         request (HttpRequest): The HTTP request object.
@@ -69,8 +101,11 @@ def index(request: HttpRequest) -> HttpResponse:
 
     cols.sort(key=lambda x: x.casefold())
 
+    # Number of records of the collections, only already computed statistics are displayed
+    stats = tools.get_collections_counts(cols, mongo_db_dedup)
+
     # Render the template with the list of collections
-    return render(request, 'dedup/index.html', {"cols": cols})
+    return render(request, 'dedup/index.html', {"cols": [{'name': col, 'counts': stats.get(col)} for col in cols]})
 
 @login_required
 def collection(request: HttpRequest, col_name: str) -> HttpResponse:
@@ -90,15 +125,16 @@ def collection(request: HttpRequest, col_name: str) -> HttpResponse:
     """
 
     # We check that the collection name provided in url exists
-    if col_name not in [col for col in mongo_db_dedup.list_collection_names()
-                        if not col_name.startswith('NZ_') is True and col_name != 'training_data']:
+    if tools.is_reserved_col(col_name) is True or col_name not in mongo_db_dedup.list_collection_names():
         return HttpResponse(escape(f'Collection "{col_name}" not found'), status=404)
 
     # At least one group must be associated to the collection
     if not tools.is_col_allowed(col_name, request):
         return HttpResponse("No right to access this collection", status=403)
 
-    tools.refresh_match_type(col_name, mongo_db_dedup)
+    # Records touched since the last refresh are reclassified in background,
+    # the page is rendered without waiting
+    tools.schedule_match_type_refresh(col_name, mongo_db_dedup)
 
     return render(request, 'dedup/collection.html', {"col_name": col_name})
 
@@ -109,40 +145,58 @@ def get_local_record_ids(request: HttpRequest, col_name: str) -> JsonResponse:
     API endpoint to retrieve record IDs for a given collection, filtered by various criteria.
 
     This view returns a JSON response containing the record IDs and the total number of records matching the filter.
-    Sorting is performed by the MongoDB '_id' field. Duplicate matches are handled with a dedicated aggregation pipeline.
+    Sorting is performed by the MongoDB '_id' field. Duplicate matches are handled with a dedicated aggregation pipeline
+    and sorted by 'matched_record' and '_id'.
+
+    Paging uses keyset cursors: the response contains an opaque 'next_cursor' token holding the sort key
+    of the last record, it can be provided with the 'cursor' parameter to get the next page without any
+    additional lookup. The total number of records is read from the statistics document of the collection,
+    it is not returned with 'total=0'.
+
+    The 'scores' parameter filters the records on the stored similarity scores of the fields of their best
+    candidate, for example "titles>0.9,creators<0.3", see `tools.parse_field_scores_filter`.
 
     Args:
-        request (HttpRequest): The HTTP request containing filter parameters (e.g., 'filter', 'next', 'recid').
+        request (HttpRequest): The HTTP request containing filter parameters (e.g., 'filter', 'scores', 'cursor',
+            'next', 'recid', 'total').
         col_name (str): The name of the collection to query.
 
     Returns:
         JsonResponse: JSON response with a list of record IDs, validation status, color (for UI alternation),
-        matched_record, and the total number of records.
+        matched_record, the total number of records and the cursor of the next page.
     """
 
     # Get the filter from the request, using parameters
     record_filter = request.GET.get('filter', 'all')
+    scores_filter = request.GET.get('scores', '')
+    cursor = request.GET.get('cursor', None)
     next_record = request.GET.get('next', None)
     recid = request.GET.get('recid', None)
-
-    # Define the queries for the different filters
-    queries = {'all': {},
-               'possible': {'match_type': 'possible_match'},
-               'possible06': {'match_type': 'possible_match',
-                              'max_match_score': {'$gt': 0.6}},
-               'possible05': {'match_type': 'possible_match',
-                              'max_match_score': {'$gt': 0.5}},
-               'possible04': {'match_type': 'possible_match',
-                              'max_match_score': {'$gt': 0.4}},
-               'nomatch': {'match_type': 'no_match'},
-               'match': {'match_type': 'match'},
-               'duplicatematch': {'match_type': 'duplicate_match'},
-               }
-
-    recids_query = queries.get(record_filter, queries['all'])
-
-    # Used with next button
-    if next_record is not None:
+    with_total = request.GET.get('total', '1') != '0'
+
+    if record_filter not in tools.RECORD_FILTERS:
+        record_filter = 'all'
+    recids_query = dict(tools.RECORD_FILTERS[record_filter])
+
+    # Filter on the similarity scores of the fields of the best candidate, e.g. "titles>0.9,creators<0.3"
+    try:
+        scores_query = tools.parse_field_scores_filter(scores_filter)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    recids_query.update(scores_query)
+
+    # Cursors are only valid for the filters used to build them
+    cursor_filter = f'{record_filter}|{scores_filter}' if len(scores_query) > 0 else record_filter
+
+    # Used with next button, the cursor contains the sort key of the last record of the previous page
+    # An invalid cursor restarts the list from the first page
+    cursor_key = tools.decode_page_cursor(cursor, cursor_filter, by_matched_record=record_filter == 'duplicatematch') \
+        if cursor is not None else None
+    if cursor_key is not None:
+        recids_query.update(tools.get_page_cursor_query(cursor_key, by_matched_record=record_filter == 'duplicatematch'))
+
+    # Used with next button without cursor
+    elif next_record is not None:
         rec = mongo_db_dedup[col_name].find_one({'rec_id': next_record},
                                                 {'_id': True, 'matched_record': True})
         if record_filter != 'duplicatematch':
@@ -166,95 +220,78 @@ def get_local_record_ids(request: HttpRequest, col_name: str) -> JsonResponse:
             recids_query.update({'matched_record': {'$gte':rec['matched_record']}})
 
     if record_filter == 'duplicatematch':
-        # Normal pipeline for other filters
-
+        # Only the page of records is read, no group of full documents is built. With an
+        # index on (match_type, matched_record, _id) the sort and the limit are resolved by
+        # the index. Colors of the groups are set below.
         pipeline = [
             # 1. Match only documents marked as duplicate
             {"$match": recids_query},
 
-            # 2. Group documents by matched_record
-            {"$group": {
-                "_id": "$matched_record",
-                "documents": {"$push": "$$ROOT"}
-            }},
-
-            # 3. Assign a rank to each group to enable color alternation
-            {
-                "$setWindowFields": {
-                    "sortBy": {"_id": 1},
-                    "output": {
-                        "groupRank": {"$rank": {}}
-                    }
-                }
-            },
-
-            # 4. Define color as True/False alternating by group rank
-            {"$set": {
-                "color": {"$eq": [{"$mod": ["$groupRank", 2]}, 0]}
-            }},
-
-            # 5. Unwind documents so each row is one document again
-            {"$unwind": "$documents"},
-
-            # 6. Set color field inside each document
-            {"$set": {
-                "documents.color": "$color"
-            }},
-
-            # 7. Replace root with each document
-            {"$replaceRoot": {"newRoot": "$documents"}},
-
-            # 8. Project only relevant fields
+            # 2. Sort by matched_record, _id makes the order unique for the cursor
+            {"$sort": {"matched_record": 1, "_id": 1}},
+
+            # 3. Limited result page
+            {"$limit": 300},
+
+            # 4. Project only relevant fields, _id is kept for the cursor
             {"$project": {
-                "_id": False,
+                "_id": True,
                 "rec_id": True,
                 "human_validated": True,
                 "matched_record": True,
-                "color": True,
                 "match_type": True,
-            }},
-
-            # 9. Re-apply match filter if needed (e.g. for paging by rec_id)
-            {"$match": recids_query},
-
-            # 10. Sort by matched_record
-            {"$sort": {"matched_record": 1}},
-
-            # 11. Split results: total count and limited result page
-            {"$facet": {
-                "total": [{"$count": "total"}],
-                "results": [{"$limit": 300}]
             }}
         ]
     else:
         # Workflow for all and no match and possible match filter
         pipeline = [
             {"$match": recids_query},
+            {"$sort": {"_id": 1}},
+            {"$limit": 300},
             {"$project": {
-                "_id": False,
+                "_id": True,
                 "rec_id": True,
                 "human_validated": True,
                 "matched_record": True
-            }},
-            {"$facet": {  # split data
-                "total": [  # Count nb documents
-                    {"$count": "total"}
-                ],
-                "results": [
-                    {"$limit": 300}
-                ]
             }}
         ]
     # Execute the query
-    result = list(mongo_db_dedup[col_name].aggregate(pipeline))
+    recs = list(mongo_db_dedup[col_name].aggregate(pipeline))
+
+    # Colors of the duplicate matches alternate by matched record. The cursor contains the color of the
+    # last group of the previous page, so a group spanning two pages keeps its color and the next
+    # group gets the other one.
+    if record_filter == 'duplicatematch':
+        color = cursor_key[2] if cursor_key is not None and len(cursor_key) > 2 else True
+        previous_matched_record = cursor_key[0] if cursor_key is not None else None
+        for rec in recs:
+            if rec['matched_record'] != previous_matched_record:
+                color = not color
+                previous_matched_record = rec['matched_record']
+            rec['color'] = color
+
+    # Cursor of the next page, only if the page is full
+    next_cursor = None
+    if len(recs) == 300:
+        last_key = [recs[-1]['_id']] if record_filter != 'duplicatematch' else [recs[-1]['matched_record'],
+                                                                              recs[-1]['_id'],
+                                                                              recs[-1]['color']]
+        next_cursor = tools.encode_page_cursor(cursor_filter, last_key)
+
+    # Filters on the scores of the fields are arbitrary, their total is not in the statistics
+    nb_total_recs = None
+    if with_total is True and len(scores_query) > 0:
+        nb_total_recs = mongo_db_dedup[col_name].count_documents({**tools.RECORD_FILTERS[record_filter],
+                                                                  **scores_query})
+    elif with_total is True:
+        nb_total_recs = tools.get_collection_stats(col_name, mongo_db_dedup)['counts'].get(record_filter, 0)
 
-    recs = result[0]['results']
-    nb_total_recs = result[0]['total'][0]['total'] if result[0]['total'] else 0
     return JsonResponse({'rec_ids': [{'rec_id': r['rec_id'],
                                       'human_validated': r.get('human_validated', False),
                                       'color': r.get('color', False),
                                       'matched_record': r.get('matched_record', None)} for r in recs],
-                         'nb_total_recs': nb_total_recs})
+                         'nb_total_recs': nb_total_recs,
+                         'next_cursor': next_cursor})
 
 
 @login_required
@@ -304,7 +341,9 @@ def get_local_rec(request, rec_id, col_name, jsonresponse=True):
             ]
         }
 
-    Idea is to iterate the possible matches and get the data from the database.
+    The data is built by `build_local_recs`. With the parameter 'fullrec=0', only the brief
+    records and the scores are returned, "fullrec" fields are null. The full records
+    can then be fetched on demand with `get_local_fullrec` and `get_nz_fullrec`.
 
     Args:
         request (HttpRequest): The HTTP request object.
@@ -319,50 +358,241 @@ def get_local_rec(request, rec_id, col_name, jsonresponse=True):
 
     # Get the model used to calculate the similarity score
     selected_model = request.GET.get('selectedModel', 'mean')
+    if not scoring.is_scoring_method(selected_model):
+        return JsonResponse({'status': 'error', 'message': f'Unknown model: {selected_model}'}, status=400)
 
-    # Get the record from the database
-    rec = mongo_db_dedup[col_name].find_one({'rec_id': rec_id}, {'_id': False})
-    briefrec = RawBriefRec(rec['briefrec'])
-
-    # Prepare the dict with matching and possible matching records
-    rec_data = {'briefrec': tools.display_briefrec(briefrec),
-                'fullrec': tools.json_to_marc(rec['fullrec']) if len(rec['fullrec']) else 'No full record',
-                'matched_record': '',
-                'possible_matches': []}
-
-    possible_matches = []
-    if rec.get('possible_matches') is not None:
-        possible_matches = rec['possible_matches']
-    if rec.get('matched_record') is not None:
-        rec_data['matched_record'] = rec['matched_record']
-
-    # Get data of possible matches
-    for possible_match in possible_matches:
-
-        # if possible_match.startswith('(DNB)'):
-        #     nz_ext_data = get_dnb_rec(request, possible_match)
-        # else:
-
-        # Get the NZ record from the database
-        rec = mongo_col_nz.find_one({'mms_id': possible_match}, {'_id': False})
-        if rec is None:
-            continue
-
-        # Prepare the dict with the data of the possible match
-        rec = dict(rec)
-
-        nz_briefrec = JsonBriefRec(rec)
-        scores = evaluate_records_similarity(briefrec, nz_briefrec)
-        nz_ext_data = {'briefrec': tools.display_briefrec(nz_briefrec),
-                       'fullrec': tools.json_to_marc(rec) if len(rec) else 'No full record',
-                       'scores': scores,
-                       'similarity_score': get_similarity_score(scores, method=selected_model),
-                       'rec_id': possible_match}
-        rec_data['possible_matches'].append(nz_ext_data)
+    rec_data = build_local_recs(col_name, [rec_id], selected_model,
+                                with_fullrec=request.GET.get('fullrec', '1') != '0').get(rec_id)
+    if rec_data is None:
+        return JsonResponse({'status': 'error', 'message': 'Record not found'}, status=404)
 
     return JsonResponse(rec_data) if jsonresponse is True else rec_data
 
 
+def build_local_recs(col_name: str,
+                     rec_ids: List[str],
+                     selected_model: str = 'mean',
+                     with_fullrec: bool = True) -> Dict[str, Dict]:
+    """
+    Build the data of several local records and their possible matches.
+
+    The local records are fetched with one query and the NZ records of all the possible
+    matches with another one, the order of the possible matches is kept and missing
+    records are skipped. All the pairs of records are evaluated at once by the pool of
+    workers, see `scoring.score_pairs`. The format of the data of each record is described
+    in `get_local_rec`.
+
+    Without full records, the full local records are not read, the NZ records whose brief
+    record is in the cache are not fetched and the "fullrec" fields are None.
+
+    Args:
+        col_name (str): The collection name.
+        rec_ids (list): The local record IDs.
+        selected_model (str, optional): The model used to calculate the similarity score. With the model of
+            the setting `DEDUP_FIELD_SCORES_METHOD`, the scores of the fields of the best candidate are stored.
+        with_fullrec (bool, optional): Whether to render the full records in HTML.
+
+    Returns:
+        dict: The data of each local record with the record ID as key, missing records are skipped.
+    """
+    projection = {'_id': False} if with_fullrec is True else {'_id': False, 'fullrec': False}
+    recs = list(mongo_db_dedup[col_name].find({'rec_id': {'$in': rec_ids}}, projection))
+
+    # Get data of possible matches, all NZ records are fetched with one query
+    # if possible_match.startswith('(DNB)'):
+    #     nz_ext_data = get_dnb_rec(request, possible_match)
+    possible_matches = {rec['rec_id']: rec.get('possible_matches') or [] for rec in recs}
+    all_possible_matches = list(dict.fromkeys(mms_id for rec in recs for mms_id in possible_matches[rec['rec_id']]))
+
+    # Parsed NZ brief records are shared between requests. Without full records,
+    # only the NZ records missing in the cache need to be fetched
+    if with_fullrec is True:
+        nz_recs = {nz_rec['mms_id']: nz_rec for nz_rec in tools.fetch_nz_records(all_possible_matches, mongo_col_nz)}
+        nz_cached_briefrecs = {mms_id: scoring.nz_briefrec_cache.get_or_add(nz_rec)
+                               for mms_id, nz_rec in nz_recs.items()}
+    else:
+        nz_cached_briefrecs = scoring.get_nz_briefrecs(all_possible_matches, mongo_col_nz)
+
+    # All the pairs of all the records are evaluated at once by the pool of workers
+    evaluations, scores_cache_updates = scoring.evaluate_local_recs(recs, nz_cached_briefrecs, selected_model)
+
+    # Scores of the fields of the best candidate are stored when they are evaluated with the configured method
+    if selected_model == settings.DEDUP_FIELD_SCORES_METHOD:
+        for rec in recs:
+            field_scores_update = scoring.get_field_scores_update(evaluations[rec['rec_id']], selected_model)
+            if any(rec.get(field) != value for field, value in field_scores_update.items()):
+                scores_cache_updates.setdefault(rec['rec_id'], dict()).update(field_scores_update)
+
+    # NZ full records are rendered once even if they are candidates of several local records
+    nz_fullrecs = dict()
+
+    recs_data = dict()
+    for rec in recs:
+        # Prepare the dict with matching and possible matching records
+        rec_data = {'briefrec': tools.display_briefrec(RawBriefRec(rec['briefrec'])),
+                    'fullrec': render_fullrec(rec['fullrec']) if with_fullrec is True else None,
+                    'matched_record': rec['matched_record'] if rec.get('matched_record') is not None else '',
+                    'possible_matches': []}
+
+        for mms_id, scores, similarity_score in evaluations[rec['rec_id']]:
+            if mms_id not in nz_fullrecs:
+                nz_fullrecs[mms_id] = render_fullrec(nz_recs[mms_id]) if with_fullrec is True else None
+
+            # Prepare the dict with the data of the possible match
+            nz_ext_data = {'briefrec': nz_cached_briefrecs[mms_id].display,
+                           'fullrec': nz_fullrecs[mms_id],
+                           'scores': scores,
+                           'similarity_score': similarity_score,
+                           'rec_id': mms_id}
+            rec_data['possible_matches'].append(nz_ext_data)
+
+        recs_data[rec['rec_id']] = rec_data
+
+    if len(scores_cache_updates) > 0:
+        mongo_db_dedup[col_name].bulk_write([UpdateOne({'rec_id': rec_id}, {'$set': update})
+                                             for rec_id, update in scores_cache_updates.items()], ordered=False)
+
+    return recs_data
+
+
+@login_required
+def get_local_recs(request: HttpRequest, col_name: str) -> JsonResponse:
+    """
+    API endpoint to retrieve several local records at once, used to prefetch the next records.
+
+    The record IDs are provided with repeated 'rec_id' parameters. The response contains
+    the data of each record, in the format described in `get_local_rec`, with the record
+    ID as key:
+        {
+            "records": {
+                "rec_id_1": {"briefrec": ..., "fullrec": ..., "matched_record": ..., "possible_matches": [...]},
+                ...
+            }
+        }
+
+    Args:
+        request (HttpRequest): The HTTP request containing the 'rec_id' and 'selectedModel' parameters.
+        col_name (str): The collection name.
+
+    Returns:
+        JsonResponse: The data of the records found, missing records are skipped.
+    """
+    if not tools.is_col_allowed(col_name, request):
+        return JsonResponse({'status': 'error', 'message': 'No right to access this collection'}, status=403)
+
+    # Get the model used to calculate the similarity score
+    selected_model = request.GET.get('selectedModel', 'mean')
+    if not scoring.is_scoring_method(selected_model):
+        return JsonResponse({'status': 'error', 'message': f'Unknown model: {selected_model}'}, status=400)
+    with_fullrec = request.GET.get('fullrec', '1') != '0'
+
+    # Remove duplicates and keep the order of the record IDs
+    rec_ids = list(dict.fromkeys(request.GET.getlist('rec_id')))
+    if len(rec_ids) > MAX_BATCH_RECORDS:
+        return JsonResponse({'status': 'error',
+                             'message': f'Maximum {MAX_BATCH_RECORDS} records can be fetched at once'}, status=400)
+
+    return JsonResponse({'records': build_local_recs(col_name, rec_ids, selected_model, with_fullrec)})
+
+
+@login_required
+def get_models(request: HttpRequest) -> JsonResponse:
+    """
+    API endpoint to list the methods available to calculate the similarity score.
+
+    Example response:
+        {
+            "models": [
+                {"name": "mean", "learned": false},
+                {"name": "learned:logistic_regression_20240131_120000", "learned": true,
+                 "algorithm": "logistic_regression", "nb_samples": 1520, ...},
+                ...
+            ]
+        }
+
+    Staff users also get the counters of the cache of the NZ brief records of the
+    process, see `scoring.BriefRecCache.stats`:
+        {"models": [...], "briefrec_cache": {"size": 1200, "maxsize": 10000, "hits": 5400,
+                                             "misses": 1200, "hit_ratio": 0.82}}
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: The fixed methods followed by the learned models, the most recent first.
+    """
+    models = [{'name': method, 'learned': False} for method in scoring.SCORING_METHODS]
+    models += [{**model, 'learned': True} for model in scoring.get_learned_models()]
+
+    if request.user.is_staff:
+        return JsonResponse({'models': models, 'briefrec_cache': scoring.nz_briefrec_cache.stats()})
+
+    return JsonResponse({'models': models})
+
+
+def render_fullrec(rec: Dict) -> str:
+    """
+    Render a full record in HTML.
+
+    Args:
+        rec (dict): The JSON MARC record, the NZ record or the 'fullrec' field of a local record.
+
+    Returns:
+        str: The HTML version of the record.
+    """
+    return tools.json_to_marc(rec) if len(rec) else 'No full record'
+
+
+@login_required
+@cache_control(private=True, max_age=FULLREC_MAX_AGE)
+def get_local_fullrec(request: HttpRequest, col_name: str, rec_id: str) -> JsonResponse:
+    """
+    API endpoint to retrieve the full record of a local record in HTML.
+
+    It is used by the frontend to display the full record on demand, the
+    response can be cached by the browser.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        col_name (str): The collection name.
+        rec_id (str): The local record ID.
+
+    Returns:
+        JsonResponse: JSON response with the "fullrec" field.
+    """
+    if not tools.is_col_allowed(col_name, request):
+        return JsonResponse({'status': 'error', 'message': 'No right to access this collection'}, status=403)
+
+    rec = mongo_db_dedup[col_name].find_one({'rec_id': rec_id}, {'_id': False, 'fullrec': True})
+    if rec is None:
+        return JsonResponse({'status': 'error', 'message': 'Record not found'}, status=404)
+
+    return JsonResponse({'fullrec': render_fullrec(rec['fullrec'])})
+
+
+@login_required
+@cache_control(private=True, max_age=FULLREC_MAX_AGE)
+def get_nz_fullrec(request: HttpRequest, mms_id: str) -> JsonResponse:
+    """
+    API endpoint to retrieve the full record of a NZ record in HTML.
+
+    It is used by the frontend to display the full record on demand, the
+    response can be cached by the browser.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        mms_id (str): The MMS ID of the NZ record.
+
+    Returns:
+        JsonResponse: JSON response with the "fullrec" field.
+    """
+    nz_rec = mongo_col_nz.find_one({'mms_id': mms_id}, tools.NZ_REC_PROJECTION)
+    if nz_rec is None:
+        return JsonResponse({'status': 'error', 'message': 'Record not found'}, status=404)
+
+    return JsonResponse({'fullrec': render_fullrec(nz_rec)})
+
+
 @login_required
 def post_local_rec(request, rec_id=None, col_name=None) -> JsonResponse:
     """
@@ -371,6 +601,8 @@ def post_local_rec(request, rec_id=None, col_name=None) -> JsonResponse:
     If the request body contains a JSON object with a key 'matched_record', this endpoint updates the record
     with the given rec_id to have the specified matched_record. It can also be used with an empty string to remove the match.
     The match type (match, duplicate_match, no_match) is updated accordingly for all affected records.
+    The changes of match type are applied to the statistics document of the collection, see
+    `tools.apply_decisions`.
 
     Args:
         request (HttpRequest): The HTTP request object.
@@ -381,56 +613,134 @@ def post_local_rec(request, rec_id=None, col_name=None) -> JsonResponse:
         JsonResponse: Status of the operation.
     """
     matched_record = json.loads(request.body)['matched_record']
-    recids_to_check_for_duplicate_match = []
-
-    orig_rec = mongo_db_dedup[col_name].find_one({'rec_id': rec_id},
-                                                 {'_id': False,
-                                                  'matched_record': True})
-    if orig_rec is not None and orig_rec['matched_record'] is not None:
-        recids_to_check_for_duplicate_match.append(orig_rec['matched_record'])
+    if matched_record is not None and not isinstance(matched_record, str):
+        return JsonResponse({'status': 'error', 'message': 'Matched record must be a record ID'}, status=400)
 
     # Case if button "cancel match" is clicked
-    if matched_record is None or matched_record=='':
+    if matched_record == '':
         matched_record = None
 
-        _ = mongo_db_dedup[col_name].update_one({'rec_id': rec_id},
-                                                {'$set': {'matched_record': matched_record,
-                                                          'human_validated': True,
-                                                          'match_type': 'no_match'}})
-    else:
-        recids_to_check_for_duplicate_match.append(matched_record)
-        _ = mongo_db_dedup[col_name].update_one({'rec_id': rec_id},
-                                                {'$set': {'matched_record': matched_record,
-                                                          'human_validated': True,
-                                                          'match_type': 'match'}})
-
-    # We need to update 'match_type' field. If we add or remove a match count of matches could change
-    for recid_to_check_for_duplicate_match in recids_to_check_for_duplicate_match:
-        # Find recids of record that need to be updated
-        # Cancel match: old matched record ID
-        # Select match: current matched record ID
-        recids = [r['rec_id'] for r in mongo_db_dedup[col_name].find({'matched_record': sanitize(recid_to_check_for_duplicate_match)},
-                                      {'rec_id': True,
-                                       '_id': False})]
-        # Number of recids decide if we have a duplicate match or not
-        if len(recids) > 1:
-            _ = mongo_db_dedup[col_name].update_many({'rec_id': {'$in': recids}},
-                                                      {'$set': {'match_type': 'duplicate_match'}})
-        elif len(recids) == 1:
-            recid = recids[0]
-            _ = mongo_db_dedup[col_name].update_one({'rec_id': recid},
-                                                    {'$set': {'match_type': 'match'}})
+    tools.apply_decisions(col_name, mongo_db_dedup, {rec_id: matched_record}, user=request.user.get_username())
 
     return JsonResponse({'status': 'ok'})
 
 
+@login_required
+def post_decisions(request: HttpRequest, col_name: str) -> JsonResponse:
+    """
+    API endpoint to set or cancel the matched record of several local records at once.
+
+    The request body contains a JSON object with the list of decisions:
+        {
+            "decisions": [
+                {"rec_id": "rec_id_1", "matched_record": "mms_id_1"},
+                {"rec_id": "rec_id_2", "matched_record": ""},
+                ...
+            ]
+        }
+    An empty string or null cancels the match. If a record appears several times, the
+    last decision is kept. All decisions are applied with one bulk write and the match
+    types are recomputed once, see `tools.apply_decisions`.
+
+    Args:
+        request (HttpRequest): The HTTP request containing the decisions.
+        col_name (str): The name of the collection.
+
+    Returns:
+        JsonResponse: Status of the operation with the number of updated records and the record IDs not found.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Only POST method is allowed'}, status=405)
+
+    if tools.is_reserved_col(col_name) is True or not tools.is_col_allowed(col_name, request):
+        return JsonResponse({'status': 'error', 'message': 'No right to access this collection'}, status=403)
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+
+    raw_decisions = data.get('decisions') if isinstance(data, dict) else None
+    if not isinstance(raw_decisions, list):
+        return JsonResponse({'status': 'error', 'message': 'List of decisions missing'}, status=400)
+
+    if len(raw_decisions) > MAX_BATCH_DECISIONS:
+        return JsonResponse({'status': 'error',
+                             'message': f'Maximum {MAX_BATCH_DECISIONS} decisions can be sent at once'}, status=400)
+
+    decisions = dict()
+    for decision in raw_decisions:
+        if not isinstance(decision, dict) or not isinstance(decision.get('rec_id'), str) \
+                or not isinstance(decision.get('matched_record', ''), (str, type(None))):
+            return JsonResponse({'status': 'error', 'message': f'Invalid decision: {decision}'}, status=400)
+        decisions[decision['rec_id']] = decision.get('matched_record') or None
+
+    result = tools.apply_decisions(col_name, mongo_db_dedup, decisions, user=request.user.get_username())
+
+    return JsonResponse({'status': 'ok', **result})
+
+
+@login_required
+def post_auto_accept(request: HttpRequest, col_name: str) -> JsonResponse:
+    """
+    API endpoint to accept the possible matches whose best candidate reaches a threshold.
+
+    The request body contains a JSON object with the parameters of the batch:
+        {
+            "threshold": 0.95,
+            "selectedModel": "mean",
+            "dry_run": true
+        }
+    Only dry runs are available, they report the matches that would be accepted among the
+    first `MAX_AUTO_ACCEPT_RECORDS` possible matches, "truncated" is true if the collection
+    has more. Matches are accepted with the `auto_accept_matches` management command, a batch
+    on a whole collection is too long for a request, see `batch.auto_accept_matches`.
+
+    Args:
+        request (HttpRequest): The HTTP request containing the parameters of the batch.
+        col_name (str): The name of the collection.
+
+    Returns:
+        JsonResponse: Status of the operation with the summary of the batch.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Only POST method is allowed'}, status=405)
+
+    if tools.is_reserved_col(col_name) is True or not tools.is_col_allowed(col_name, request):
+        return JsonResponse({'status': 'error', 'message': 'No right to access this collection'}, status=403)
+
+    try:
+        data = json.loads(request.body)
+        threshold = float(data['threshold'])
+    except (json.JSONDecodeError, TypeError, KeyError, ValueError):
+        return JsonResponse({'status': 'error', 'message': 'Threshold missing or invalid'}, status=400)
+
+    if not 0 < threshold <= 1:
+        return JsonResponse({'status': 'error', 'message': 'Threshold must be between 0 and 1'}, status=400)
+
+    selected_model = data.get('selectedModel', 'mean')
+    if not scoring.is_scoring_method(selected_model):
+        return JsonResponse({'status': 'error', 'message': f'Unknown model: {selected_model}'}, status=400)
+
+    if data.get('dry_run', True) is False:
+        return JsonResponse({'status': 'error',
+                             'message': 'Matches are accepted with the auto_accept_matches management command, '
+                                        'only dry runs are available'}, status=400)
+
+    summary = batch.auto_accept_matches(col_name, mongo_db_dedup, mongo_col_nz, threshold, selected_model,
+                                        dry_run=True, max_records=MAX_AUTO_ACCEPT_RECORDS)
+
+    return JsonResponse({'status': 'ok', **summary})
+
+
 @login_required
 def add_to_training_data(request) -> JsonResponse:
     """
     API endpoint to add a pair of records (local/NZ) to the training dataset.
 
     This endpoint receives a JSON payload with the local record ID, NZ record ID, and user decision.
-    It adds or updates the corresponding entry in the training data collection, including similarity score and match status.
+    It adds or updates the corresponding entry in the training data collection, including similarity score and match status,
+    see `training.add_training_pairs`.
 
     Args:
         request (HttpRequest): The HTTP request containing record IDs and user decision.
@@ -443,106 +753,324 @@ def add_to_training_data(request) -> JsonResponse:
 
     # Get the model used to calculate the similarity score
     selected_model = data.get('selectedModel', 'mean')
+    if not scoring.is_scoring_method(selected_model):
+        return JsonResponse({'status': 'error', 'message': f'Unknown model: {selected_model}'})
 
-    # Get the local record from the database
-    local_record = mongo_db_dedup[data['col_name']].find_one({'rec_id': sanitize(data['local_recid'])}, {'_id': False})
-    if len(local_record['fullrec']) == 0:
-        return JsonResponse({'status': 'error', 'message': 'Local record has no full record'})
-    
-    briefrec = RawBriefRec(local_record['briefrec'])
-
-    # Check if the nz fetched record is in the possible matches
-    if data['ext_nz_recid'] not in local_record['possible_matches']:
-        return JsonResponse({'status': 'error', 'message': 'External record not found in possible matches'})
-
-    # Get the NZ record from the database
-    nz_ext_rec = mongo_col_nz.find_one({'mms_id': sanitize(data['ext_nz_recid'])}, {'_id': False})
-    nz_briefrec = JsonBriefRec(nz_ext_rec)
-
-    # Calculate the similarity score
-    scores = evaluate_records_similarity(briefrec, nz_briefrec)
-    similarity_score = get_similarity_score(scores, method=selected_model)
-
-    # Preparation of the document with the training data
-    # We use the JSON version of the full records
-    training_entry = {'local_fullrec': local_record['fullrec'],
-                      'ext_nz_fullrec': nz_ext_rec['marc'],
-                      'similarity_score': similarity_score,
-                      'is_match': data['is_match'],
-                      'match_id': f'{local_record["rec_id"]}-{data["ext_nz_recid"]}',
-                      'type': local_record['format']}
-
-    # Update or insert a new record in the training data collection
-    result = mongo_db_dedup[f'training_data'].replace_one({'match_id': training_entry['match_id']},
-                                                          training_entry,
-                                                              upsert=True)
+    if tools.is_reserved_col(data.get('col_name', '')) is True \
+            or not isinstance(data.get('local_recid'), str) or not isinstance(data.get('ext_nz_recid'), str):
+        return JsonResponse({'status': 'error', 'message': 'Invalid training data'})
+
+    result = training.add_training_pairs(data['col_name'], mongo_db_dedup, mongo_col_nz,
+                                         [{'local_recid': data['local_recid'],
+                                           'ext_nz_recid': data['ext_nz_recid'],
+                                           'is_match': data['is_match']}],
+                                         method=selected_model)
 
     # Return the result of the operation in a message to display
-    if result.modified_count == 0:
+    if len(result['errors']) > 0:
+        return JsonResponse({'status': 'error', 'message': result['errors'][0]['message']})
+    elif result['added'] > 0:
         return JsonResponse({'status': 'ok', 'message': 'New entry added to training data'})
     else:
         return JsonResponse({'status': 'ok', 'message': 'Entry updated in training data'})
 
 
+@login_required
+def post_training_pairs(request: HttpRequest, col_name: str) -> JsonResponse:
+    """
+    API endpoint to add several pairs of records (local/NZ) to the training dataset at once.
+
+    The request body contains a JSON object with the model and the list of pairs:
+        {
+            "selectedModel": "mean",
+            "pairs": [
+                {"local_recid": "rec_id_1", "ext_nz_recid": "mms_id_1", "is_match": true},
+                ...
+            ]
+        }
+    The NZ records must be possible matches of the local records. All the pairs are evaluated at
+    once and written with one bulk write, see `training.add_training_pairs`.
+
+    Args:
+        request (HttpRequest): The HTTP request containing the pairs.
+        col_name (str): The name of the collection of the local records.
+
+    Returns:
+        JsonResponse: Status of the operation with the numbers of added and updated entries and the rejected pairs.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Only POST method is allowed'}, status=405)
+
+    if tools.is_reserved_col(col_name) is True or not tools.is_col_allowed(col_name, request):
+        return JsonResponse({'status': 'error', 'message': 'No right to access this collection'}, status=403)
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+
+    pairs = data.get('pairs') if isinstance(data, dict) else None
+    if not isinstance(pairs, list):
+        return JsonResponse({'status': 'error', 'message': 'List of pairs missing'}, status=400)
+
+    if len(pairs) > MAX_BATCH_TRAINING_PAIRS:
+        return JsonResponse({'status': 'error',
+                             'message': f'Maximum {MAX_BATCH_TRAINING_PAIRS} pairs can be sent at once'}, status=400)
+
+    for pair in pairs:
+        if not isinstance(pair, dict) or not isinstance(pair.get('local_recid'), str) \
+                or not isinstance(pair.get('ext_nz_recid'), str) or not isinstance(pair.get('is_match'), bool):
+            return JsonResponse({'status': 'error', 'message': f'Invalid pair: {pair}'}, status=400)
+
+    selected_model = data.get('selectedModel', 'mean')
+    if not scoring.is_scoring_method(selected_model):
+        return JsonResponse({'status': 'error', 'message': f'Unknown model: {selected_model}'}, status=400)
+
+    result = training.add_training_pairs(col_name, mongo_db_dedup, mongo_col_nz, pairs, method=selected_model)
+
+    return JsonResponse({'status': 'ok', **result})
+
+
+@login_required
+def get_training_data_export(request: HttpRequest) -> HttpResponse:
+    """
+    API endpoint to export the training data.
+
+    JSON Lines are streamed from the cursor. The Parquet file is written by row
+    groups to a temporary file, it requires pyarrow. The training data contains records
+    of all the collections, only staff users can export it.
+
+    Parameters of the request:
+        - format: 'jsonl' (default) or 'parquet'
+        - type: only the entries of this type of record, for example 'book'
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: File for download or an error response.
+    """
+    if not request.user.is_staff:
+        return HttpResponse("No right to access the training data", status=403)
+
+    export_format = request.GET.get('format', 'jsonl')
+    entry_type = request.GET.get('type')
+    entries = training.iter_training_data(mongo_db_dedup, entry_type=entry_type)
+    filename = f'training_data_{entry_type}' if entry_type is not None else 'training_data'
+
+    if export_format == 'jsonl':
+        response = StreamingHttpResponse(tools.iter_jsonl(entries), content_type='application/jsonl; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.jsonl"'
+        return response
+
+    if export_format == 'parquet':
+        # The temporary file is deleted when the response closes it
+        output = tempfile.TemporaryFile()
+        try:
+            training.write_training_parquet(entries, output)
+        except ImportError:
+            output.close()
+            return HttpResponse('Parquet export requires pyarrow', status=501)
+        output.seek(0)
+        return FileResponse(output, as_attachment=True, filename=f'{filename}.parquet',
+                            content_type='application/vnd.apache.parquet')
+
+    return HttpResponse(escape(f'Unknown export format "{export_format}"'), status=400)
+
+
+@login_required
+def get_training_evaluation(request: HttpRequest) -> JsonResponse:
+    """
+    API endpoint to evaluate the scoring methods on the training data.
+
+    For each method, the precision, recall, F1 and confusion matrix are returned at each
+    threshold, see `training.get_evaluation`. The thresholds of the filters of the list of
+    records are always evaluated. The result is cached until the training data changes. Only
+    staff users can read the evaluation of the training data.
+
+    Parameters of the request:
+        - type: only the entries of this type of record, for example 'book'
+        - methods: comma separated methods, all the methods and learned models by default
+        - thresholds: comma separated thresholds between 0 and 1, from 0 to 1 by 0.01 by default
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: The evaluation of the methods or an error message.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': 'No right to access the training data'}, status=403)
+
+    methods = request.GET.get('methods')
+    if methods is not None:
+        methods = [method for method in methods.split(',') if method != '']
+        unknown_methods = [method for method in methods if not scoring.is_scoring_method(method)]
+        if len(methods) == 0 or len(unknown_methods) > 0:
+            return JsonResponse({'status': 'error', 'message': f'Unknown models: {unknown_methods}'}, status=400)
+
+    thresholds = request.GET.get('thresholds')
+    if thresholds is not None:
+        try:
+            thresholds = [float(threshold) for threshold in thresholds.split(',')]
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Thresholds must be numbers'}, status=400)
+        if not all(0 <= threshold <= 1 for threshold in thresholds):
+            return JsonResponse({'status': 'error', 'message': 'Thresholds must be between 0 and 1'}, status=400)
+
+    evaluation = training.get_evaluation(mongo_db_dedup, entry_type=request.GET.get('type'),
+                                         methods=methods, thresholds=thresholds)
+
+    return JsonResponse({'status': 'ok', **evaluation})
+
+
 @login_required
 def get_matching_records(request, col_name=None) -> HttpResponse:
     """
     API endpoint to export records with a match (match, duplicate_match, possible_match) for a collection.
 
-    This endpoint requires authentication. It returns an Excel file containing the matching records for the specified collection,
-    or redirects to the collection view if no results are found.
+    This endpoint requires authentication. It returns a file containing the matching records for the specified collection,
+    or redirects to the collection view if no results are found. The collection is read with a cursor: CSV and TSV
+    are streamed, the Excel file is written to a temporary file with a constant memory usage.
+
+    The export does not wait for the refresh of the match types. If it is pending, a refresh is started in
+    background, the current match types are exported and the 'X-Dedup-Refresh-Pending' header is 'true'.
+
+    Parameters of the request:
+        - format: 'xlsx' (default), 'csv' or 'tsv'
 
     Args:
         request (HttpRequest): The HTTP request object.
         col_name (str, optional): The collection name.
 
     Returns:
-        HttpResponse: Excel file for download or a redirect response.
-    """
-
-    if col_name is not None:
-        tools.refresh_match_type(col_name, mongo_db_dedup)
-
-    matching_records = mongo_db_dedup[col_name].find({'match_type': {'$in': ['match', 'duplicate_match', 'possible_match']}},
-                                                           {'_id': False,
-                                                            'rec_id': True,
-                                                            'matched_record': True,
-                                                            'possible_matches': True,
-                                                            'match_type': True})
-    data = []
-    for matching_record in matching_records:
-        if matching_record['match_type'] in ['match', 'duplicate_match']:
-            # Matched record
-            data.append({'rec_id': matching_record['rec_id'],
-                         'matched_record': matching_record['matched_record'],
-                         'match_type': matching_record['match_type']})
-        elif matching_record['match_type'] == 'possible_match':
-            # No match but possible matches
-            for possible_match in matching_record['possible_matches']:
-                data.append({'rec_id': matching_record['rec_id'],
-                             'matched_record': possible_match,
-                             'match_type': matching_record['match_type']})
-
-    if len(data) == 0:
+        HttpResponse: File for download or a redirect response.
+    """
+    export_format = request.GET.get('format', 'xlsx')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponse(escape(f'Unknown export format "{export_format}"'), status=400)
+
+    refresh_pending = tools.is_match_type_refresh_pending(col_name, mongo_db_dedup)
+    if refresh_pending is True:
+        tools.schedule_match_type_refresh(col_name, mongo_db_dedup)
+
+    rows = tools.iter_matching_rows(mongo_db_dedup[col_name])
+    first_row = next(rows, None)
+    if first_row is None:
         return collection(request, col_name)
+    rows = itertools.chain([first_row], rows)
+
+    filename = f'export_{col_name}.{export_format}'
+    if export_format == 'xlsx':
+        # The temporary file is deleted when the response closes it
+        output = tempfile.TemporaryFile()
+        tools.write_xlsx(rows, tools.MATCHING_EXPORT_COLUMNS, output)
+        output.seek(0)
+        response = FileResponse(output, as_attachment=True, filename=filename,
+                                content_type=EXPORT_FORMATS[export_format])
+    else:
+        delimiter = '\t' if export_format == 'tsv' else ','
+        response = StreamingHttpResponse(tools.iter_delimited(rows, tools.MATCHING_EXPORT_COLUMNS, delimiter),
+                                         content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+    response['X-Dedup-Refresh-Pending'] = 'true' if refresh_pending is True else 'false'
+
+    return response
+
+@login_required
+def get_marcxml_export(request: HttpRequest, col_name: str) -> HttpResponse:
+    """
+    API endpoint to export the records of a collection in MarcXML.
+
+    The export is streamed: the collection is read with a cursor and the records
+    are serialized one by one, memory usage does not depend on the size of the
+    collection.
 
-    # create dataframe from the data
-    df = pd.DataFrame(data)
+    Parameters of the request:
+        - records: 'local' to export the full records of the collection (default) or 'nz'
+          to export the NZ records matched by the records of the collection
+        - gzip: '1' to compress the export with gzip
 
-    # Export data to Excel
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False)
+    Args:
+        request (HttpRequest): The HTTP request object.
+        col_name (str): The collection name.
+
+    Returns:
+        HttpResponse: Streamed MarcXML file or an error response.
+    """
+    if not tools.is_col_allowed(col_name, request):
+        return HttpResponse("No right to access this collection", status=403)
+
+    records = request.GET.get('records', 'local')
+    compress = request.GET.get('gzip', '0') == '1'
 
-    # Prepare response with the Excel file
-    response = HttpResponse(
-        output.getvalue(),
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
-    response['Content-Disposition'] = f'attachment; filename="export_{col_name}.xlsx"'
+    if records == 'local':
+        recs = tools.iter_local_fullrecs(mongo_db_dedup[col_name])
+    elif records == 'nz':
+        recs = tools.iter_matched_nz_recs(mongo_db_dedup[col_name], mongo_col_nz)
+    else:
+        return HttpResponse(escape(f'Unknown records type "{records}"'), status=400)
+
+    response = StreamingHttpResponse(tools.iter_marcxml(recs, compress=compress),
+                                     content_type='application/gzip' if compress is True else 'application/xml')
+    filename = f'export_{col_name}_{records}.xml' + ('.gz' if compress is True else '')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
     return response
 
+
+@login_required
+def get_decisions_export(request: HttpRequest, col_name: str) -> HttpResponse:
+    """
+    API endpoint to export the decisions taken on a collection since a watermark.
+
+    The entries of the decision journal are streamed in the order they are written,
+    the last entry of a record is its current decision. The response has a
+    'X-Dedup-Watermark' header: it must be used as 'since' parameter of the next
+    export to get only the new decisions. The watermark is `DEDUP_JOURNAL_SAFETY_LAG`
+    seconds in the past, the decisions written since are returned by the next export.
+
+    Parameters of the request:
+        - since: ISO 8601 date, only the decisions written after it are exported, all decisions by default.
+          Dates without time zone are in UTC.
+        - format: 'csv' (default) or 'jsonl'
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        col_name (str): The collection name.
+
+    Returns:
+        HttpResponse: Streamed file or an error response.
+    """
+    if tools.is_reserved_col(col_name) is True or not tools.is_col_allowed(col_name, request):
+        return HttpResponse("No right to access this collection", status=403)
+
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in JOURNAL_EXPORT_FORMATS:
+        return HttpResponse(escape(f'Unknown export format "{export_format}"'), status=400)
+
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return HttpResponse(escape(f'Invalid date "{since}"'), status=400)
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+
+    # Decisions written after the watermark are returned by the next export
+    until = tools.get_journal_watermark()
+    entries = tools.iter_journal_entries(col_name, mongo_db_dedup, since=since, until=until)
+
+    response = StreamingHttpResponse(tools.iter_journal_export(entries, export_format),
+                                     content_type=JOURNAL_EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="decisions_{col_name}.{export_format}"'
+    response['X-Dedup-Watermark'] = until.isoformat()
+
+    return response
+
+
 def login_view(request) -> HttpResponse:
     """
     Handle user authentication using Django's AuthenticationForm.
@@ -595,18 +1123,14 @@ def logout_view(request):
 #         "query": f"identifier={rec_id}",
 #         "recordSchema": "MARC21-xml"
 #     }
-#     nsmap = {'srw': 'http://www.loc.gov/zing/srw/',
-#              'm': 'http://www.loc.gov/MARC21/slim',
-#              'diag': 'http://www.loc.gov/zing/srw/diagnostic/'}
-#
 #     base_url = "https://services.dnb.de/sru/dnb"
 #
 #     # Send the request
 #     response = requests.get(base_url, params=params)
 #     xml_rec = XmlData(response.content)
 #
-#     records = [XmlData(etree.tostring(tools.remove_ns(r))) for r in
-#                xml_rec.content.findall('.//m:record', namespaces=nsmap)]
+#     records = [XmlData(etree.tostring(r)) for r in
+#                tools.remove_ns_from_records(xml_rec.content, 'recordData/record')]
 #
 #     rec = records[0] if len(records) > 0 else None
 #
@@ -0,0 +1,98 @@
+"""
+Micro-benchmark of `dedup.tools.json_to_marc` against the previous implementation.
+
+Usage:
+    python scripts/benchmark_json_to_marc.py [--records 20] [--fields 400] [--seed 1]
+
+Random JSON MARC records are generated with shuffled tags, spaces and HTML markup in
+the values and the indicators and empty lists of subfields. The previous implementation
+escapes the data of the records like the current one, so both return the same HTML.
+The outputs of both implementations are compared first, then the time by record of each
+one is measured with `timeit`, the best of several runs is kept.
+"""
+import argparse
+import html
+import os
+import random
+import re
+import string
+import sys
+import timeit
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup.tools import json_to_marc  # noqa: E402
+
+
+def json_to_marc_baseline(rec: Dict) -> str:
+    """Previous implementation of `json_to_marc`, it sorts the rendered lines, with the data escaped"""
+    data = rec['marc'] if 'marc' in rec else rec
+    escape = html.escape
+
+    new_data = list()
+    new_data.append(f'<strong>LDR&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong>{escape(data["leader"])}')
+    for f_num in data:
+        if f_num.startswith('00'):
+            new_data.append(f'<strong>{f_num}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;</strong> {escape(data[f_num])}')
+
+        elif re.match(r'^\d{3}$', f_num):
+            for field in data[f_num]:
+                subfields = ' '.join([[f'<strong>$${escape(f)}</strong> {escape(subfield[f])}' for f in subfield][0]
+                                      for subfield in field["sub"]])
+
+                indicators = f'{escape(field["ind1"])}&nbsp;{escape(field["ind2"])}'
+                new_data.append(f'<strong>{f_num}&nbsp;{indicators}&nbsp;</strong> {subfields}')
+
+    new_data = '<br>'.join(sorted(new_data, key=lambda k: 0 if k.startswith('<strong>LDR') else int(k[8:11])))
+    return new_data.replace(' ', '&nbsp;')
+
+
+def get_random_record(rnd: random.Random, nb_fields: int) -> Dict:
+    """Return a random JSON MARC record, as a NZ record or as the full record of a dedup document"""
+    def value() -> str:
+        return ''.join(rnd.choice(string.ascii_letters + 'éà  ,.<>&"') for _ in range(rnd.randint(1, 30)))
+
+    marc = {'leader': '00000nam a2200000 c 4500', '001': '991', '005': '2020 0101', '008': '200101s2020    sz    '}
+    for _ in range(nb_fields):
+        tag = f'{rnd.randint(10, 999):03d}'
+        marc.setdefault(tag, []).append({'ind1': rnd.choice(' 01<'),
+                                         'ind2': rnd.choice(' 01'),
+                                         'sub': [{rnd.choice('abcdefgh6 &'): value()} for _ in range(rnd.randint(0, 6))]})
+    marc['mms_id'] = '99'
+    items = list(marc.items())
+    rnd.shuffle(items)
+
+    return {'mms_id': '1', 'marc': dict(items)} if rnd.random() < 0.5 else dict(items)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20, help='Number of timed records')
+    parser.add_argument('--fields', type=int, default=400, help='Number of datafields of each timed record')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random records')
+    parser.add_argument('--number', type=int, default=5, help='Number of renderings of the records by run')
+    parser.add_argument('--repeat', type=int, default=7, help='Number of runs, the best one is kept')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+
+    # Both implementations must return the same HTML, records of all sizes are checked
+    checked = [get_random_record(rnd, rnd.randint(0, args.fields)) for _ in range(300)]
+    for rec in checked:
+        if json_to_marc(rec) != json_to_marc_baseline(rec):
+            sys.exit(f'Outputs differ for record: {rec}')
+    print(f'Identical output on {len(checked)} records')
+
+    recs = [get_random_record(rnd, args.fields) for _ in range(args.records)]
+    times = dict()
+    for name, function in [('baseline', json_to_marc_baseline), ('json_to_marc', json_to_marc)]:
+        best = min(timeit.repeat(lambda: [function(rec) for rec in recs], number=args.number, repeat=args.repeat))
+        times[name] = best / (args.number * len(recs))
+        print(f'{name:<13} {times[name] * 1e3:.3f} ms per record ({args.fields} datafields)')
+
+    print(f'Speedup: {times["baseline"] / times["json_to_marc"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -112,6 +112,10 @@ LOGOUT_REDIRECT_URL = '/'
 # Pour le développement, désactive la vérification SSL (à ne pas faire en prod)
 OIDC_VERIFY_SSL = False
 
+# --- DEDUP CONFIGURATION ---
+# Settings of the dedup application, see `settings_dedup.py`
+from .settings_dedup import *  # noqa: E402,F401,F403
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 LANGUAGE_CODE = 'en-us'
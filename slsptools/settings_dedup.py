@@ -0,0 +1,38 @@
+"""
+Settings of the dedup application, shared by the development and the production settings.
+
+They are imported by `settings.py` and `settings_prod.py`, which can override them.
+"""
+from pathlib import Path
+
+# Pool of workers used by the web app to evaluate the similarity of the possible matches
+# of a record. Executor can be 'thread' or 'process', with 0 workers the evaluation is
+# sequential. A pool of processes is created lazily in each web worker: it forks a process
+# holding a connected MongoClient and the state of Django, and each pair of brief records
+# is sent to another process. Only use it with a server starting its workers without
+# threads before the first request. The `rescore_collection` and `build_training_features`
+# commands create their own pools of processes.
+DEDUP_SCORING_EXECUTOR = 'thread'
+DEDUP_SCORING_WORKERS = 4
+
+# In-process LRU cache of parsed NZ brief records: maximum number of entries and
+# lifetime of the entries in seconds
+DEDUP_BRIEFREC_CACHE_SIZE = 20000
+DEDUP_BRIEFREC_CACHE_TTL = 3600
+
+# Maximum duration in seconds of a refresh of the match types of a collection. Only one
+# refresh runs by collection, after this delay the lease of a refresh can be taken over.
+DEDUP_MATCH_TYPE_REFRESH_LEASE = 600
+
+# Delay in seconds before a decision can be exported from the decision journal. The entries
+# are written after the decisions, the watermark of an export is this delay in the past so
+# that entries still being written are returned by the next export.
+DEDUP_JOURNAL_SAFETY_LAG = 60
+
+# Method used to choose the best candidate of each record, the similarity scores of its
+# fields are stored in the dedup documents and can be used to filter the list of records
+DEDUP_FIELD_SCORES_METHOD = 'mean'
+
+# Directory of the models trained on the training data with the `train_model` command,
+# they can be selected as 'learned:<name>' methods. It is at the root of the project.
+DEDUP_MODELS_DIR = Path(__file__).resolve().parent.parent / 'dedup_models'
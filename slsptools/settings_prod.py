@@ -141,3 +141,7 @@ OIDC_CREATE_USER = False
 
 IZS_WITH_ACTIVE_MFA = ['NZ']
 IZ_ONE_LOGIN_LETTER_TOKEN = os.getenv('IZ_ONE_LOGIN_LETTER_TOKEN')
+
+# --- DEDUP CONFIGURATION ---
+# Settings of the dedup application, see `settings_dedup.py`
+from .settings_dedup import *  # noqa: E402,F401,F403